@@ -0,0 +1,200 @@
+"""
+How the calls to OpenAI are going: how long they take, how many tokens they use, what they
+cost and how often they fail, for each kind of call and engine.
+
+Shown by `s, stats` and, as JSON, by Flask's `/stats` endpoint. Time is split up into
+waiting for the LLMScheduler ("queue"), building the prompt ("prompt"), moderation and
+the completion itself, to tell where slow answers come from.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import statistics
+import threading
+import time
+from typing import Any, Iterator, Optional
+
+import aiohttp
+import openai
+
+from api.utilities.openai import OpenAIEngines
+
+# dollars per 1000 (prompt, completion) tokens
+ENGINE_PRICES = {
+    OpenAIEngines.DAVINCI: (0.02, 0.02),
+    OpenAIEngines.CURIE: (0.002, 0.002),
+    OpenAIEngines.BABBAGE: (0.0005, 0.0005),
+    OpenAIEngines.GPT_3_5_TURBO: (0.0015, 0.002),
+    OpenAIEngines.GPT_4: (0.03, 0.06),
+}
+
+# how many of the latest durations the percentiles are worked out from
+RECENT_CALLS = 200
+
+
+@dataclass
+class CallStats:
+    calls: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    timeouts: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    total_seconds: float = 0.0
+    recent_seconds: deque[float] = field(default_factory=lambda: deque(maxlen=RECENT_CALLS))
+
+    def percentile(self, percent: int) -> Optional[float]:
+        if len(self.recent_seconds) < 2:
+            return self.recent_seconds[0] if self.recent_seconds else None
+        return statistics.quantiles(self.recent_seconds, n=100)[percent - 1]
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "timeouts": self.timeouts,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": round(self.cost, 4),
+            "mean_seconds": self.total_seconds / self.calls if self.calls else None,
+            "p50_seconds": self.percentile(50),
+            "p95_seconds": self.percentile(95),
+        }
+
+    def summary(self) -> str:
+        parts = [f"{self.calls} calls"]
+        if self.calls:
+            parts.append(f"median {self.percentile(50):.2f}s, p95 {self.percentile(95):.2f}s")
+        for count, label in [
+            (self.errors, "errors"),
+            (self.rate_limited, "rate limited"),
+            (self.timeouts, "timed out"),
+        ]:
+            if count:
+                parts.append(f"{count} {label}")
+        if self.prompt_tokens or self.completion_tokens:
+            parts.append(f"{self.prompt_tokens}+{self.completion_tokens} tokens")
+        if self.cost:
+            parts.append(f"~${self.cost:.2f}")
+        return ", ".join(parts)
+
+
+class CallRecord:
+    """Filled in by the caller while a call is being timed"""
+
+    def __init__(self) -> None:
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add_usage(self, usage: Optional[dict]) -> None:
+        """Take the token counts from the `usage` of an OpenAI response"""
+        if usage:
+            self.prompt_tokens += usage.get("prompt_tokens", 0)
+            self.completion_tokens += usage.get("completion_tokens", 0)
+
+
+def is_rate_limit(error: BaseException) -> bool:
+    if isinstance(error, openai.error.RateLimitError):
+        return True
+    return isinstance(error, aiohttp.ClientResponseError) and error.status == 429
+
+
+class LLMMetrics:
+    __instance: Optional[LLMMetrics] = None
+
+    @staticmethod
+    def get_instance() -> LLMMetrics:
+        if LLMMetrics.__instance is None:
+            LLMMetrics.__instance = LLMMetrics()
+        return LLMMetrics.__instance
+
+    def __init__(self) -> None:
+        # Flask handles messages in its own thread
+        self.lock = threading.Lock()
+        # by (kind of call, engine)
+        self.stats: dict[tuple[str, Optional[OpenAIEngines]], CallStats] = {}
+        self.started = time.time()
+
+    def get(self, kind: str, engine: Optional[OpenAIEngines]) -> CallStats:
+        key = (kind, engine)
+        if key not in self.stats:
+            self.stats[key] = CallStats()
+        return self.stats[key]
+
+    @contextmanager
+    def timed(self, kind: str, engine: Optional[OpenAIEngines] = None) -> Iterator[CallRecord]:
+        """Time the block, which makes a call of this `kind` (e.g. "completion", "moderation").
+
+        Exceptions are counted (as errors, rate limits or timeouts) and passed on.
+        """
+        record = CallRecord()
+        start = time.monotonic()
+        error: Optional[BaseException] = None
+        try:
+            yield record
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.add(kind, engine, time.monotonic() - start, record, error)
+
+    def add(
+        self,
+        kind: str,
+        engine: Optional[OpenAIEngines],
+        seconds: float,
+        record: Optional[CallRecord] = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        with self.lock:
+            stats = self.get(kind, engine)
+            stats.calls += 1
+            stats.total_seconds += seconds
+            stats.recent_seconds.append(seconds)
+            if error is not None:
+                if is_rate_limit(error):
+                    stats.rate_limited += 1
+                elif isinstance(error, (asyncio.TimeoutError, openai.error.Timeout)):
+                    stats.timeouts += 1
+                else:
+                    stats.errors += 1
+            if record is not None:
+                stats.prompt_tokens += record.prompt_tokens
+                stats.completion_tokens += record.completion_tokens
+                if engine in ENGINE_PRICES:
+                    prompt_price, completion_price = ENGINE_PRICES[engine]
+                    stats.cost += (
+                        record.prompt_tokens * prompt_price
+                        + record.completion_tokens * completion_price
+                    ) / 1000
+
+    def as_dict(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "since": self.started,
+                "calls": [
+                    {"kind": kind, "engine": str(engine) if engine else None, **stats.as_dict()}
+                    for (kind, engine), stats in self.stats.items()
+                ],
+            }
+
+    def summary(self) -> str:
+        """For the stats command"""
+        with self.lock:
+            lines = ["LLM calls:"]
+            for (kind, engine), stats in sorted(
+                self.stats.items(), key=lambda item: (item[0][0], str(item[0][1]))
+            ):
+                lines.append(f"{kind}{f' ({engine})' if engine else ''}: {stats.summary()}")
+            if len(lines) == 1:
+                lines.append("none yet")
+            total = sum(stats.cost for stats in self.stats.values())
+        if total:
+            lines.append(f"Estimated cost: ${total:.2f}")
+        return "\n".join(lines)
@@ -0,0 +1,194 @@
+"""
+Decides when requests to the language models get made.
+
+When several people ping Stampy in the same channel at once, each message would otherwise
+get its own completion, all built from (nearly) the same chat log, racing each other.
+Instead, every request says which channel it's for:
+
+- A channel has at most one request waiting. A new request for the channel replaces the
+  waiting one (which gets None back, and shouldn't reply), and a single completion built
+  from the latest chat log answers them all.
+- A channel has at most one request running, so replies come out in order.
+- Each engine has at most ENGINE_CONCURRENCY requests running (GPT-4 is slow and costs a lot),
+  the rest wait their turn, VIPs first, then bot devs, then everyone else.
+
+Flask runs every callback in its own event loop (and thread), so the scheduler's state is
+guarded by a lock and waiting requests are woken up in their own loop.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+import heapq
+import itertools
+import threading
+import time
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional, TypeVar
+
+from structlog import get_logger
+
+from api.llm_metrics import LLMMetrics
+from api.utilities.openai import OpenAIEngines
+from config import bot_vip_ids
+from utilities import is_bot_dev
+from utilities.serviceutils import ServiceUser
+
+log = get_logger()
+
+# how many requests to each engine can run at once
+ENGINE_CONCURRENCY = {
+    OpenAIEngines.GPT_4: 2,
+}
+DEFAULT_CONCURRENCY = 4
+
+# lower goes first
+PRIORITY_VIP = 0
+PRIORITY_BOT_DEV = 1
+PRIORITY_DEFAULT = 2
+
+T = TypeVar("T")
+
+
+def request_priority(user: ServiceUser) -> int:
+    if user.id in bot_vip_ids:
+        return PRIORITY_VIP
+    if is_bot_dev(user):
+        return PRIORITY_BOT_DEV
+    return PRIORITY_DEFAULT
+
+
+@dataclass(order=True)
+class LLMRequest:
+    priority: int
+    number: int  # requests with the same priority go in the order they came
+    key: Hashable = field(compare=False)
+    engine: OpenAIEngines = field(compare=False)
+    turn: asyncio.Future = field(compare=False)
+    # whether it's been let through (True) or replaced by a newer request (False)
+    outcome: Optional[bool] = field(default=None, compare=False)
+
+
+class LLMScheduler:
+    __instance: Optional[LLMScheduler] = None
+
+    @staticmethod
+    def get_instance() -> LLMScheduler:
+        if LLMScheduler.__instance is None:
+            LLMScheduler.__instance = LLMScheduler()
+        return LLMScheduler.__instance
+
+    def __init__(self) -> None:
+        self.class_name = self.__class__.__name__
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.queues: defaultdict[OpenAIEngines, list[LLMRequest]] = defaultdict(list)
+        self.running: defaultdict[OpenAIEngines, int] = defaultdict(int)
+        # the waiting request and the running one, of each key (e.g. channel) that has them
+        self.waiting: dict[Hashable, LLMRequest] = {}
+        self.active: set[Hashable] = set()
+
+    async def submit(
+        self,
+        key: Hashable,
+        engine: OpenAIEngines,
+        priority: int,
+        generate: Callable[[], Awaitable[T]],
+    ) -> Optional[T]:
+        """Await `generate()` once it's this request's turn.
+
+        Returns None, without calling `generate`, if a newer request with the same key
+        turned up while this one was waiting. `generate` should build its prompt when it's
+        called, so that it includes everything that was said while it waited.
+        """
+        async with self.turn(key, engine, priority) as let_through:
+            if not let_through:
+                return None
+            return await generate()
+
+    @asynccontextmanager
+    async def turn(
+        self, key: Hashable, engine: OpenAIEngines, priority: int
+    ) -> AsyncIterator[bool]:
+        """Wait for this request's turn, and hold on to it until the block ends.
+
+        Gives False if a newer request with the same key turned up while this one was
+        waiting, in which case there's nothing to do. For requests that last longer than a
+        single call, e.g. streamed completions.
+        """
+        request = LLMRequest(
+            priority, next(self.counter), key, engine, asyncio.get_running_loop().create_future()
+        )
+        with self.lock:
+            replaced = self.waiting.get(key)
+            if replaced is not None:
+                # the newer request answers for both, so it gets the better place in the queue
+                request.priority = min(request.priority, replaced.priority)
+                self.settle(replaced, False)
+            self.waiting[key] = request
+            heapq.heappush(self.queues[engine], request)
+            self.dispatch(engine)
+
+        queued_at = time.monotonic()
+        try:
+            let_through = await request.turn
+        except asyncio.CancelledError:
+            with self.lock:
+                if request.outcome is None:
+                    self.settle(request, False)
+                elif request.outcome:
+                    self.finish(request)
+            raise
+
+        if not let_through:
+            log.info(self.class_name, msg="Dropped a request that was replaced by a newer one", key=key)
+            yield False
+            return
+        LLMMetrics.get_instance().add("queue", engine, time.monotonic() - queued_at)
+        try:
+            yield True
+        finally:
+            with self.lock:
+                self.finish(request)
+
+    def settle(self, request: LLMRequest, let_through: bool) -> None:
+        """Decide what happens to a waiting request, and wake it up. Call with the lock held."""
+        request.outcome = let_through
+        if self.waiting.get(request.key) is request:
+            del self.waiting[request.key]
+        if let_through:
+            self.running[request.engine] += 1
+            self.active.add(request.key)
+
+        def wake() -> None:
+            if not request.turn.done():
+                request.turn.set_result(let_through)
+
+        loop = request.turn.get_loop()
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(wake)
+
+    def finish(self, request: LLMRequest) -> None:
+        """A request that was let through is done. Call with the lock held."""
+        self.running[request.engine] -= 1
+        self.active.discard(request.key)
+        # this key's next request could be waiting on any engine
+        for engine in list(self.queues):
+            self.dispatch(engine)
+
+    def dispatch(self, engine: OpenAIEngines) -> None:
+        """Let through as many waiting requests as the engine has room for. Call with the lock held."""
+        queue = self.queues[engine]
+        held_back = []
+        while queue and self.running[engine] < ENGINE_CONCURRENCY.get(engine, DEFAULT_CONCURRENCY):
+            request = heapq.heappop(queue)
+            if request.outcome is not None:
+                continue  # replaced or cancelled
+            if request.key in self.active:
+                held_back.append(request)
+                continue
+            self.settle(request, True)
+        for request in held_back:
+            heapq.heappush(queue, request)
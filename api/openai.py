@@ -1,4 +1,8 @@
 import asyncio
+from collections import OrderedDict
+import hashlib
+from typing import Optional
+from api.llm_metrics import LLMMetrics
 from api.utilities.openai import OpenAIEngines
 from config import (
     openai_api_key,
@@ -12,6 +16,7 @@ from config import (
     openai_allowed_sources,
 )
 from structlog import get_logger
+from utilities.http_utils import DeadlineExceededError, HttpClient, time_left
 from utilities.serviceutils import ServiceMessage
 from utilities import Utilities, discordutils
 if use_helicone:
@@ -22,8 +27,8 @@ if use_helicone:
 else:
     import openai
     from openai import Moderation
+import aiohttp
 import discord
-import requests
 import json # moderation response dump
 
 
@@ -33,13 +38,39 @@ OPENAI_NASTY_CATEGORIES = {
     "harassment/threatening", "violence"
 }
 
+OPENAI_MODERATION_URL = "https://api.openai.com/v1/moderations"
+
+# seconds to wait for openai before giving up. GPT-4 can take a while to write a reply.
+COMPLETION_TIMEOUT = 60
+MODERATION_TIMEOUT = 10
+
+# how many moderation verdicts to remember
+MODERATION_CACHE_SIZE = 2000
+
 openai.api_key = openai_api_key
 start_sequence = "\nA:"
 restart_sequence = "\n\nQ: "
 utils = Utilities.get_instance()
 
 
+def request_timeout(timeout: float) -> float:
+    """`timeout`, or less if the message being answered has to be answered sooner"""
+    remaining = time_left()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceededError("Ran out of time to answer this message")
+    return min(timeout, remaining)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
 class OpenAI:
+    # whether texts are risky, by `content_hash`, shared by every module that uses openai
+    verdicts: OrderedDict[str, bool] = OrderedDict()
+
     def __init__(self):
         self.class_name = self.__class__.__name__
         self.log = get_logger()
@@ -62,68 +93,103 @@ class OpenAI:
         if exception:
             loop.create_task(utils.log_exception(exception))
 
-    def is_text_risky(self, text: str) -> bool:
+    async def is_text_risky(self, text: str) -> bool:
         """Ask the openai moderation endpoint if the text is risky.
 
         See https://platform.openai.com/docs/guides/moderation/quickstart for details.
         """
-        allowed_categories = {"violence"} # Can be triggered by some AI safety terms
+        return await self.any_text_risky([text])
 
+    async def any_text_risky(self, texts: list[str]) -> bool:
+        """Whether any of the texts is risky, asking about all the unfamiliar ones in one request"""
         if disable_prompt_moderation:
             return False
+        return any(await self.moderate(texts))
 
-        response = None
-        if use_helicone:
-            try:
-                http_response = requests.post(
-                    'https://api.openai.com/v1/moderations',
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {openai_api_key}"
-                    },
-                    json={"input": text}
-                )
-            except Exception as e:
-                self.log_error("Error in Requests module trying to moderate content", e)
-                return True
+    async def moderate(self, texts: list[str]) -> list[bool]:
+        """Whether each of the texts is risky.
+
+        Verdicts are remembered (by a hash of the text), so e.g. the chat log, which is
+        mostly the same every time, doesn't get checked again and again. Only texts we
+        haven't seen are sent to the moderation endpoint, all in one request. If that
+        fails, they count as risky (but that isn't remembered).
+        """
+        keys = [content_hash(text) for text in texts]
+        unseen = {key: text for key, text in zip(keys, texts) if key not in self.verdicts}
+        if unseen:
+            results = await self.request_moderation(list(unseen.values()))
+            if results is None:
+                return [key in unseen or self.verdicts[key] for key in keys]
+            for key, result in zip(unseen, results):
+                self.verdicts[key] = self.is_result_risky(result)
+        else:
+            self.log.info(self.class_name, msg="Already checked all of this with the content filter")
 
-            if http_response.status_code == 401:
+        verdicts = []
+        for key in keys:
+            self.verdicts.move_to_end(key)
+            verdicts.append(self.verdicts[key])
+        while len(self.verdicts) > MODERATION_CACHE_SIZE:
+            self.verdicts.popitem(last=False)
+        return verdicts
+
+    async def request_moderation(self, texts: list[str]) -> Optional[list[dict]]:
+        """The moderation endpoint's results for each of the texts, or None if something went wrong"""
+        try:
+            with LLMMetrics.get_instance().timed("moderation"):
+                timeout = request_timeout(MODERATION_TIMEOUT)
+                if use_helicone:
+                    async with HttpClient.get_instance().request(
+                        "POST",
+                        OPENAI_MODERATION_URL,
+                        headers={"Authorization": f"Bearer {openai_api_key}"},
+                        json={"input": texts},
+                        timeout=aiohttp.ClientTimeout(total=timeout),
+                    ) as http_response:
+                        response = await http_response.json()
+                else:
+                    response = await asyncio.wait_for(Moderation.acreate(input=texts), timeout)
+        except aiohttp.ClientResponseError as e:
+            if e.status == 401:
                 self.log_error("OpenAI Authentication Failed")
-                return True
-            elif http_response.status_code == 429:
+            elif e.status == 429:
                 self.log_error("OpenAI Rate Limit Exceeded", warning=True)
-                return True
-            elif http_response.status_code != 200:
-                self.log_error(
-                    f"Possible issue with the OpenAI API. Status: {http_response.status_code}, Content: {http_response.text}"
-                )
-                return True
-            response = http_response.json()
+            else:
+                self.log_error(f"Possible issue with the OpenAI API. Status: {e.status}, Message: {e.message}")
+            return None
+        except openai.error.AuthenticationError as e:
+            self.log_error("OpenAI Authentication Failed", e)
+            return None
+        except openai.error.RateLimitError as e:
+            self.log_error("OpenAI Rate Limit Exceeded", e, warning=True)
+            return None
+        except (asyncio.TimeoutError, openai.error.Timeout):
+            self.log_error("Timed out waiting for the OpenAI moderation endpoint", warning=True)
+            return None
+        except Exception as e:
+            self.log_error("Error trying to moderate content", e)
+            return None
 
-        else:
-            try:
-                response = Moderation.create(input=text)
-            except openai.error.AuthenticationError as e:
-                self.log_error("OpenAI Authentication Failed", e)
-                return True
-            except openai.error.RateLimitError as e:
-                self.log_error(self.class_name, "OpenAI Rate Limit Exceeded", e, warning=True)
-                return True
-
-        results = response.get("results", [])[0]
-        if not results:
-            return False
+        results = response.get("results", [])
+        if len(results) != len(texts):
+            self.log_error(f"Asked the content filter about {len(texts)} texts, but got {len(results)} results")
+            return None
+        return results
+
+    def is_result_risky(self, result: dict) -> bool:
+        allowed_categories = {"violence"} # Can be triggered by some AI safety terms
 
-        if not results["flagged"]:
+        if not result["flagged"]:
             self.log.info(self.class_name, msg=f"Checked with content filter, it says the text looks clean")
             return False
 
+        categories = result.get("categories", {})
         violated_categories = [
-            moral for moral in OPENAI_NASTY_CATEGORIES - allowed_categories if results.get(moral)
+            moral for moral in OPENAI_NASTY_CATEGORIES - allowed_categories if categories.get(moral)
         ]
         if violated_categories:
             self.log.warning(self.class_name, msg=f"Text violated these unwanted categories: {violated_categories}")
-            self.log.debug(self.class_name, msg=f"OpenAI moderation response: {json.dumps(response)}")
+            self.log.debug(self.class_name, msg=f"OpenAI moderation result: {json.dumps(result)}")
             return True
 
         self.log.info(self.class_name, msg="Checked with content filter, it doesn't violate any of our categories")
@@ -140,22 +206,38 @@ class OpenAI:
         else:
             return OpenAIEngines.GPT_3_5_TURBO
 
-    def get_response(self, engine: OpenAIEngines, prompt: str, logit_bias: dict[int, int]) -> str:
-        if self.is_text_risky(prompt):
+    async def get_response(
+        self,
+        engine: OpenAIEngines,
+        prompt: str,
+        logit_bias: dict[int, int],
+        moderate: Optional[list[str]] = None,
+    ) -> str:
+        """`moderate` is what to check with the content filter first, if not the whole prompt,
+        e.g. the separate messages that the prompt is made of, so ones we've seen before can be skipped.
+        """
+        if await self.any_text_risky(moderate if moderate is not None else [prompt]):
             self.log.info(self.class_name, msg="The content filter thought the prompt was risky")
             return ""
 
         try:
-            response = openai.ChatCompletion.create(
-                model=str(engine),
-                messages=[{'role': 'user', 'content': prompt}],
-                temperature=0,
-                max_tokens=100,
-                top_p=1,
-                # stop=["\n"],
-                logit_bias=logit_bias,
-                # user=str(message.author.id),
-            )
+            with LLMMetrics.get_instance().timed("completion", engine) as call:
+                timeout = request_timeout(COMPLETION_TIMEOUT)
+                response = await asyncio.wait_for(
+                    openai.ChatCompletion.acreate(
+                        model=str(engine),
+                        messages=[{'role': 'user', 'content': prompt}],
+                        temperature=0,
+                        max_tokens=100,
+                        top_p=1,
+                        # stop=["\n"],
+                        logit_bias=logit_bias,
+                        # user=str(message.author.id),
+                        request_timeout=timeout,
+                    ),
+                    timeout,
+                )
+                call.add_usage(response.get("usage"))
         except openai.error.AuthenticationError as e:
             self.log.error(self.class_name, error="OpenAI Authentication Failed")
             loop = asyncio.get_running_loop()
@@ -168,6 +250,9 @@ class OpenAI:
             loop.create_task(utils.log_error(f"OpenAI Rate Limit Exceeded"))
             loop.create_task(utils.log_exception(e))
             return ""
+        except (asyncio.TimeoutError, openai.error.Timeout):
+            self.log.warning(self.class_name, error=f"Timed out waiting for {engine}")
+            return ""
 
         if response["choices"]:
             choice = response["choices"][0]
@@ -1,15 +1,28 @@
+from __future__ import annotations
+
 from api.utilities import tokenizers
 from enum import Enum
-from transformers import PreTrainedTokenizerFast
+from typing import TYPE_CHECKING
+
+from structlog import get_logger
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizerFast
+
+log = get_logger()
 
 
 class OpenAIEngines(Enum):
-    def __new__(cls, value: str, name: str, description: str, tokenizer: PreTrainedTokenizerFast):
+    def __new__(
+        cls, value: str, name: str, description: str, tokenizer_name: str, log_budget: int
+    ):
         obj = object.__new__(cls)
         obj._value_ = value
         obj.name = name
         obj.description = description
-        obj.tokenizer = tokenizer
+        obj.tokenizer_name = tokenizer_name
+        # how many tokens of chat log go in a prompt, well inside the model's context window
+        obj.log_budget = log_budget
         return obj
 
     @property
@@ -34,11 +47,14 @@ class OpenAIEngines(Enum):
 
     @property
     def tokenizer(self) -> PreTrainedTokenizerFast:
-        return self._tokenizer
+        """Loaded the first time it's needed, see api/utilities/tokenizers.py"""
+        return tokenizers.get_tokenizer(self.tokenizer_name)
 
-    @tokenizer.setter
-    def tokenizer(self, value: PreTrainedTokenizerFast) -> None:
-        self._tokenizer = value
+    @property
+    def has_own_tokenizer(self) -> bool:
+        """Whether `tokenizer` is the engine's own, rather than a fallback that only counts
+        tokens about right. Token ids (e.g. for a logit bias) need its own."""
+        return tokenizers.is_saved(self.tokenizer_name)
 
     def __str__(self) -> str:
         return str(self._value_)
@@ -47,31 +63,52 @@ class OpenAIEngines(Enum):
         "text-davinci-003",
         "Davinci 003",
         "Should only be used for Rob.",
-        tokenizers.gpt2,
+        "gpt2",
+        400,
     )
     CURIE = (
         "text-curie-001",
         "Curie 001",
         "Should only be used for bot devs.",
-        tokenizers.gpt2,
+        "gpt2",
+        400,
     )
     BABBAGE = (
         "text-babbage-001",
         "Babbage 001",
         "Should be used by everyone else.",
-        tokenizers.gpt2,
+        "gpt2",
+        400,
     )
 
     GPT_3_5_TURBO = (
         "gpt-3.5-turbo",
         "GPT 3.5 Turbo",
         "Medium-cost, general-purpose model",
-        tokenizers.gpt2
+        "cl100k_base",
+        500,
     )
 
     GPT_4 = (
         "gpt-4",
         "GPT 4",
         "wicked slow",
-        tokenizers.gpt2
+        "cl100k_base",
+        500,
     )
+
+
+def tokenizers_available() -> bool:
+    """Whether every engine's tokenizer can be loaded.
+
+    The modules that count tokens are turned off (with their `is_available`) if not, rather
+    than failing every time they're asked something.
+    """
+    missing = tokenizers.missing_tokenizers(engine.tokenizer_name for engine in OpenAIEngines)
+    if missing:
+        log.error(
+            "tokenizers",
+            msg=f"Missing tokenizers {missing} in {tokenizers.tokenizers_dir}, so the LLM modules are off. "
+            "Run `python -m api.utilities.tokenizers` to get them.",
+        )
+    return not missing
@@ -0,0 +1,94 @@
+"""
+The recent messages of a channel, trimmed to fit in a prompt.
+
+Building a prompt only needs the newest messages that fit in the engine's token budget.
+Each message is rendered (e.g. "name: text") and tokenized the first time a prompt for an
+engine with that tokenizer needs it, and the result is kept with the message, so only the
+new messages get tokenized on each turn, rather than the whole history.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Callable, NamedTuple, Optional
+
+from api.utilities.openai import OpenAIEngines
+from utilities.conversations import ConversationStore, MessageRecord
+from utilities.serviceutils import ServiceChannel
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizerFast
+
+# what's put in place of the middle of messages that are too long
+ELLIPSIS = " ... "
+
+
+class Tokenized(NamedTuple):
+    text: str
+    tokens: int
+
+
+def clip_to_tokens(tokenizer: PreTrainedTokenizerFast, text: str, max_tokens: int) -> Tokenized:
+    """`text`, with the middle cut out if it's longer than `max_tokens` tokens"""
+    ids = tokenizer.encode(text)
+    if len(ids) <= max_tokens:
+        return Tokenized(text, len(ids))
+    half = (max_tokens - len(tokenizer.encode(ELLIPSIS))) // 2
+    clipped = tokenizer.decode(ids[:half]) + ELLIPSIS + tokenizer.decode(ids[-half:])
+    # tokens can merge differently where the pieces join, so count again to be exact
+    return Tokenized(clipped, len(tokenizer.encode(clipped)))
+
+
+class PromptWindow:
+    """How a module fits the last `max_messages` messages of a channel into a prompt.
+
+    The messages come from the shared ConversationStore. Each is rendered to text by
+    `render` and cut down to `max_message_tokens`. `message_overhead` is the number of
+    tokens every message costs on top of its text (e.g. separators, or the role in a chat
+    completion).
+    """
+
+    def __init__(
+        self,
+        max_messages: int,
+        max_message_tokens: int,
+        render: Callable[[MessageRecord], str],
+        message_overhead: int = 1,
+    ) -> None:
+        self.max_messages = max_messages
+        self.max_message_tokens = max_message_tokens
+        self.render = render
+        self.message_overhead = message_overhead
+
+    def messages(self, channel: ServiceChannel) -> list[MessageRecord]:
+        return ConversationStore.get_instance().history(channel, self.max_messages)
+
+    def tokenize(self, record: MessageRecord, engine: OpenAIEngines) -> Tokenized:
+        """The message's text as this window renders it, and its length in tokens.
+
+        Worked out once per tokenizer, and kept with the message.
+        """
+        key = (self, engine.tokenizer_name)
+        if key not in record.memo:
+            record.memo[key] = clip_to_tokens(
+                engine.tokenizer, self.render(record), self.max_message_tokens
+            )
+        return record.memo[key]
+
+    def fit(
+        self, channel: ServiceChannel, engine: OpenAIEngines, budget: Optional[int] = None
+    ) -> list[tuple[MessageRecord, str]]:
+        """The newest messages (and their texts) that fit in `budget` tokens, oldest first.
+
+        The budget defaults to the engine's `log_budget`.
+        """
+        if budget is None:
+            budget = engine.log_budget
+        fitted = []
+        for record in reversed(self.messages(channel)):
+            text, tokens = self.tokenize(record, engine)
+            budget -= tokens + self.message_overhead
+            if budget < 0:
+                break
+            fitted.append((record, text))
+        fitted.reverse()
+        return fitted
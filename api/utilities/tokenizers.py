@@ -1,5 +1,119 @@
-from enum import Enum
-from transformers import GPT2TokenizerFast, GPTNeoXTokenizerFast
+"""
+Tokenizers for the language models, loaded the first time they're used.
 
-gpt2 = GPT2TokenizerFast.from_pretrained("gpt2")
-gpt_neo_x = GPTNeoXTokenizerFast.from_pretrained("EleutherAI/gpt-neox-20b")
+Importing `transformers` and loading a tokenizer takes a while, so it's only done when a
+tokenizer is actually needed. They're read from `tokenizers_dir` and never downloaded
+while the bot is running. They're downloaded when the Docker image is built, and by
+scripts/update-stampy.sh when deploying without Docker, or do it by hand with
+
+    python -m api.utilities.tokenizers
+
+which only downloads the ones that aren't there yet, and fails if it couldn't get them all.
+If they're still missing when the bot starts, the modules that need them are turned off,
+see `tokenizers_available` in api/utilities/openai.py.
+"""
+
+from __future__ import annotations
+
+from functools import lru_cache
+import os
+import sys
+from typing import TYPE_CHECKING, Iterable, Optional
+
+from structlog import get_logger
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizerFast
+
+log = get_logger()
+
+# where the tokenizers are saved. Not in config, as they're downloaded while the Docker image
+# is built, where config can't be imported, having none of its settings (or secrets) yet.
+tokenizers_dir = os.getenv("TOKENIZERS_DIR", "./database/tokenizers")
+
+# tokenizer name -> (transformers class, Hugging Face repo to download it from)
+TOKENIZERS = {
+    "gpt2": ("GPT2TokenizerFast", "gpt2"),
+    # what the chat models (gpt-3.5-turbo and gpt-4) use
+    "cl100k_base": ("GPT2TokenizerFast", "Xenova/gpt-4"),
+}
+
+
+# what to count tokens with when a tokenizer isn't saved. The counts are close enough to fit
+# prompts into their budget, but the token ids are wrong for the engine, so don't send them.
+FALLBACKS = {
+    "cl100k_base": "gpt2",
+}
+
+
+def tokenizer_path(name: str) -> str:
+    return os.path.join(tokenizers_dir, name)
+
+
+def is_saved(name: str) -> bool:
+    return os.path.isdir(tokenizer_path(name))
+
+
+def loadable_as(name: str) -> Optional[str]:
+    """The saved tokenizer that `get_tokenizer(name)` loads: that one, or its fallback, if either"""
+    if is_saved(name):
+        return name
+    fallback = FALLBACKS.get(name)
+    if fallback is not None and is_saved(fallback):
+        return fallback
+    return None
+
+
+def missing_tokenizers(names: Iterable[str]) -> list[str]:
+    """The tokenizers that can't be loaded, not even as their fallback"""
+    return sorted({name for name in names if loadable_as(name) is None})
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(name: str) -> PreTrainedTokenizerFast:
+    import transformers
+
+    class_name, _ = TOKENIZERS[name]
+    saved = loadable_as(name)
+    if saved is None:
+        raise FileNotFoundError(
+            f"No {name} tokenizer in {tokenizers_dir}, run `python -m api.utilities.tokenizers`"
+        )
+    if saved != name:
+        log.warning(
+            "tokenizers",
+            msg=f"No {name} tokenizer in {tokenizers_dir}, counting its tokens with {saved} instead",
+        )
+        class_name, _ = TOKENIZERS[saved]
+    return getattr(transformers, class_name).from_pretrained(tokenizer_path(saved), local_files_only=True)
+
+
+def download_tokenizers() -> list[str]:
+    """Save a copy of every tokenizer that isn't in `tokenizers_dir` yet.
+
+    Returns the ones that are still missing.
+    """
+    missing = missing_tokenizers(TOKENIZERS)
+    if not missing:
+        return []
+    import transformers
+
+    for name in missing:
+        class_name, repo = TOKENIZERS[name]
+        try:
+            tokenizer = getattr(transformers, class_name).from_pretrained(repo)
+        except Exception as e:
+            print(f"Couldn't download the {name} tokenizer from {repo}: {e}")
+            continue
+        if len(tokenizer) < 2:
+            # what some versions of transformers give when they can't reach Hugging Face
+            print(f"Got an empty {name} tokenizer from {repo}, not saving it")
+            continue
+        tokenizer.save_pretrained(tokenizer_path(name))
+        print(f"Saved the {name} tokenizer to {tokenizer_path(name)}")
+    return [name for name in missing if not is_saved(name)]
+
+
+if __name__ == "__main__":
+    if still_missing := download_tokenizers():
+        sys.exit(f"Couldn't get the {', '.join(still_missing)} tokenizers into {tokenizers_dir}")
@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+import asyncio
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 import json
+import threading
 from typing import Optional
 from googleapiclient.discovery import build as get_youtube_api
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 from structlog import get_logger
 
 from config import (
@@ -18,6 +22,16 @@ from utilities import Utilities
 log = get_logger()
 utils = Utilities.get_instance()
 
+# how many pages of comment threads to go through at most, when lots were posted since the last check
+MAX_COMMENT_PAGES = 5
+COMMENTS_PER_PAGE = 100
+
+# how many responses to remember the ETags of
+RESPONSE_CACHE_SIZE = 200
+
+# new comments wait here until their consumers get to them
+COMMENT_QUEUE_SIZE = 500
+
 class YoutubeAPI:
     """Youtube API"""
     __instance: Optional[YoutubeAPI] = None
@@ -53,6 +67,13 @@ class YoutubeAPI:
         # timestamp of last time we asked a youtube question
         self.last_question_asked_timestamp = datetime.now(timezone.utc)
 
+        # recent responses, by request, to ask YouTube if they've changed, see `execute_cached`
+        self.response_cache: OrderedDict[str, dict] = OrderedDict()
+        self.response_cache_lock = threading.Lock()
+
+        # queues of the consumers of new comments, see `subscribe`
+        self.subscribers: list[asyncio.Queue[dict]] = []
+
         # Was the last message posted in #general by anyone, us asking a question from YouTube?
         # We start off not knowing, but it's better to assume yes than no
         self.last_message_was_youtube_question = True
@@ -64,6 +85,7 @@ class YoutubeAPI:
                 developerKey=self.YOUTUBE_API_KEY,
             )
         except HttpError:
+            self.youtube = None
             if self.YOUTUBE_API_KEY:
                 log.info(self.class_name, msg="YouTube API Key is set but not correct")
             else:
@@ -72,7 +94,7 @@ class YoutubeAPI:
     def rate_limit(self, timer_name: str, **kwargs) -> bool:
         """Should I rate-limit? i.e. Has it been less than this length of time since the last time
         this function was called using the same `timer_name`?
-        Used in a function like Module.tick() to make sure it doesn't run too often.
+        Used in a function that runs regularly to make sure it doesn't run too often.
         For example, adding this at the top of a function that checks the youtube API:
 
         if utils.rate_limit("check youtube API", seconds=30):
@@ -99,21 +121,47 @@ class YoutubeAPI:
         return True
 
 
+    @staticmethod
+    def comment_id(comment_url: str) -> str:
+        return comment_url.split("&lc=")[-1].split(".")[0]
+
+    def log_http_error(self, err: HttpError) -> None:
+        if err.resp.get("content-type", "").startswith("application/json"):
+            message = json.loads(err.content).get("error").get("errors")[0].get("message")
+            if message:
+                log.error(self.class_name, error=message)
+                return
+        log.error(self.class_name, error="Unknown Google API Error")
+
+    def execute_cached(self, key: str, request: HttpRequest) -> dict:
+        """`request.execute()`, but if we've made this request (`key`) recently, only get the
+        response again if it has changed. If it hasn't, YouTube says so with a 304 (which costs
+        less quota than the whole response) and the response we have is returned.
+        """
+        with self.response_cache_lock:
+            cached = self.response_cache.get(key)
+        if cached is not None and cached.get("etag"):
+            request.headers["If-None-Match"] = cached["etag"]
+        try:
+            response = request.execute()
+        except HttpError as err:
+            if cached is None or err.resp.status != 304:
+                raise
+            response = cached
+        with self.response_cache_lock:
+            self.response_cache[key] = response
+            self.response_cache.move_to_end(key)
+            while len(self.response_cache) > RESPONSE_CACHE_SIZE:
+                self.response_cache.popitem(last=False)
+        return response
+
     def get_youtube_comment_replies(self, comment_url: str) -> list[dict]:
-        url_arr = comment_url.split("&lc=")
-        reply_id = url_arr[-1].split(".")[0]
+        reply_id = self.comment_id(comment_url)
         request = self.youtube.comments().list(part="snippet", parentId=reply_id)
         try:
-            response = request.execute()
+            response = self.execute_cached(f"replies:{reply_id}", request)
         except HttpError as err:
-            if err.resp.get("content-type", "").startswith("application/json"):
-                message = (
-                    json.loads(err.content).get("error").get("errors")[0].get("message")
-                )
-                if message:
-                    log.error(self.class_name, error=message)
-                    return []
-            log.error(self.class_name, error="Unknown Google API Error")
+            self.log_http_error(err)
             return []
         items: list[dict] = response.get("items", [])
         replies = [self.parse_reply(item) for item in items]
@@ -136,23 +184,14 @@ class YoutubeAPI:
         }
         return reply
         
-
     def get_youtube_comment(self, comment_url):
-        url_arr = comment_url.split("&lc=")
-        video_url = url_arr[0]
-        reply_id = url_arr[-1].split(".")[0]
+        video_url = comment_url.split("&lc=")[0]
+        reply_id = self.comment_id(comment_url)
         request = self.youtube.commentThreads().list(part="snippet", id=reply_id)
         try:
-            response = request.execute()
+            response = self.execute_cached(f"threads:{reply_id}", request)
         except HttpError as err:
-            if err.resp.get("content-type", "").startswith("application/json"):
-                message = (
-                    json.loads(err.content).get("error").get("errors")[0].get("message")
-                )
-                if message:
-                    log.error(self.class_name, error=message)
-                    return
-            log.error(self.class_name, error="Unknown Google API Error")
+            self.log_http_error(err)
             return
         items = response.get("items")
         comment = {"video_url": video_url}
@@ -199,11 +238,8 @@ class YoutubeAPI:
             self.youtube_cooldown = self.youtube_cooldown * 10
             return []
 
-        request = self.youtube.commentThreads().list(
-            part="snippet", allThreadsRelatedToChannelId=rob_miles_youtube_channel_id
-        )
         try:
-            response = request.execute()
+            response = self.fetch_comment_threads()
         except HttpError as err:
             if err.resp.get("content-type", "").startswith("application/json"):
                 message = (
@@ -231,10 +267,7 @@ class YoutubeAPI:
         new_items = []
         for item in items:
             # Find when the comment was published
-            timestamp = item["snippet"]["topLevelComment"]["snippet"]["publishedAt"]
-            # For some reason fromisoformat() doesn't like the trailing 'Z' on timestmaps
-            # And we add the "+00:00" so it knows to use UTC
-            published_timestamp = datetime.fromisoformat(timestamp[:-1] + "+00:00")
+            published_timestamp = self.published_at(item)
 
             # If this comment is newer than the newest one from last time we called API, keep it
             if published_timestamp > self.latest_comment_timestamp:
@@ -273,6 +306,63 @@ class YoutubeAPI:
     
     
     
+    def fetch_comment_threads(self) -> dict:
+        """The latest comment threads on the channel, newest first, as a commentThreads response.
+
+        Follows `nextPageToken` while every thread on the page is newer than the newest one
+        seen so far (so none get missed when lots are posted between checks), for up to
+        MAX_COMMENT_PAGES pages.
+        """
+        items: list[dict] = []
+        page_token = None
+        for _ in range(MAX_COMMENT_PAGES):
+            request = self.youtube.commentThreads().list(
+                part="snippet",
+                allThreadsRelatedToChannelId=rob_miles_youtube_channel_id,
+                maxResults=COMMENTS_PER_PAGE,
+                order="time",
+                pageToken=page_token,
+            )
+            if page_token is None:
+                # usually nothing's changed since the last check
+                response = self.execute_cached("latest threads", request)
+            else:
+                response = request.execute()
+            page = response.get("items", [])
+            items += page
+            page_token = response.get("nextPageToken")
+            if not page_token or not page or self.published_at(page[-1]) <= self.latest_comment_timestamp:
+                break
+        return {**response, "items": items}
+
+    @staticmethod
+    def published_at(item: dict) -> datetime:
+        timestamp = item["snippet"]["topLevelComment"]["snippet"]["publishedAt"]
+        # For some reason fromisoformat() doesn't like the trailing 'Z' on timestmaps
+        # And we add the "+00:00" so it knows to use UTC
+        return datetime.fromisoformat(timestamp[:-1] + "+00:00")
+
+    def subscribe(self) -> asyncio.Queue[dict]:
+        """A queue that gets every new comment `poll_comments` finds. Call it in the event loop."""
+        queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=COMMENT_QUEUE_SIZE)
+        self.subscribers.append(queue)
+        return queue
+
+    async def poll_comments(self) -> None:
+        """Check for new comments, if the cooldown is up, and pass them on to the subscribers.
+
+        The check (and the requests it makes) runs in an executor, so a slow YouTube API
+        doesn't hold up the rest of the bot.
+        """
+        loop = asyncio.get_running_loop()
+        new_comments = await loop.run_in_executor(None, self.check_for_new_youtube_comments)
+        for comment in new_comments or []:
+            for queue in self.subscribers:
+                try:
+                    queue.put_nowait(comment)
+                except asyncio.QueueFull:
+                    log.warning(self.class_name, msg="Dropped a new comment, the queue is full", url=comment["url"])
+
     @staticmethod
     def parse_comment(item: dict) -> dict:
         top_level_comment = item["snippet"]["topLevelComment"]
@@ -0,0 +1,23 @@
+"""Compile the video subtitles into the prebuilt index VideoSearch loads at startup.
+
+Stampy updates the index by himself when the subtitles change, but running this after
+downloading new subtitles keeps the update off the critical path of the next restart.
+Only new or changed subtitle files are parsed, unless you pass `--full`.
+"""
+import sys
+
+from config import subs_dir, video_index_path
+from database.transcripts import TranscriptCorpus
+
+
+def main() -> None:
+    if "--full" in sys.argv:
+        corpus = TranscriptCorpus.build(subs_dir)
+        corpus.save(video_index_path)
+    else:
+        corpus = TranscriptCorpus.load_or_build(subs_dir, video_index_path)
+    print(f"Indexed {len(corpus)} videos into {video_index_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -73,6 +73,10 @@ def getenv_unique_set(var_name: str, default: T = frozenset()) -> Union[frozense
 
 maximum_recursion_depth = 30
 subs_dir = "./database/subs"
+# prebuilt index of everything in subs_dir, see build_video_index.py
+video_index_path = "./database/subs.idx"
+# answers from DuckDuckGo, Wolfram Alpha etc, see database/result_cache.py
+result_cache_path = "./database/result_cache.db"
 youtube_api_service_name = "youtube"
 youtube_api_version = "v3"
 god_id = "0"
@@ -0,0 +1,156 @@
+"""
+A cache of answers from external lookups (DuckDuckGo, Wolfram Alpha, semantic search...)
+
+People ask the same "what is X?" questions over and over, so answers are kept for a while,
+keyed by source and a normalised version of the query. Lookups that found nothing are cached
+too ("negative" entries), usually for less time. Errors (timeouts, outages) aren't cached.
+
+Entries live in memory, so a hit doesn't touch the disk, and are written through to SQLite
+so they survive restarts.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from collections import Counter
+from datetime import timedelta
+import json
+import re
+import time
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+from structlog import get_logger
+
+from config import result_cache_path
+from database.database import Database
+
+log = get_logger()
+
+
+class CacheTTL(NamedTuple):
+    positive: timedelta
+    negative: timedelta
+
+
+# how long answers (and the lack of them) from each source are trusted
+SOURCE_TTLS: dict[str, CacheTTL] = {
+    "duckduckgo": CacheTTL(positive=timedelta(days=7), negative=timedelta(days=1)),
+    # short, because e.g. "what time is it in Tokyo" goes out of date quickly
+    "wolfram": CacheTTL(positive=timedelta(hours=1), negative=timedelta(hours=1)),
+    "semantic": CacheTTL(positive=timedelta(days=1), negative=timedelta(hours=6)),
+    "nlp": CacheTTL(positive=timedelta(days=1), negative=timedelta(hours=6)),
+}
+DEFAULT_TTL = CacheTTL(positive=timedelta(hours=1), negative=timedelta(minutes=10))
+
+# expired entries are cleared out of the database after this many writes
+PRUNE_EVERY = 100
+
+RE_WHITESPACE = re.compile(r"\s+")
+
+
+def normalise_query(query: str) -> str:
+    """Ignore case, spacing and a trailing "?" or ".", so "What is AIXI?" and "what is aixi" match.
+
+    Anything else stays, as "what is 2+2" and "what is 2*2" are different questions.
+    """
+    return RE_WHITESPACE.sub(" ", query.casefold()).strip().rstrip("?.").rstrip()
+
+
+class CachedResult(NamedTuple):
+    # None for a negative entry, i.e. the source had nothing for this query
+    value: Any
+    expires: float
+
+
+class ResultCache:
+    __instance: Optional[ResultCache] = None
+
+    @staticmethod
+    def get_instance() -> ResultCache:
+        if ResultCache.__instance is None:
+            ResultCache.__instance = ResultCache(result_cache_path)
+        return ResultCache.__instance
+
+    def __init__(self, path: str) -> None:
+        self.class_name = self.__class__.__name__
+        self.db = Database(path)
+        self.entries: dict[tuple[str, str], CachedResult] = {}
+        self.hits: Counter[str] = Counter()
+        self.misses: Counter[str] = Counter()
+        self.writes = 0
+        self.load()
+
+    def load(self) -> None:
+        """Create the table if needed, and read every unexpired entry into memory"""
+        now = time.time()
+        self.db.query(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "source TEXT, query TEXT, value TEXT, expires REAL, PRIMARY KEY (source, query))"
+        )
+        self.db.query("DELETE FROM results WHERE expires <= ?", (now,))
+        for source, query, value, expires in self.db.query(
+            "SELECT source, query, value, expires FROM results"
+        ):
+            self.entries[(source, query)] = CachedResult(json.loads(value), expires)
+        log.info(self.class_name, msg=f"Loaded {len(self.entries)} cached lookup results")
+
+    def get(self, source: str, query: str) -> Optional[CachedResult]:
+        """The cached result for this query, if there's one that hasn't expired"""
+        key = (source, normalise_query(query))
+        cached = self.entries.get(key)
+        if cached is not None and cached.expires <= time.time():
+            self.entries.pop(key, None)
+            cached = None
+        if cached is None:
+            self.misses[source] += 1
+        else:
+            self.hits[source] += 1
+        return cached
+
+    def put(self, source: str, query: str, value: Any) -> None:
+        """Remember the result of a lookup. A value of None means nothing was found."""
+        ttl = SOURCE_TTLS.get(source, DEFAULT_TTL)
+        expires = time.time() + (ttl.negative if value is None else ttl.positive).total_seconds()
+        key = (source, normalise_query(query))
+        self.entries[key] = CachedResult(value, expires)
+        self.db.query(
+            "INSERT OR REPLACE INTO results (source, query, value, expires) VALUES (?, ?, ?, ?)",
+            (*key, json.dumps(value), expires),
+        )
+        self.writes += 1
+        if self.writes % PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self) -> None:
+        now = time.time()
+        # puts run in an executor thread, so don't iterate over the live dict
+        for key, cached in list(self.entries.items()):
+            if cached.expires <= now:
+                self.entries.pop(key, None)
+        self.db.query("DELETE FROM results WHERE expires <= ?", (now,))
+
+    async def get_or_fetch(
+        self, source: str, query: str, fetch: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """The cached result for this query, or else the result of awaiting `fetch()`, which is cached.
+
+        `fetch` should return None (or something empty) if the source has no answer, and raise
+        if the lookup failed, so that failures aren't cached.
+        """
+        cached = self.get(source, query)
+        if cached is not None:
+            return cached.value
+        value = await fetch() or None
+        # writing to sqlite blocks, so do it outside the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.put, source, query, value)
+        return value
+
+    def stats(self) -> str:
+        """Hit rates for each source since startup, for the stats command"""
+        lines = [f"Lookup cache: {len(self.entries)} entries"]
+        for source in sorted(self.hits.keys() | self.misses.keys()):
+            hits, misses = self.hits[source], self.misses[source]
+            lines.append(
+                f"{source}: {hits}/{hits + misses} hits ({hits / (hits + misses):.0%})"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,553 @@
+"""
+Positional index over the transcripts of Rob Miles videos, used by the VideoSearch module.
+
+Transcripts are stored in the `timestamp|line` format produced by `process_vtt_file`.
+Every line becomes a cue, and every token remembers which cue it came from, so a match
+can be turned straight into a `youtu.be/<stub>?t=<seconds>` link.
+
+Parsing all the subtitles is slow, so the parsed corpus and its index are compiled into a
+single artifact file (see `build_video_index.py`), which is only rebuilt if the files in the
+subs directory have changed since it was built. The artifact is a small JSON header with the
+video metadata, followed by the index arrays as raw uint32s and then the transcript texts.
+At startup the artifact is memory-mapped: the index arrays are bulk copied out of it, without
+any unpickling, and the texts stay in the mapping until they're asked for.
+"""
+
+from __future__ import annotations
+
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import repeat
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from typing import Iterable, Iterator, NamedTuple, Optional, Union
+
+from structlog import get_logger
+
+log = get_logger()
+
+# bump this whenever the artifact layout or the parsing/indexing changes
+ARTIFACT_VERSION = 3
+ARTIFACT_MAGIC = b"STAMPYVI"
+# magic, version, length of the JSON header
+ARTIFACT_PREAMBLE = struct.Struct("<8sIQ")
+# the index arrays are stored as little-endian uint32s, whatever the platform
+UINT32_SIZE = 4
+
+RE_VTT_TAG = re.compile(r"<[^>]*>")
+RE_VTT_FILENAME = re.compile(r"^(.+?)-([a-zA-Z0-9\-_]{11})\.en(-GB)?\.vtt$")
+RE_TOKEN = re.compile(r"[a-z0-9]+(?:'[a-z0-9]+)*")
+RE_PHRASE = re.compile(r"\"([^\"]+)\"")
+
+# below this many files to parse, starting worker processes costs more than it saves
+PARALLEL_INGEST_MIN_FILES = 8
+
+# query terms closer together than this many tokens count as "near" each other
+PROXIMITY_WINDOW = 30
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase the text and split it into word tokens"""
+    return RE_TOKEN.findall(text.lower())
+
+
+def extract_phrases(query: str) -> list[list[str]]:
+    """Find the "quoted strings" in a query, tokenized"""
+    phrases = [tokenize(phrase) for phrase in RE_PHRASE.findall(query)]
+    return [phrase for phrase in phrases if phrase]
+
+
+def parse_timestamp(timestamp: str) -> int:
+    """Convert a transcript timestamp like `10:17` or `1:02:03` into seconds"""
+    seconds = 0
+    for part in timestamp.split(":"):
+        try:
+            seconds = seconds * 60 + int(part or 0)
+        except ValueError:
+            return 0
+    return seconds
+
+
+def iter_vtt_cues(vtt_lines: Iterable[str]) -> Iterator[str]:
+    """Stream the spoken lines out of a .vtt subtitle file as `timestamp|line` rows.
+
+    Only lines with inline word timings are spoken lines, the rest are cue headers
+    or repeats of the previous line.
+    """
+    for line in vtt_lines:
+        # cheap check first, most lines have no tags at all
+        if "<" not in line:
+            continue
+        regex_matches = RE_VTT_TAG.search(line)
+        if regex_matches:
+            # the timestamp for the start of the line
+            timestamp = regex_matches.group(0)
+
+            # remove the brackets, leading zeros, and milliseconds
+            # 00:10:17.630 becomes 10:17
+            timestamp = timestamp.lstrip("0<>").lstrip(":").partition(".")[0]
+
+            # strip out all the html tags from the line
+            pline = RE_VTT_TAG.sub("", line.strip())
+            yield timestamp + "|" + pline
+
+
+def process_vtt_file(vtt_file_name: str) -> str:
+    """Strip a .vtt subtitle file down to one `timestamp|line` row per spoken line"""
+    with open(vtt_file_name) as vtt_file:
+        return "\n".join(iter_vtt_cues(vtt_file))
+
+
+class TranscriptPart(NamedTuple):
+    """The index of a single transcript, before it's merged into a TranscriptIndex"""
+
+    # token -> positions of the token in the transcript
+    postings: dict[str, array]
+    # cue number of each token position
+    token_cues: array
+    # start time of each cue, in seconds
+    cue_seconds: array
+    # length of the transcript text
+    length: int
+
+
+def index_transcript(text: str) -> TranscriptPart:
+    """Index a transcript in `timestamp|line` format"""
+    postings: dict[str, array] = {}
+    token_cues = array("I")
+    cue_seconds = array("I")
+    for line in text.splitlines():
+        timestamp, _, line_text = line.partition("|")
+        cue = len(cue_seconds)
+        cue_seconds.append(parse_timestamp(timestamp))
+        for token in tokenize(line_text):
+            postings.setdefault(token, array("I")).append(len(token_cues))
+            token_cues.append(cue)
+    return TranscriptPart(postings, token_cues, cue_seconds, len(text))
+
+
+@dataclass
+class TranscriptMatch:
+    """How well one transcript matches a query, and where the best match is"""
+
+    doc_id: int
+    score: float
+    seconds: Optional[int] = None
+
+
+class TranscriptIndex:
+    """Inverted index mapping each token to its positions in every transcript.
+
+    Positions are token offsets within a transcript. `token_cues` maps a position to
+    the cue (line) it came from and `cue_seconds` maps a cue to its start time.
+    """
+
+    def __init__(self) -> None:
+        # token -> {doc_id: positions of the token in that transcript}
+        self.postings: dict[str, dict[int, array]] = defaultdict(dict)
+        # doc_id -> cue number of each token position
+        self.token_cues: list[array] = []
+        # doc_id -> start time of each cue, in seconds
+        self.cue_seconds: list[array] = []
+        # doc_id -> length of the transcript text, to normalise scores the same way as titles
+        self.lengths: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, text: str) -> int:
+        """Index a transcript in `timestamp|line` format, returning its doc_id"""
+        return self.add_part(index_transcript(text))
+
+    def add_part(self, part: TranscriptPart) -> int:
+        """Merge an already indexed transcript into the index, returning its doc_id"""
+        doc_id = len(self.lengths)
+        for token, positions in part.postings.items():
+            self.postings[token][doc_id] = positions
+        self.token_cues.append(part.token_cues)
+        self.cue_seconds.append(part.cue_seconds)
+        self.lengths.append(part.length)
+        return doc_id
+
+    def seconds_at(self, doc_id: int, position: int) -> int:
+        """Start time of the cue containing the token at `position`"""
+        return self.cue_seconds[doc_id][self.token_cues[doc_id][position]]
+
+    def phrase_starts(self, doc_id: int, phrase: list[str]) -> list[int]:
+        """Positions in the transcript where the whole phrase starts"""
+        first = self.postings.get(phrase[0], {}).get(doc_id)
+        if not first:
+            return []
+        rest = []
+        for token in phrase[1:]:
+            positions = self.postings.get(token, {}).get(doc_id)
+            if not positions:
+                return []
+            rest.append(set(positions))
+        return [
+            start
+            for start in first
+            if all(start + offset in positions for offset, positions in enumerate(rest, 1))
+        ]
+
+    @staticmethod
+    def best_window(hits: list[tuple[int, int]]) -> tuple[int, int]:
+        """Find the window of PROXIMITY_WINDOW tokens containing the most distinct query parts.
+
+        `hits` is a sorted list of (position, query part) pairs.
+        Returns the number of distinct parts in the best window, and its first position.
+        """
+        best_count, best_start = 0, hits[0][0]
+        counts: dict[int, int] = defaultdict(int)
+        left = 0
+        for position, part in hits:
+            counts[part] += 1
+            while hits[left][0] < position - PROXIMITY_WINDOW:
+                left_part = hits[left][1]
+                counts[left_part] -= 1
+                if not counts[left_part]:
+                    del counts[left_part]
+                left += 1
+            if len(counts) > best_count:
+                best_count, best_start = len(counts), hits[left][0]
+        return best_count, best_start
+
+    def search(self, terms: list[str], phrases: list[list[str]]) -> dict[int, TranscriptMatch]:
+        """Score every transcript that contains any of the terms or phrases.
+
+        Phrases only count where all their tokens appear consecutively, and are worth
+        as much as all of their tokens together. Transcripts where different query parts
+        occur close together get a proximity bonus, and the best such spot is the one linked to.
+        """
+        parts: list[list[str]] = [[term] for term in dict.fromkeys(terms)] + phrases
+        if not parts:
+            return {}
+
+        candidates = set()
+        for part in parts:
+            candidates.update(self.postings.get(part[0], {}))
+
+        matches = {}
+        for doc_id in candidates:
+            hits = []
+            score = 0.0
+            for part_number, part in enumerate(parts):
+                if len(part) == 1:
+                    starts = self.postings.get(part[0], {}).get(doc_id, ())
+                else:
+                    starts = self.phrase_starts(doc_id, part)
+                score += len(starts) * len(part)
+                hits.extend((start, part_number) for start in starts)
+            if not hits:
+                continue
+
+            hits.sort()
+            near_count, best_position = self.best_window(hits)
+            if len(parts) > 1:
+                score *= 1 + (near_count - 1) / len(parts)
+
+            matches[doc_id] = TranscriptMatch(
+                doc_id=doc_id,
+                score=score / (self.lengths[doc_id] + 1),
+                seconds=self.seconds_at(doc_id, best_position),
+            )
+        return matches
+
+
+class VideoRecord(NamedTuple):
+    """Everything we know about one video, as stored in the artifact"""
+
+    title: str
+    stub: str
+    description: str
+    # the files this record was built from, with their fingerprints (None if missing)
+    sources: tuple[tuple[str, Optional[tuple[int, int]]], ...]
+    # where the transcript text is in the artifact's text blob, in bytes
+    text_offset: int
+    text_length: int
+    part: TranscriptPart
+
+
+class IngestedVideo(NamedTuple):
+    """A freshly parsed video, as sent back from an ingestion worker process"""
+
+    title: str
+    stub: str
+    description: str
+    text: bytes
+    part: TranscriptPart
+
+
+def subs_fingerprint(subs_dir: str) -> dict[str, tuple[int, int]]:
+    """Modification time and size of every file the corpus is built from, by file name"""
+    fingerprint = {}
+    with os.scandir(subs_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith((".en.vtt", ".description")):
+                stat = entry.stat()
+                fingerprint[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return fingerprint
+
+
+def description_filename(title: str, stub: str) -> str:
+    return title + "-" + stub + ".description"
+
+
+def ingest_video(subs_dir: str, vtt_name: str) -> IngestedVideo:
+    """Parse and index one video's subtitles and description.
+
+    This runs in a worker process, so it only takes and returns picklable things.
+    """
+    vtt_groups = RE_VTT_FILENAME.match(vtt_name)
+    title = vtt_groups.group(1)
+    stub = vtt_groups.group(2)
+
+    text = process_vtt_file(os.path.join(subs_dir, vtt_name))
+
+    description_filepath = os.path.join(subs_dir, description_filename(title, stub))
+    if os.path.exists(description_filepath):
+        with open(description_filepath, encoding="utf8") as description_file:
+            description = description_file.read()
+    else:
+        description = ""
+
+    return IngestedVideo(title, stub, description, text.encode("utf-8"), index_transcript(text))
+
+
+def uint32_bytes(values: array) -> bytes:
+    """The values as they're stored in the artifact"""
+    if sys.byteorder == "little":
+        return values.tobytes()
+    swapped = array("I", values)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def uint32_array(view: memoryview, start: int, count: int) -> array:
+    """Copy `count` values stored by `uint32_bytes` out of the artifact"""
+    end = start + count * UINT32_SIZE
+    if end > len(view):
+        raise ValueError("index arrays run past the end of the artifact")
+    values = array("I")
+    values.frombytes(view[start:end])
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+class TranscriptCorpus:
+    """The titles, descriptions and transcripts of all the videos, plus the transcript index.
+
+    Transcript texts aren't needed for searching, so they stay in the artifact's
+    memory-mapped text blob and are only decoded when asked for.
+    """
+
+    def __init__(
+        self,
+        records: list[VideoRecord],
+        texts: Union[bytes, mmap.mmap],
+        fingerprint: dict[str, tuple[int, int]],
+        text_base: int = 0,
+    ) -> None:
+        self.records = records
+        self.texts = texts
+        # where the text blob starts in `texts`
+        self.text_base = text_base
+        self.fingerprint = fingerprint
+        self.index = TranscriptIndex()
+        for record in records:
+            self.index.add_part(record.part)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def text_bytes(self, doc_id: int) -> bytes:
+        record = self.records[doc_id]
+        start = self.text_base + record.text_offset
+        return self.texts[start : start + record.text_length]
+
+    def text(self, doc_id: int) -> str:
+        return self.text_bytes(doc_id).decode("utf-8")
+
+    @classmethod
+    def build(
+        cls,
+        subs_dir: str,
+        previous: Optional[TranscriptCorpus] = None,
+        max_workers: Optional[int] = None,
+    ) -> TranscriptCorpus:
+        """Parse and index the transcripts in the subs directory.
+
+        Videos whose files haven't changed since `previous` was built are reused from it,
+        and the rest are parsed in parallel, one file per task, then merged in.
+        """
+        fingerprint = subs_fingerprint(subs_dir)
+
+        reusable: dict[str, tuple[VideoRecord, bytes]] = {}
+        if previous is not None:
+            for doc_id, record in enumerate(previous.records):
+                if all(fingerprint.get(name) == stat for name, stat in record.sources):
+                    reusable[record.sources[0][0]] = (record, previous.text_bytes(doc_id))
+
+        vtt_names = sorted(name for name in fingerprint if RE_VTT_FILENAME.match(name))
+        to_ingest = [name for name in vtt_names if name not in reusable]
+        log.info(
+            "TranscriptCorpus",
+            msg=f"Ingesting {len(to_ingest)} videos, reusing {len(vtt_names) - len(to_ingest)}",
+        )
+        ingested: dict[str, IngestedVideo] = {}
+        if len(to_ingest) >= PARALLEL_INGEST_MIN_FILES:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                videos = pool.map(ingest_video, repeat(subs_dir), to_ingest)
+                ingested = dict(zip(to_ingest, videos))
+        else:
+            for name in to_ingest:
+                ingested[name] = ingest_video(subs_dir, name)
+
+        records = []
+        texts = bytearray()
+        for name in vtt_names:
+            if name in reusable:
+                record, text = reusable[name]
+                records.append(record._replace(text_offset=len(texts)))
+            else:
+                video = ingested[name]
+                text = video.text
+                description_name = description_filename(video.title, video.stub)
+                sources = (
+                    (name, fingerprint[name]),
+                    (description_name, fingerprint.get(description_name)),
+                )
+                records.append(
+                    VideoRecord(
+                        video.title,
+                        video.stub,
+                        video.description,
+                        sources,
+                        len(texts),
+                        len(text),
+                        video.part,
+                    )
+                )
+            texts += text
+        return cls(records, bytes(texts), fingerprint)
+
+    def save(self, path: str) -> None:
+        """Write the corpus out as an artifact file, atomically replacing any old one"""
+        videos = []
+        arrays = bytearray()
+        for record in self.records:
+            part = record.part
+            videos.append(
+                {
+                    "title": record.title,
+                    "stub": record.stub,
+                    "description": record.description,
+                    "sources": record.sources,
+                    "text_offset": record.text_offset,
+                    "text_length": record.text_length,
+                    "length": part.length,
+                    "arrays_offset": len(arrays),
+                    "cues": len(part.cue_seconds),
+                    "tokens": list(part.postings),
+                    "counts": [len(positions) for positions in part.postings.values()],
+                }
+            )
+            for values in [part.token_cues, part.cue_seconds, *part.postings.values()]:
+                arrays += uint32_bytes(values)
+        header = json.dumps(
+            {"fingerprint": self.fingerprint, "arrays_length": len(arrays), "videos": videos}
+        ).encode("utf-8")
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as artifact:
+            artifact.write(ARTIFACT_PREAMBLE.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, len(header)))
+            artifact.write(header)
+            artifact.write(arrays)
+            artifact.write(self.texts[self.text_base :])
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> TranscriptCorpus:
+        """Memory-map an artifact file. Raises ValueError if it's not a current artifact"""
+        with open(path, "rb") as artifact:
+            texts = mmap.mmap(artifact.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, header_length = ARTIFACT_PREAMBLE.unpack_from(texts)
+            if magic != ARTIFACT_MAGIC or version != ARTIFACT_VERSION:
+                raise ValueError(f"{path} is not a version {ARTIFACT_VERSION} video index")
+            arrays_base = ARTIFACT_PREAMBLE.size + header_length
+            header = json.loads(texts[ARTIFACT_PREAMBLE.size : arrays_base])
+            text_base = arrays_base + header["arrays_length"]
+            if text_base > len(texts):
+                raise ValueError(f"{path} is truncated")
+            fingerprint = {name: tuple(stat) for name, stat in header["fingerprint"].items()}
+            with memoryview(texts) as view:
+                records = [
+                    cls.load_record(view, arrays_base, video) for video in header["videos"]
+                ]
+        except (KeyError, TypeError) as e:
+            texts.close()
+            raise ValueError(f"{path} has a malformed header") from e
+        except (ValueError, struct.error):
+            texts.close()
+            raise
+        return cls(records, texts, fingerprint, text_base=text_base)
+
+    @staticmethod
+    def load_record(view: memoryview, arrays_base: int, video: dict) -> VideoRecord:
+        """Rebuild a video's record from its header entry and its arrays in the artifact"""
+        token_count = sum(video["counts"])
+        start = arrays_base + video["arrays_offset"]
+        token_cues = uint32_array(view, start, token_count)
+        start += token_count * UINT32_SIZE
+        cue_seconds = uint32_array(view, start, video["cues"])
+        start += video["cues"] * UINT32_SIZE
+        all_positions = uint32_array(view, start, token_count)
+
+        postings = {}
+        position = 0
+        for token, count in zip(video["tokens"], video["counts"]):
+            postings[token] = all_positions[position : position + count]
+            position += count
+
+        sources = tuple(
+            (name, None if stat is None else tuple(stat)) for name, stat in video["sources"]
+        )
+        return VideoRecord(
+            video["title"],
+            video["stub"],
+            video["description"],
+            sources,
+            video["text_offset"],
+            video["text_length"],
+            TranscriptPart(postings, token_cues, cue_seconds, video["length"]),
+        )
+
+    @classmethod
+    def load_or_build(cls, subs_dir: str, path: str) -> TranscriptCorpus:
+        """Load the artifact if it's up to date with the subs directory, otherwise update it.
+
+        Only the videos whose files were added or changed get parsed again.
+        """
+        previous = None
+        try:
+            previous = cls.load(path)
+            if previous.fingerprint == subs_fingerprint(subs_dir):
+                return previous
+            log.info("TranscriptCorpus", msg=f"{subs_dir} has changed, updating {path}")
+        except (OSError, ValueError, struct.error) as e:
+            log.info("TranscriptCorpus", msg=f"Couldn't load {path}, rebuilding it", error=e)
+
+        corpus = cls.build(subs_dir, previous=previous)
+        try:
+            corpus.save(path)
+        except OSError as e:
+            log.warning("TranscriptCorpus", msg=f"Couldn't save {path}", error=e)
+        return corpus
@@ -3,14 +3,21 @@ Searches a database of AI-alignment-related documents for something like your qu
 """
 
 from __future__ import annotations
+import asyncio
+import json
+import os
 import re
-from dataclasses import dataclass
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
 import zipfile
-import requests
+import aiohttp
+import numpy as np
 from io import BytesIO
 from lxml import etree
 from structlog import get_logger
 from modules.module import Module, Response
+from utilities.http_utils import HttpClient
 from utilities.serviceutils import ServiceMessage
 
 # this is the URL to Alignment Newsletter's google sheets database.
@@ -22,16 +29,35 @@ HIGHLIGHT_WEIGHT = 1.5
 # maximum number of items to return in the response
 MAX_NUM_ITEMS = 5
 
+# how long a downloaded copy of the database is used before refreshing it in the background
+CACHE_TTL = timedelta(hours=12)
+
+# how long to wait before trying again, if refreshing the database failed
+CACHE_RETRY_INTERVAL = timedelta(minutes=10)
+
+# where the parsed database is kept between restarts
+CACHE_PATH = "./database/alignment_newsletter.json"
+
+# how long to wait for google sheets before giving up
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+# how much a keyword counts for, depending on which field of the item it's found in
+FIELD_WEIGHTS = {"title": 3.0, "authors": 2.0, "summary": 1.0, "opinion": 0.5}
+
+# regex for splitting text into search terms
+RE_TERM = re.compile(r"[a-z0-9]+")
+
 # regex for pulling the first markdown link, with its title and url.
-RE_MARKDOWN_LINK = re.compile(rb"""\[(?P<title>[^\]]+)\]\((?P<url>[^\)]+)\)""")
+RE_MARKDOWN_LINK = re.compile(r"""\[(?P<title>[^\]]+)\]\((?P<url>[^\)]+)\)""")
 
 
-@dataclass
-class Item:
+class Item(NamedTuple):
     """Class to hold a single row from the google sheets database.
 
     Most of the attributes are just the columns from the database.
     self.score will show much the item matches a query.
+    It's a tuple so that the few thousand rows of the database stay small in memory,
+    use `item._replace(score=...)` to get a scored copy.
     """
 
     category: str
@@ -49,8 +75,8 @@ class Item:
 
         Parameters
         ----------
-        row : some kind of lxml etree object
-            see AlignmentNewsletterSearch.load_items() for where row comes from
+        row : lxml <tr> element
+            see AlignmentNewsletterSearch.parse_items() for where row comes from
 
         Returns
         -------
@@ -59,6 +85,8 @@ class Item:
             If the row is invalid, return None.
         """
         # TODO - Any kind of error checking and handling
+        if len(row) < 11:
+            return None
 
         # column 1 is the category
         category = row[1].text or ""
@@ -68,7 +96,7 @@ class Item:
 
         # column 3 is the title, which is also a link to the paper/post
         # so we fill 2 fields from this 1 column
-        title_field_text = etree.tostring(row[3], method="text", encoding="UTF-8")
+        title_field_text = cell_text(row[3])
         if not title_field_text:
             return None
 
@@ -76,28 +104,19 @@ class Item:
         atag = row[3].find(".//a")
         if atag is not None:
             title = atag.text or ""
-            url = atag.attrib["href"] or ""
+            url = atag.get("href") or ""
         else:
             # no A tag, maybe a markdown link?
             match_object = RE_MARKDOWN_LINK.match(title_field_text)
             if match_object:
-                title = match_object["title"].decode("utf-8") or ""
-                url = match_object["url"].decode("utf-8") or ""
+                title = match_object["title"]
+                url = match_object["url"]
             else:
                 return None
 
-        authors = (
-            etree.tostring(row[4], method="text", encoding="UTF-8").decode("utf-8")
-            or ""
-        )
-        summary = (
-            etree.tostring(row[9], method="text", encoding="UTF-8").decode("utf-8")
-            or ""
-        )
-        opinion = (
-            etree.tostring(row[10], method="text", encoding="UTF-8").decode("utf-8")
-            or ""
-        )
+        authors = cell_text(row[4])
+        summary = cell_text(row[9])
+        opinion = cell_text(row[10])
         return cls(category, is_highlight, url, title, authors, summary, opinion)
 
     def __repr__(self):
@@ -107,11 +126,106 @@ class Item:
         return self.__repr__()
 
 
+def cell_text(cell) -> str:
+    """All the text in a table cell, including that of any nested tags"""
+    return "".join(cell.itertext())
+
+
+class NewsletterIndex:
+    """Sparse TF-IDF term-document matrix over the searchable fields of the items.
+
+    The matrix is stored column by column, like a CSC matrix: the documents containing
+    term `t` are `doc_ids[indptr[t]:indptr[t + 1]]`, with their weights at the same
+    positions in `weights`. Scoring a query only touches the columns of its own terms.
+    It's built once whenever the items are (re)loaded.
+    """
+
+    def __init__(self, items: list[Item]) -> None:
+        self.items = items
+
+        rows: dict[str, list[tuple[int, float]]] = {}
+        doc_norms = np.zeros(len(items))
+        for doc_id, item in enumerate(items):
+            counts: Counter[str] = Counter()
+            for field, field_weight in FIELD_WEIGHTS.items():
+                for term in RE_TERM.findall(getattr(item, field).lower()):
+                    counts[term] += field_weight
+            for term, count in counts.items():
+                rows.setdefault(term, []).append((doc_id, 1 + np.log(count)))
+
+        self.vocabulary = {term: term_id for term_id, term in enumerate(rows)}
+        self.indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        self.doc_ids = np.empty(sum(len(postings) for postings in rows.values()), dtype=np.int64)
+        self.weights = np.empty(len(self.doc_ids))
+
+        for term_id, postings in enumerate(rows.values()):
+            start = self.indptr[term_id]
+            end = start + len(postings)
+            self.indptr[term_id + 1] = end
+            idf = np.log((len(items) + 1) / (len(postings) + 1)) + 1
+            self.doc_ids[start:end] = [doc_id for doc_id, _ in postings]
+            self.weights[start:end] = [tf * idf for _, tf in postings]
+
+        # normalise every document vector to unit length, so long summaries don't win by default
+        np.add.at(doc_norms, self.doc_ids, self.weights**2)
+        self.weights /= np.sqrt(doc_norms[self.doc_ids])
+
+        self.highlight_boost = np.array(
+            [HIGHLIGHT_WEIGHT if item.is_highlight else 1.0 for item in items]
+        )
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def scores(self, keywords: list[str]) -> np.ndarray:
+        """Relevance of every item to the keywords, as one sparse matrix-vector product"""
+        scores = np.zeros(len(self.items))
+        for term, count in Counter(
+            term for keyword in keywords for term in RE_TERM.findall(keyword)
+        ).items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            # doc_ids are unique within a column, so plain fancy indexing is safe here
+            scores[self.doc_ids[start:end]] += count * self.weights[start:end]
+        return scores * self.highlight_boost
+
+    def top_items(self, keywords: list[str], limit: int) -> list[Item]:
+        """The `limit` best scoring items with a non-zero score, best first.
+
+        The returned items are copies with their `score` filled in.
+        """
+        scores = self.scores(keywords)
+        limit = min(limit, np.count_nonzero(scores))
+        if not limit:
+            return []
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best])]
+        return [self.items[i]._replace(score=float(scores[i])) for i in best]
+
+
 class AlignmentNewsletterSearch(Module):
     """
     A module that searches the Alignment Newsletter database for relevant papers/articles etc.
+
+    The parsed database is cached in memory and on disk. Once it's older than CACHE_TTL,
+    the next search still uses it but kicks off a refresh in the background. Refreshes use
+    conditional requests, so an unchanged spreadsheet isn't downloaded again, and if
+    google sheets is down we carry on serving the copy we have.
     """
 
+    def __init__(self):
+        super().__init__()
+        self.index = NewsletterIndex([])
+        # validators from the last download, sent back to google to ask if anything changed
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.fetched_at: Optional[datetime] = None
+        self.next_refresh_at = datetime.now(timezone.utc)
+        self.refresh_task: Optional[asyncio.Task] = None
+        self.load_cache()
+
     def process_message(self, message: ServiceMessage) -> Response:
         """Process a message and return a response if this module can handle it."""
         text = self.is_at_me(message)
@@ -157,16 +271,22 @@ class AlignmentNewsletterSearch(Module):
     async def process_search_request(self, query) -> Response:
         """Search for relevant items for the query.
 
-        First we load all items from the Alignment Newsletter database.
-        Then we sort the items by relevance to the query.
+        First we get the index of the Alignment Newsletter database.
+        Then we find the items most relevant to the query.
         Finally we return the most relevant items, if any.
         """
         self.log.info(self.class_name, newsletter_query=query)
 
-        items = self.load_items()
-        items_sorted = self.sort_by_relevance(items, query, reverse=True)
+        index = await self.get_index()
+        if not index:
+            return Response(
+                confidence=8,
+                text="I can't reach the Alignment Newsletter Database right now, try again later",
+                why="I couldn't download the Alignment Newsletter Database",
+            )
+        items_sorted = self.sort_by_relevance(index, query)
 
-        self.log.info(self.class_name, search_results=items_sorted[:MAX_NUM_ITEMS])
+        self.log.info(self.class_name, search_results=items_sorted)
 
         most_relevant_items = self.get_most_relevant_items(items_sorted)
 
@@ -184,42 +304,146 @@ class AlignmentNewsletterSearch(Module):
                 why="I couldn't find anything relevant in the Alignment Newsletter",
             )
 
-    def load_items(self) -> list[Item]:
+    def is_stale(self) -> bool:
+        return datetime.now(timezone.utc) >= self.next_refresh_at
+
+    @property
+    def items(self) -> list[Item]:
+        return self.index.items
+
+    async def get_index(self) -> NewsletterIndex:
+        """Get the index of the cached items, refreshing them in the background if they're stale.
+
+        We only wait for the download if we have nothing at all to search yet. If the last
+        attempt failed, we don't try again until CACHE_RETRY_INTERVAL is up, even then.
         """
-        Loads and parses the google sheets database into a list of Item objects.
+        refresh_running = self.refresh_task is not None and not self.refresh_task.done()
+        if not refresh_running and self.is_stale():
+            self.refresh_task = asyncio.create_task(self.refresh())
+            refresh_running = True
+        if not self.items and refresh_running:
+            # shield, so the refresh survives this search being cancelled
+            await asyncio.shield(self.refresh_task)
+        return self.index
+
+    async def refresh(self) -> None:
+        """Bring the cached items up to date, keeping the old ones if that fails"""
+        try:
+            await self.fetch_items()
+            self.next_refresh_at = datetime.now(timezone.utc) + CACHE_TTL
+        except Exception as e:
+            self.log.error(
+                self.class_name,
+                msg="Couldn't refresh the Alignment Newsletter Database, keeping the cached copy",
+                error=e,
+            )
+            self.next_refresh_at = datetime.now(timezone.utc) + CACHE_RETRY_INTERVAL
+
+    async def fetch_items(self) -> None:
+        """Download the database if it has changed since we last fetched it, and cache it"""
+        headers = {}
+        if self.items:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+
+        request = HttpClient.get_instance().request(
+            "GET", SPREADSHEET_URL, headers=headers, timeout=DOWNLOAD_TIMEOUT
+        )
+        async with request as response:
+            if response.status == 304:
+                self.log.info(self.class_name, msg="Alignment Newsletter Database hasn't changed")
+                zipped_html = None
+            else:
+                zipped_html = await response.read()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+
+        loop = asyncio.get_running_loop()
+        if zipped_html is not None:
+            # parsing and indexing take a while, so keep them out of the event loop
+            self.index = await loop.run_in_executor(None, self.build_index, zipped_html)
+            self.etag = etag
+            self.last_modified = last_modified
+            self.log.info(self.class_name, msg=f"Downloaded {len(self.items)} newsletter items")
+
+        self.fetched_at = datetime.now(timezone.utc)
+        await loop.run_in_executor(None, self.save_cache)
+
+    def load_cache(self) -> None:
+        """Load the items saved by a previous run, if there are any"""
+        try:
+            with open(CACHE_PATH, encoding="utf-8") as cache_file:
+                cache = json.load(cache_file)
+            self.index = NewsletterIndex([Item(**item) for item in cache["items"]])
+            self.etag = cache.get("etag")
+            self.last_modified = cache.get("last_modified")
+            self.fetched_at = datetime.fromisoformat(cache["fetched_at"])
+            self.next_refresh_at = self.fetched_at + CACHE_TTL
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.log.warning(self.class_name, msg=f"Ignoring broken cache at {CACHE_PATH}", error=e)
+
+    def save_cache(self) -> None:
+        cache = {
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "fetched_at": self.fetched_at.isoformat() if self.fetched_at else None,
+            "items": [item._asdict() for item in self.items],
+        }
+        try:
+            tmp_path = CACHE_PATH + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(tmp_path, CACHE_PATH)
+        except OSError as e:
+            self.log.warning(self.class_name, msg=f"Couldn't save cache to {CACHE_PATH}", error=e)
+
+    async def load_items(self) -> list[Item]:
+        """Download and parse the google sheets database, bypassing the cache"""
+        async with HttpClient.get_instance().request(
+            "GET", SPREADSHEET_URL, timeout=DOWNLOAD_TIMEOUT
+        ) as response:
+            return self.parse_items(await response.read())
+
+    @classmethod
+    def build_index(cls, zipped_html: bytes) -> NewsletterIndex:
+        return NewsletterIndex(cls.parse_items(zipped_html))
+
+    @staticmethod
+    def parse_items(zipped_html: bytes) -> list[Item]:
+        """
+        Parses the google sheets database into a list of Item objects.
 
         The database is a google sheets spreadsheet, which can be exported as a zip file.
         The zip file contains a single html file, which contains the table of data.
-        We then extract the table from the html.
-        Finally, we parse the table one row at a time into a list of Item objects.
+        We stream the html straight out of the zip file and parse the table one row
+        at a time into a list of Item objects, throwing each row away once it's parsed,
+        so the whole document is never held in memory at once.
 
         Returns
         --------------
         items : list[Item]
             Each item is a parsed row from the google sheets database.
         """
-        # download the sheet as zipped html from the google sheets API.
-        response = requests.get(SPREADSHEET_URL)
-
-        # we have to use BytesIO to unzip in memory
-        bytes = BytesIO(response.content)
-        zip_file = zipfile.ZipFile(bytes)
-        with zip_file.open("Database.html") as html_file:
-            # pull out the main body of the table
-            html_data = html_file.read().decode("utf-8")
-            table = etree.HTML(html_data).find("body/div/table/tbody")
-
-        rows = iter(table)
-
-        # first two rows are headers and freeze bar, chuck them out
-        headers = next(rows)
-        bar = next(rows)
-
         items: list[Item] = []
-        for row in rows:
-            item = Item.parse(row)
-            if item is not None:
-                items.append(item)
+        with zipfile.ZipFile(BytesIO(zipped_html)) as zip_file, zip_file.open(
+            "Database.html"
+        ) as html_file:
+            # stream the html, handing over each row of the table as soon as it's been read
+            rows = etree.iterparse(html_file, events=("end",), tag="tr", html=True)
+            for row_number, (_, row) in enumerate(rows):
+                # first two rows are headers and freeze bar, chuck them out
+                if row_number >= 2:
+                    item = Item.parse(row)
+                    if item is not None:
+                        items.append(item)
+                # free the row, and the already parsed ones still hanging off the table
+                row.clear()
+                while row.getprevious() is not None:
+                    del row.getparent()[0]
 
         return items
 
@@ -242,44 +466,27 @@ class AlignmentNewsletterSearch(Module):
         keywords = [w.strip("\"'?.,!") for w in keywords if w not in boring_words]
         return keywords
 
-    def sort_by_relevance(
-        self, items: list[Item], query: str, reverse: bool = False
-    ) -> list[Item]:
-        """Sort items by calculating how relevant each item is to the query.
+    def sort_by_relevance(self, index: NewsletterIndex, query: str) -> list[Item]:
+        """Find the items most relevant to the query.
 
         Parameters
         ----------
-        items : list[Item]
-            The list of items to sort.
+        index : NewsletterIndex
+            The index of the items to search.
         query : str
             The query from user.
-        reverse : bool, optional
-            Whether to sort in descending order, by default False
 
         Returns
         -------
         list[Item]
-            The sorted list of items, with relevance scores stored
-            in the `score` attribute of each item.
+            At most MAX_NUM_ITEMS items, most relevant first, with relevance scores
+            stored in the `score` attribute of each item.
         """
         # TODO: Semantic search or something else less brain dead
         keywords = self.extract_keywords(query)
         self.log.info(self.class_name, keywords=keywords)
 
-        for item in items:
-            for keyword in keywords:
-                item.score += item.title.lower().count(keyword) / (len(item.title) + 1)
-                item.score += item.authors.lower().count(keyword) / (
-                    len(item.authors) + 1
-                )
-                item.score += item.summary.lower().count(keyword) / (
-                    len(item.summary) + 1
-                )
-
-            if item.is_highlight:
-                item.score *= HIGHLIGHT_WEIGHT
-
-        return sorted(items, key=(lambda item: item.score), reverse=reverse)
+        return index.top_items(keywords, MAX_NUM_ITEMS)
 
     def get_most_relevant_items(self, items_sorted: list[Item]) -> list[Item]:
         """Get the most relevant items.
@@ -295,6 +502,8 @@ class AlignmentNewsletterSearch(Module):
             At most MAX_NUM_ITEMS items will be returned.
             If none of the items are relevant, an empty list is returned.
         """
+        if not items_sorted:
+            return []
         best_score = items_sorted[0].score
         if best_score == 0:
             return []
@@ -345,6 +554,6 @@ class AlignmentNewsletterSearch(Module):
 
 if __name__ == "__main__":
     module = AlignmentNewsletterSearch()
-    items = module.load_items()
+    items = asyncio.run(module.load_items())
     log = get_logger()
     log.info(module.class_name, an_search_items=items[0])
@@ -27,6 +27,8 @@ from config import (
     Stampy_Path,
     bot_reboot,
 )
+from api.llm_metrics import LLMMetrics
+from database.result_cache import ResultCache
 from modules.module import IntegrationTest, Module, Response
 from servicemodules.serviceConstants import Services
 from utilities import (
@@ -37,6 +39,7 @@ from utilities import (
     get_question_id,
     is_bot_dev,
 )
+from utilities.periodic import PeriodicScheduler
 from utilities.serviceutils import ServiceMessage
 
 
@@ -187,9 +190,21 @@ class StampyControls(Module):
         memory_message = get_memory_usage()
         runtime_message = self.utils.get_time_running()
         modules_message = self.utils.list_modules()
+        cache_message = ResultCache.get_instance().stats()
+        llm_message = LLMMetrics.get_instance().summary()
+        periodic_message = PeriodicScheduler.get_instance().summary()
         # scores_message = self.utils.modules_dict["StampsModule"].get_user_scores()
         return "\n\n".join(
-            [git_message, run_message, memory_message, runtime_message, modules_message]
+            [
+                git_message,
+                run_message,
+                memory_message,
+                runtime_message,
+                modules_message,
+                cache_message,
+                llm_message,
+                periodic_message,
+            ]
         )
 
     async def get_stampy_stats(self, message: ServiceMessage) -> Response:
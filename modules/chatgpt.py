@@ -2,12 +2,18 @@
 Gives user response to ChatGPT
 """
 
+import asyncio
 from openai.openai_object import OpenAIObject
+import aiohttp
 import re
-from typing import cast, TYPE_CHECKING
-
-from api.openai import OpenAI
-from api.utilities.openai import OpenAIEngines
+from typing import AsyncIterator, Callable, cast, TYPE_CHECKING
+
+from api.llm_metrics import LLMMetrics
+from api.llm_scheduler import LLMScheduler, request_priority
+from api.openai import COMPLETION_TIMEOUT, OpenAI, request_timeout
+from api.utilities.openai import OpenAIEngines, tokenizers_available
+from api.utilities.prompt_window import PromptWindow
+from utilities.conversations import ConversationStore, MessageRecord, channel_key
 from config import (
     CONFUSED_RESPONSE,
     openai_api_key,
@@ -18,7 +24,12 @@ from config import (
 from modules.module import IntegrationTest, Module, Response
 from utilities.serviceutils import ServiceChannel, ServiceMessage
 from utilities import Utilities, can_use_paid_service
-from servicemodules.serviceConstants import service_italics_marks, default_italics_mark
+from servicemodules.serviceConstants import (
+    service_italics_marks,
+    default_italics_mark,
+    italicise,
+)
+from utilities.streaming import STREAMING_SERVICES, StreamedText, wait_for_text
 
 if use_helicone:
     try:
@@ -33,18 +44,30 @@ if TYPE_CHECKING:
 
 openai.api_key = openai_api_key
 
+# sometimes the response starts with "Stampy says:" or responds or replies etc, which we don't want
+RE_STAMPY_SAYS = re.compile(r"^[sS]tampy\ ?[a-zA-Z]{,15}:\s?")
+STAMPY_SAYS_MAX_LENGTH = 25
+
 
 class ChatGPTModule(Module):
+    @staticmethod
+    def is_available() -> bool:
+        return tokenizers_available()
+
     def __init__(self):
         super().__init__()
 
-        self.message_logs: dict[
-            ServiceChannel, list[ServiceMessage]
-        ] = {}  # one message log per channel
-        self.log_max_messages = 15  # don't store more than X messages back
-        self.log_max_chars = 1500  # total log length shouldn't be longer than this
-        self.log_message_max_chars = (
-            1000  # limit message length to X chars (remove the middle part)
+        self.log_max_messages = 15  # don't use more than X messages back
+        self.log_message_max_tokens = (
+            250  # limit message length to X tokens (remove the middle part)
+        )
+        # the log's total length is limited by the engine's log_budget
+        self.chat_window = PromptWindow(
+            self.log_max_messages,
+            self.log_message_max_tokens,
+            self.render_message,
+            # the role and separators that every chat message comes with
+            message_overhead=4,
         )
         self.openai = OpenAI() if openai_api_key else None
         if not openai_api_key:
@@ -85,43 +108,29 @@ class ChatGPTModule(Module):
     def message_log_append(self, message) -> None:
         """Store the message in the log"""
 
-        # make sure we have a list in there for this channel
-        self.message_logs[message.channel] = self.message_logs.get(message.channel, [])
-
-        self.message_logs[message.channel].append(message)
-        self.message_logs[message.channel] = self.message_logs[message.channel][-self.log_max_messages:]  # fmt:skip
+        ConversationStore.get_instance().add(message)
 
-    def generate_messages_list(self, channel) -> list[dict[str, str]]:
-        messages = []
-        chatlog = ""
-        for message in self.message_logs[channel][::-1]:
-            username = message.author.display_name
-            text = message.clean_content
-
-            if len(text) > self.log_message_max_chars:
-                text = (
-                    text[: self.log_message_max_chars // 2]
-                    + " ... "
-                    + text[-self.log_message_max_chars // 2 :]
-                )
-            chatline = f"{username} says: {text}"
-
-            chatlog += chatline
-            if len(chatlog) + len(chatline) > self.log_max_chars:
-                break
-
-            if Utilities.get_instance().stampy_is_author(message):
-                messages.insert(0, {"role": "assistant", "content": text.strip("*")})
-            else:
-                messages.insert(0, {"role": "user", "content": chatline})
+    @staticmethod
+    def render_message(record: MessageRecord) -> str:
+        if record.from_stampy:
+            return record.clean_content.strip("*")
+        return f"{record.author_display_name} says: {record.clean_content}"
 
-        messages.insert(
-            0,
+    def generate_messages_list(
+        self, channel: ServiceChannel, engine: OpenAIEngines
+    ) -> list[dict[str, str]]:
+        messages = [
             {
                 "role": "system",
                 "content": llm_prompt,
             },
-        )
+        ]
+
+        for record, text in self.chat_window.fit(channel, engine):
+            if record.from_stampy:
+                messages.append({"role": "assistant", "content": text})
+            else:
+                messages.append({"role": "user", "content": text})
 
         return messages
 
@@ -132,9 +141,6 @@ class ChatGPTModule(Module):
 
         engine: OpenAIEngines = self.openai.get_engine(message)
 
-        messages = self.generate_messages_list(message.channel)
-        self.log.info(self.class_name, messages=messages)
-
         if message.service in service_italics_marks:
             im = service_italics_marks[message.service]
         else:
@@ -144,39 +150,164 @@ class ChatGPTModule(Module):
             self.log.info(self.class_name, msg="channel not allowed")
             return Response()
 
-        if self.openai.is_text_risky(message.clean_content):
+        if await self.openai.is_text_risky(message.clean_content):
             return Response(
                 confidence=0,
                 text="",
                 why="GPT-3's content filter thought the prompt was risky",
             )
 
+        if message.service in STREAMING_SERVICES:
+            # show the answer as it's written, but only claim the message once there's an
+            # answer, so that if ChatGPT fails or says nothing another module can have a go
+            superseded = asyncio.Event()
+            deltas = await wait_for_text(
+                self.stream_chat_completion(message, engine, on_superseded=superseded.set)
+            )
+            if deltas is None:
+                if superseded.is_set():
+                    return Response(
+                        confidence=10,
+                        why="Someone else said something, so I'm answering everyone at once",
+                    )
+                return Response()
+            return Response(
+                confidence=10,
+                text=StreamedText(deltas, format=lambda text: italicise(text, message)),
+                why="ChatGPT made me say it!",
+            )
+
+        response = await LLMScheduler.get_instance().submit(
+            channel_key(message.channel),
+            engine,
+            request_priority(message.author),
+            lambda: self.chat_completion(message.channel, engine),
+        )
+        if response is None:
+            # confident but empty, so that nothing else answers this message either
+            return Response(
+                confidence=10,
+                why="Someone else said something, so I'm answering everyone at once",
+            )
+        if response:
+            return Response(
+                confidence=10,
+                text=f"{im}{response}{im}",
+                why="ChatGPT made me say it!",
+            )
+        return Response()
+
+    async def chat_completion(self, channel: ServiceChannel, engine: OpenAIEngines) -> str:
+        """What ChatGPT says next in the channel, or "" if it didn't say anything"""
+        metrics = LLMMetrics.get_instance()
+        with metrics.timed("prompt", engine):
+            messages = self.generate_messages_list(channel, engine)
+        self.log.info(self.class_name, messages=messages)
+
         self.log.info(
             self.class_name,
             msg=f"sending chat prompt to chatgpt, engine {engine} ({engine.description})",
         )
         try:
-            chatcompletion = cast(
-                OpenAIObject,
-                openai.ChatCompletion.create(model=str(engine), messages=messages),
+            with metrics.timed("completion", engine) as call:
+                timeout = request_timeout(COMPLETION_TIMEOUT)
+                chatcompletion = cast(
+                    OpenAIObject,
+                    await asyncio.wait_for(
+                        openai.ChatCompletion.acreate(
+                            model=str(engine), messages=messages, request_timeout=timeout
+                        ),
+                        timeout,
+                    ),
+                )
+                call.add_usage(chatcompletion.get("usage"))
+        except (asyncio.TimeoutError, openai.error.Timeout):
+            self.log.warning(self.class_name, error=f"Timed out waiting for {engine}")
+            return ""
+
+        if not chatcompletion.choices:
+            return ""
+        response = chatcompletion.choices[0].message.content
+
+        response = RE_STAMPY_SAYS.sub("", response)
+
+        self.log.info(self.class_name, response=response)
+        return response
+
+    async def stream_chat_completion(
+        self,
+        message: ServiceMessage,
+        engine: OpenAIEngines,
+        on_superseded: Callable[[], object] = lambda: None,
+    ) -> AsyncIterator[str]:
+        """ChatGPT's reply to the message, as it's written.
+
+        Calls `on_superseded` instead if a newer message in the channel is being answered.
+        """
+        turn = LLMScheduler.get_instance().turn(
+            channel_key(message.channel), engine, request_priority(message.author)
+        )
+        async with turn as let_through:
+            if not let_through:
+                on_superseded()
+                return
+
+            metrics = LLMMetrics.get_instance()
+            with metrics.timed("prompt", engine):
+                messages = self.generate_messages_list(message.channel, engine)
+                # streamed replies don't say how many tokens they used, so count them ourselves
+                prompt_tokens = sum(
+                    self.chat_window.tokenize(record, engine).tokens + self.chat_window.message_overhead
+                    for record, _ in self.chat_window.fit(message.channel, engine)
+                )
+            self.log.info(self.class_name, messages=messages)
+            self.log.info(
+                self.class_name,
+                msg=f"streaming chat prompt to chatgpt, engine {engine} ({engine.description})",
             )
-            if chatcompletion.choices:
-                response = chatcompletion.choices[0].message.content
-
-                # sometimes the response starts with "Stampy says:" or responds or replies etc, which we don't want
-                response = re.sub(r"^[sS]tampy\ ?[a-zA-Z]{,15}:\s?", "", response)
-
-                self.log.info(self.class_name, response=response)
-
-                if response:
-                    return Response(
-                        confidence=10,
-                        text=f"{im}{response}{im}",
-                        why="ChatGPT made me say it!",
+            # held back until it's long enough to tell whether it starts with "Stampy says:"
+            start = ""
+            response = ""
+            try:
+                with metrics.timed("completion", engine) as call:
+                    # the request timeout covers the whole stream, not just the first chunk
+                    timeout = request_timeout(COMPLETION_TIMEOUT)
+                    chunks = await asyncio.wait_for(
+                        openai.ChatCompletion.acreate(
+                            model=str(engine),
+                            messages=messages,
+                            stream=True,
+                            request_timeout=timeout,
+                        ),
+                        timeout,
                     )
-        except openai.error.Timeout:
-            pass
-        return Response()
+                    call.prompt_tokens = prompt_tokens
+                    async for chunk in chunks:
+                        # each chunk is one token
+                        call.completion_tokens += 1
+                        delta = chunk.choices[0].delta.get("content", "") if chunk.choices else ""
+                        if start is not None:
+                            start += delta
+                            if len(start) < STAMPY_SAYS_MAX_LENGTH:
+                                continue
+                            delta, start = RE_STAMPY_SAYS.sub("", start), None
+                        response += delta
+                        yield delta
+            # LLMMetrics counts these, but the reply is already on its way, so they can't
+            # escape: end it with whatever was written so far instead
+            except (asyncio.TimeoutError, openai.error.Timeout):
+                self.log.warning(self.class_name, error=f"Timed out waiting for {engine}")
+            except openai.error.AuthenticationError:
+                self.log.error(self.class_name, error="OpenAI Authentication Failed")
+            except openai.error.RateLimitError:
+                self.log.warning(self.class_name, error="OpenAI Rate Limit Exceeded")
+            except (openai.error.OpenAIError, aiohttp.ClientError) as e:
+                self.log.error(self.class_name, error=f"Error streaming from {engine}: {e!r}")
+            if start:
+                start = RE_STAMPY_SAYS.sub("", start)
+                response += start
+                yield start
+            self.log.info(self.class_name, response=response)
 
     def __str__(self):
         return "ChatGPT Module"
@@ -5,12 +5,18 @@ Wikipedia article for linear algebra.
 
 import re
 import json
-from urllib.parse import quote_plus
-from urllib.request import urlopen
+from typing import Optional
 
+from database.result_cache import ResultCache
 from modules.module import IntegrationTest, Module, Response
+from utilities.http_utils import HttpClient
 from utilities.serviceutils import ServiceMessage
 
+DUCKDUCKGO_API_URL = "https://api.duckduckgo.com/"
+
+# the parts of DuckDuckGo's answer that we use, and so cache
+USED_KEYS = ("Abstract", "AbstractSource", "AbstractURL", "Entity", "Type", "RelatedTopics")
+
 
 class DuckDuckGo(Module):
     """DuckDuckGo module"""
@@ -32,6 +38,9 @@ class DuckDuckGo(Module):
                     why="This is definitely a web search",
                 )
             print(f"Text didn't match: {text}")
+            if not HttpClient.get_instance().is_available(DUCKDUCKGO_API_URL):
+                # only bother when asked directly, while DuckDuckGo is having trouble
+                return Response()
             if text.endswith("?"):
                 return Response(
                     confidence=6,
@@ -62,7 +71,7 @@ class DuckDuckGo(Module):
             return 1
         return max_confidence
 
-    def ask(self, question: str) -> Response:
+    async def ask(self, question: str) -> Response:
         """Ask DuckDuckGo a question and return a response."""
 
         # strip out question mark and common 'question phrases', e.g. 'who are',
@@ -71,13 +80,21 @@ class DuckDuckGo(Module):
         q = re.sub(r"w(hat|ho)('s|'re| is| are| was| were) ?", "", q)
         q = re.sub(r"(what do you know|(what )?(can you)? ?tell me) about", "", q)
 
-        # create url which searches DuckDuckGo for the question
-        url = f"https://api.duckduckgo.com/?q={quote_plus(q)}&format=json&nohtml=1&skip_disambig=1"
+        # search DuckDuckGo for the question
+        params = {"q": q, "format": "json", "nohtml": "1", "skip_disambig": "1"}
+
+        async def search() -> Optional[dict]:
+            j = await HttpClient.get_instance().get_json(DUCKDUCKGO_API_URL, params=params)
+            if j["Abstract"] or j["Type"] == "D":
+                return {k: j.get(k) for k in USED_KEYS}
+            return None
+
         try:
-            data = urlopen(url).read()
-            j = json.loads(data)
+            j = await ResultCache.get_instance().get_or_fetch("duckduckgo", q, search)
 
-            self.log.info(self.class_name, query=q, url=url)
+            self.log.info(self.class_name, query=q)
+            if not j:
+                return Response()
             debug_keys = ["Abstract", "AbstractSource", "AbstractURL", "Entity", "Type"]
             debug_data = {k: j.get(k) for k in debug_keys}
 
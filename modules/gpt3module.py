@@ -2,13 +2,21 @@
 Gives user response to GPT-3 (old API)
 """
 
+from functools import lru_cache
 from typing import Optional, cast
 
+import asyncio
+
 import openai
 from openai.openai_object import OpenAIObject
 import openai.error as oa_error
 
-from api.openai import OpenAI, OpenAIEngines
+from api.llm_metrics import LLMMetrics
+from api.llm_scheduler import LLMScheduler, request_priority
+from api.openai import COMPLETION_TIMEOUT, OpenAI, OpenAIEngines, request_timeout
+from api.utilities.openai import tokenizers_available
+from api.utilities.prompt_window import PromptWindow
+from utilities.conversations import ConversationStore, MessageRecord, channel_key
 from config import openai_api_key, bot_vip_ids
 from modules.module import Module, Response
 from utilities import Utilities
@@ -19,8 +27,23 @@ openai.api_key = openai_api_key
 start_sequence = "\nA:"
 restart_sequence = "\n\nQ: "
 
+# we italicise GPT's replies ourselves, so stop it from adding asterisks of its own
+FORBIDDEN_STRINGS = ("*", "**", "***", " *", " **", " ***")
+
+
+@lru_cache(maxsize=None)
+def constant_logit_bias(engine: OpenAIEngines) -> dict[int, int]:
+    """The logit bias that's the same for every request, worked out once per engine. Don't modify it!"""
+    if not engine.has_own_tokenizer:
+        return {}  # the token ids would be for some other tokenizer
+    return {engine.tokenizer(text)["input_ids"][0]: -100 for text in FORBIDDEN_STRINGS}  # type:ignore
+
 
 class GPT3Module(Module):
+    @staticmethod
+    def is_available() -> bool:
+        return tokenizers_available()
+
     def __init__(self) -> None:
         super().__init__()
         self.start_prompt = (
@@ -46,12 +69,13 @@ class GPT3Module(Module):
             "A: Unknown\n\n"
             "Q: "
         )
-        # one message log per channel
-        self.message_logs: dict[ServiceChannel, list[ServiceMessage]] = {}
-        self.log_max_messages = 10  # don't store more than X messages back
-        self.log_max_chars = 1500  # total log length shouldn't be longer than this
-        # limit message length to X chars (remove the middle part)
-        self.log_message_max_chars = 500
+        self.log_max_messages = 10  # don't use more than X messages back
+        # limit message length to X tokens (remove the middle part)
+        self.log_message_max_tokens = 125
+        # the log's total length is limited by the engine's log_budget
+        self.chat_window = PromptWindow(
+            self.log_max_messages, self.log_message_max_tokens, self.render_message
+        )
 
         self.openai = OpenAI() if openai_api_key else None
         if not openai_api_key:
@@ -87,15 +111,34 @@ class GPT3Module(Module):
 
     def message_log_append(self, message: ServiceMessage) -> None:
         """Store the message in the log"""
-
-        # make sure we have a list in there for this channel
-        self.message_logs[message.channel] = self.message_logs.get(message.channel, [])
-
-        self.message_logs[message.channel].append(message)
-        self.message_logs[message.channel] = self.message_logs[message.channel][-self.log_max_messages :]  # fmt:skip
-
-    def generate_chatlog_prompt(self, channel: ServiceChannel) -> str:
-        chatlog_string = self.generate_chatlog(channel)
+        record = ConversationStore.get_instance().add(message)
+
+        # tokenize stampy's messages now, rather than every time we ask GPT for a reply
+        if self.openai and record.from_stampy:
+            for engine in {engine.tokenizer_name: engine for engine in OpenAIEngines}.values():
+                if engine.has_own_tokenizer:
+                    self.first_token(record, engine)
+
+    def first_token(self, record: MessageRecord, engine: OpenAIEngines) -> int:
+        """The token that stampy's message starts with, as it would be generated after "stampy:" """
+        key = ("first_token", engine.tokenizer_name)
+        if key not in record.memo:
+            # we only need the first token, so just clip to ten chars
+            # the space is because we generate from "stampy:" so there's always a space at the start
+            if record.service in service_italics_marks:
+                im = service_italics_marks[record.service]
+            else:
+                im = default_italics_mark
+            text = " " + record.clean_content[:10].strip(im)
+            record.memo[key] = self.tokenize(engine, text)
+        return record.memo[key]
+
+    @staticmethod
+    def render_message(record: MessageRecord) -> str:
+        return f"{record.author_name}: {record.clean_content}"
+
+    def generate_chatlog_prompt(self, channel: ServiceChannel, engine: OpenAIEngines) -> str:
+        chatlog_string = self.generate_chatlog(channel, engine)
 
         prompt = (
             f"Stampy is a helpful, intelligent, and sarcastic AI bot. He loves stamps more than anything, and hates to repeat himself.\n"
@@ -106,26 +149,9 @@ class GPT3Module(Module):
         self.log.info(self.class_name, prompt=prompt)
         return prompt
 
-    def generate_chatlog(self, channel: ServiceChannel) -> str:
-        chatlog = ""
-        for message in self.message_logs[channel][::-1]:
-            username = message.author.name
-            text = message.clean_content
-
-            if len(text) > self.log_message_max_chars:
-                text = (
-                    text[: self.log_message_max_chars // 2]
-                    + " ... "
-                    + text[-self.log_message_max_chars // 2 :]
-                )
-            chatline = f"{username}: {text}"
-
-            if len(chatlog) + len(chatline) > self.log_max_chars:
-                break
-
-            chatlog = f"{chatline}\n{chatlog}"
-
-        return chatlog
+    def generate_chatlog(self, channel: ServiceChannel, engine: OpenAIEngines) -> str:
+        """The newest lines of the chat log that fit in the engine's log budget"""
+        return "".join(f"{line}\n" for _, line in self.chat_window.fit(channel, engine))
 
     def get_forbidden_tokens(
         self, channel: ServiceChannel, engine: OpenAIEngines
@@ -136,20 +162,15 @@ class GPT3Module(Module):
         """
 
         forbidden_tokens = set()
+        if not engine.has_own_tokenizer:
+            return forbidden_tokens  # the token ids would be for some other tokenizer
 
-        for message in self.message_logs[channel]:
-            if Utilities.get_instance().stampy_is_author(message):
-                # we only need the first token, so just clip to ten chars
-                # the space is because we generate from "stampy:" so there's always a space at the start
-                if message.service in service_italics_marks:
-                    im = service_italics_marks[message.service]
-                else:
-                    im = default_italics_mark
-                text = " " + message.clean_content[:10].strip(im)
-                forbidden_token = engine.tokenizer(text)["input_ids"][0]  # type:ignore
+        for record in self.chat_window.messages(channel):
+            if record.from_stampy:
+                forbidden_token = self.first_token(record, engine)
                 forbidden_tokens.add(forbidden_token)
                 self.log.info(
-                    self.class_name, text=text, forbidden_token=forbidden_token
+                    self.class_name, message_id=record.id, forbidden_token=forbidden_token
                 )
 
         return forbidden_tokens
@@ -171,32 +192,24 @@ class GPT3Module(Module):
             print('no engine')
             return Response()
 
-        prompt = self.generate_chatlog_prompt(message.channel)
-
-        forbidden_tokens = self.get_forbidden_tokens(message.channel, engine)
-        self.log.info(self.class_name, forbidden_tokens=forbidden_tokens)
-        logit_bias = {
-            self.tokenize(engine, "*"): -100,
-            self.tokenize(engine, "**"): -100,
-            self.tokenize(engine, "***"): -100,
-            self.tokenize(engine, " *"): -100,
-            self.tokenize(engine, " **"): -100,
-            self.tokenize(engine, " ***"): -100,
-        }
-        for forbidden_token in forbidden_tokens:
-            logit_bias[forbidden_token] = -100
-
         if message.service in service_italics_marks:
             im = service_italics_marks[message.service]
         else:
             im = default_italics_mark
 
         if self.openai.is_channel_allowed(message):
-            self.log.info(
-                self.class_name, msg="sending chat prompt to openai", engine=engine
+            response = await LLMScheduler.get_instance().submit(
+                channel_key(message.channel),
+                engine,
+                request_priority(message.author),
+                lambda: self.chat_completion(message.channel, engine),
             )
-            response = self.openai.get_response(engine, prompt, logit_bias)
-            self.log.info(self.class_name, response=response)
+            if response is None:
+                # confident but empty, so that nothing else answers this message either
+                return Response(
+                    confidence=10,
+                    why="Someone else said something, so I'm answering everyone at once",
+                )
             if response != "":
                 return Response(
                     confidence=10,
@@ -206,6 +219,29 @@ class GPT3Module(Module):
 
         return Response()
 
+    async def chat_completion(self, channel: ServiceChannel, engine: OpenAIEngines) -> str:
+        """What GPT-3 says stampy says next in the channel, or "" if nothing"""
+        self.openai = cast(OpenAI, self.openai)
+        with LLMMetrics.get_instance().timed("prompt", engine):
+            prompt = self.generate_chatlog_prompt(channel, engine)
+
+            forbidden_tokens = self.get_forbidden_tokens(channel, engine)
+            self.log.info(self.class_name, forbidden_tokens=forbidden_tokens)
+            logit_bias = dict(constant_logit_bias(engine))
+            for forbidden_token in forbidden_tokens:
+                logit_bias[forbidden_token] = -100
+
+        self.log.info(
+            self.class_name, msg="sending chat prompt to openai", engine=engine
+        )
+        # the rest of the prompt is ours, and most of these were checked on previous turns
+        log_texts = [r.clean_content for r in self.chat_window.messages(channel)]
+        response = await self.openai.get_response(
+            engine, prompt, logit_bias, moderate=log_texts
+        )
+        self.log.info(self.class_name, response=response)
+        return response
+
     async def gpt3_question(self, message: ServiceMessage) -> Response:
         """Ask GPT-3 for an answer"""
         self.openai = cast(OpenAI, self.openai)
@@ -217,7 +253,7 @@ class GPT3Module(Module):
             self.log.info(self.class_name, status="Asking GPT-3")
             prompt = self.start_prompt + text + start_sequence
 
-            if self.openai.is_text_risky(text):
+            if await self.openai.is_text_risky(text):
                 return Response(
                     confidence=0,
                     text="",
@@ -225,24 +261,34 @@ class GPT3Module(Module):
                 )
 
             try:
-                response = cast(
-                    OpenAIObject,
-                    openai.Completion.create(
-                        engine=engine,
-                        prompt=prompt,
-                        temperature=0,
-                        max_tokens=100,
-                        top_p=1,
-                        user=str(message.author.id),
-                        # stop=["\n"],
-                    ),
-                )
+                with LLMMetrics.get_instance().timed("completion", engine) as call:
+                    timeout = request_timeout(COMPLETION_TIMEOUT)
+                    response = cast(
+                        OpenAIObject,
+                        await asyncio.wait_for(
+                            openai.Completion.acreate(
+                                engine=engine,
+                                prompt=prompt,
+                                temperature=0,
+                                max_tokens=100,
+                                top_p=1,
+                                user=str(message.author.id),
+                                # stop=["\n"],
+                                request_timeout=timeout,
+                            ),
+                            timeout,
+                        ),
+                    )
+                    call.add_usage(response.get("usage"))
             except oa_error.AuthenticationError:
                 self.log.error(self.class_name, error="OpenAI Authentication Failed")
                 return Response()
             except oa_error.RateLimitError:
                 self.log.warning(self.class_name, error="OpenAI Rate Limit Exceeded")
                 return Response(why="Rate Limit Exceeded")
+            except (asyncio.TimeoutError, oa_error.Timeout):
+                self.log.warning(self.class_name, error="Timed out waiting for GPT-3")
+                return Response()
 
             if response["choices"]:
                 choice = response["choices"][0]
@@ -4,13 +4,15 @@ from dataclasses import dataclass, field
 import inspect
 import re
 import random
-from typing import Callable, Iterable, Literal, Optional, TypedDict, Union
+from typing import Awaitable, Callable, Iterable, Literal, Optional, TypedDict, Union
 
 import discord
 from structlog import get_logger
 
 from config import TEST_MESSAGE_PREFIX
 from utilities.help_utils import ModuleHelp
+from utilities.periodic import PeriodicJob, PeriodicScheduler
+from utilities.streaming import StreamedText
 from utilities.utilities import (
     Utilities,
     is_stampy_mentioned,
@@ -47,6 +49,11 @@ class Response:
 
         Response(text=["a", "b", "c"], confidence=9)
 
+    If the text is slow to generate (e.g. a chat bot answering), it can use a `StreamedText`, which
+    Discord shows as it arrives, editing the message as it goes:
+
+        Response(text=StreamedText(deltas, epilogue=lambda: citations), confidence=10)
+
     Another module may spot that "What is AIXI?" is a question it may be able to actually answer well,
     but it doesn't know without slow/expensive operations that we don't want to do if we don't have to,
     like hitting a remote API or running a large language model. So it generates a callback response:
@@ -90,7 +97,7 @@ class Response:
 
     embed: Optional[discord.Embed] = None
     confidence: float = 0.0
-    text: Union[str, Iterable[str]] = ""
+    text: Union[str, Iterable[str], StreamedText] = ""
     callback: Optional[Callable] = None
     args: list = field(default_factory=list)
     kwargs: dict = field(default_factory=dict)
@@ -177,15 +184,15 @@ class Module:
         Use this to allow modules to handle adding and removing reactions on messages"""
         return Response()
 
-    async def tick(self):
-        """This function will be called all the time, whenever anything happens on the discord.
-        Use it for things that need to happen regularly, but RATE LIMIT IT!
-        ALWAYS call self.utils.rate_limit() first thing in the function, so it doesn't happen too much.
-        For example:
+    def schedule(self, name: str, func: Callable[[], Awaitable], interval: float, **kwargs) -> PeriodicJob:
+        """Have `await func()` run every `interval` seconds, for things that need to happen regularly.
+        Call it in `__init__`. The keyword arguments (`jitter`, `missed`, `run_at_start`) are passed
+        on to PeriodicScheduler.register, see utilities/periodic.py. For example:
 
-        if self.utils.rate_limit("check youtube API", seconds=30):
-            return"""
-        pass
+        self.schedule("check youtube API", self.check_youtube, interval=30, jitter=5)"""
+        return PeriodicScheduler.get_instance().register(
+            f"{self.class_name}: {name}", func, interval, **kwargs
+        )
 
     def __str__(self):
         return "Base Module"
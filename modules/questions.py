@@ -108,12 +108,7 @@ class Questions(Module):
         self.wip_autopost_limit: int = 3
 
         if is_rob_server:
-            @self.utils.client.event  # fmt:skip
-            async def on_socket_event_type(_event_type) -> None:
-                if self.is_time_for_autopost_not_started():
-                    await self.autopost_not_started()
-                if self.is_time_for_autopost_wip():
-                    await self.autopost_wip()
+            self.schedule("autopost", self.autopost_if_due, interval=60, jitter=10)
 
         ###############
         #   Regexes   #
@@ -354,6 +349,14 @@ class Questions(Module):
             why=why,
         )
 
+    async def autopost_if_due(self) -> None:
+        if not self.utils.client.is_ready():
+            return
+        if self.is_time_for_autopost_not_started():
+            await self.autopost_not_started()
+        if self.is_time_for_autopost_wip():
+            await self.autopost_wip()
+
     def is_time_for_autopost_not_started(self) -> bool:
         return (
             self.last_not_started_autopost_attempt_dt
@@ -4,13 +4,21 @@ Checks if there are human-written answers to your queston on AIsafety.info
 
 import re
 import json
-import urllib
+
+import aiohttp
+
+from database.result_cache import ResultCache
 from modules.module import Module, Response
+from utilities.http_utils import HttpClient
+
+SEMANTIC_SEARCH_URL = "https://stampy-nlp-t6p37v2uia-uw.a.run.app/api/search"
 
 class SemanticAnswers(Module):
 
     def process_message(self, message):
         text = self.is_at_me(message)
+        if not HttpClient.get_instance().is_available(SEMANTIC_SEARCH_URL):
+            return Response()
         if text and text.endswith("?"):
             return Response(
                 confidence=6,
@@ -24,35 +32,38 @@ class SemanticAnswers(Module):
     def __str__(self):
         return "Semantic Answers"
 
-    def ask(self, question):
+    async def ask(self, question):
         q = question.lower().strip()
-        url = (
-            "https://stampy-nlp-t6p37v2uia-uw.a.run.app/api/search?query=%s"
-            % urllib.parse.quote_plus(q)
-        )
-        
-        try:
-            data = urllib.request.urlopen(url, timeout=4).read()
-            j = json.loads(data)
 
-            self.log.info("SemanticAnswers", query=q, url=url)
+        async def search():
+            j = await HttpClient.get_instance().get_json(
+                SEMANTIC_SEARCH_URL, params={"query": q}, timeout=aiohttp.ClientTimeout(total=4)
+            )
             self.log.debug("SemanticAnswers", data=json.dumps(j, sort_keys=True, indent=2))
 
             for possible_answer in j:
                 if possible_answer["score"] > 0.5:
                     if not possible_answer["url"].endswith("_"):
                         possible_answer["url"] = possible_answer["url"] + "_"
-                    response = f"""Perhaps this can answer your question?
-{possible_answer["url"]}"""
+                    return possible_answer["url"]
+            return None
+
+        try:
+            url = await ResultCache.get_instance().get_or_fetch("semantic", q, search)
+            self.log.info("SemanticAnswers", query=q, url=url)
+
+            if url:
+                response = f"""Perhaps this can answer your question?
+{url}"""
 
-                    return Response(
-                        confidence=8,
-                        text=response,
-                        why="I found a similar question with semantic search",
-                    )
+                return Response(
+                    confidence=8,
+                    text=response,
+                    why="I found a similar question with semantic search",
+                )
 
         except Exception as e:
-            self.log.error("SemanticAnswers", error=e)
-            raise(e)
+            # not worth a traceback in the error channel, someone else can answer instead
+            self.log.warning("SemanticAnswers", msg="Semantic search failed", error=e)
 
         return Response()
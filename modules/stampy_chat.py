@@ -3,26 +3,29 @@ Queries chat.stampy.ai with the user's question.
 
 """
 
-import json
+import asyncio
 import re
-from collections import deque, defaultdict
-from typing import Iterable, List, Dict, Any
+from typing import List, Dict, Any, Optional
 from uuid import uuid4
 
-import requests
+import aiohttp
 from structlog import get_logger
 
+from database.result_cache import ResultCache
 from modules.module import Module, Response
 from servicemodules.serviceConstants import italicise
-from utilities.serviceutils import ServiceChannel, ServiceMessage
+from utilities.conversations import ConversationStore, MessageRecord
+from utilities.http_utils import CircuitOpenError, HttpClient
+from utilities.serviceutils import ServiceMessage
+from utilities.sse import iter_json
+from utilities.streaming import STREAMING_SERVICES, StreamedText
 from utilities.utilities import Utilities
 
 log = get_logger()
 utils = Utilities.get_instance()
 
 
-LOG_MAX_MESSAGES = 15  # don't store more than X messages back
-DATA_HEADER = 'data: '
+LOG_MAX_MESSAGES = 15  # don't use more than X messages back
 
 STAMPY_CHAT_ENDPOINT = "https://chat.stampy.ai:8443/chat"
 NLP_SEARCH_ENDPOINT = "https://nlp.stampy.ai"
@@ -30,35 +33,44 @@ NLP_SEARCH_ENDPOINT = "https://nlp.stampy.ai"
 STAMPY_ANSWER_MIN_SCORE = 0.75
 STAMPY_CHAT_MIN_SCORE = 0.4
 
+# the chat bot can take a while to think, but shouldn't go quiet for long once it starts answering
+STAMPY_CHAT_TIMEOUT = aiohttp.ClientTimeout(total=120, connect=5, sock_read=30)
 
-def stream_lines(stream: Iterable):
-    line = ''
-    for item in stream:
-        item = item.decode('utf8')
-        line += item
-        if '\n' in line:
-            lines = line.split('\n')
-            line = lines[-1]
-            for l in lines[:-1]:
-                yield l
-    yield line
+# what's shown when the chat bot stops answering partway, or before it's said anything
+INTERRUPTED_NOTE = '\n\n(answer interrupted)'
+NO_ANSWER_TEXT = "I couldn't get an answer from the chat bot, try again later"
 
 
-def parse_data_items(stream: Iterable):
-    for item in stream:
-        if item.strip().startswith(DATA_HEADER):
-            yield json.loads(item.split(DATA_HEADER)[1])
-
+async def top_nlp_search(query: str) -> Dict[str, Any]:
+    async def search():
+        items = await HttpClient.get_instance().get_json(
+            NLP_SEARCH_ENDPOINT + '/api/search', params={'query': query, 'status': 'all'}
+        )
+        return items and items[0]
 
-def top_nlp_search(query: str) -> Dict[str, Any]:
-    resp = requests.get(NLP_SEARCH_ENDPOINT + '/api/search', params={'query': query, 'status': 'all'})
-    if not resp:
+    try:
+        return await ResultCache.get_instance().get_or_fetch('nlp', query, search) or {}
+    except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+        log.warning('stampy_chat', msg='NLP search failed', error=e)
         return {}
-
-    items = resp.json()
-    if not items:
+    except Exception as e:
+        # e.g. a reply that isn't the JSON we expect. This usually runs in a prefetch task,
+        # which nobody awaits if another module answers, so it mustn't raise.
+        log.error('stampy_chat', msg='NLP search gave an unexpected reply', error=repr(e))
         return {}
-    return items[0]
+
+
+def prefetch_nlp_search(query: str) -> Optional['asyncio.Task[Dict[str, Any]]']:
+    """Start looking the query up in the background, while the other modules have their say.
+
+    Returns None if there's no event loop running here (e.g. Flask), in which case the
+    lookup is done when the callback runs. If the callback never runs, the result is
+    still cached, in case someone asks again.
+    """
+    try:
+        return asyncio.get_running_loop().create_task(top_nlp_search(query))
+    except RuntimeError:
+        return None
 
 
 def chunk_text(text: str, chunk_limit=2000, delimiter='.'):
@@ -81,7 +93,6 @@ class StampyChat(Module):
 
     def __init__(self):
         self.utils = Utilities.get_instance()
-        self._messages: dict[ServiceChannel, deque[ServiceMessage]] = defaultdict(lambda: deque(maxlen=LOG_MAX_MESSAGES))
         self.session_id = str(uuid4())
         super().__init__()
 
@@ -89,57 +100,105 @@ class StampyChat(Module):
     def class_name(self):
         return 'stampy_chat'
 
-    def format_message(self, message: ServiceMessage):
+    def format_message(self, record: MessageRecord):
         return {
-            'content': message.content,
-            'role': 'assistant' if self.utils.stampy_is_author(message) else 'user',
+            'content': record.content,
+            'role': 'assistant' if record.from_stampy else 'user',
         }
 
-    def stream_chat_response(self, query: str, history: List[ServiceMessage]):
-        return parse_data_items(stream_lines(requests.post(STAMPY_CHAT_ENDPOINT, stream=True, json={
+    async def stream_chat_response(self, query: str, history: List[MessageRecord]):
+        request = HttpClient.get_instance().request('POST', STAMPY_CHAT_ENDPOINT, timeout=STAMPY_CHAT_TIMEOUT, json={
             'query': query,
             'history': [self.format_message(m) for m in history],
             'sessionId': self.session_id,
             'settings': {'mode': 'discord'},
-        })))
-
-    def get_chat_response(self, query: str, history: List[ServiceMessage]):
-        response = {'citations': [], 'content': '', 'followups': []}
-        for item in self.stream_chat_response(query, history):
-            if item.get('state') == 'citations':
-                response['citations'] += item.get('citations', [])
-            elif item.get('state') == 'streaming':
-                response['content'] += item.get('content', '')
-            elif item.get('state') == 'followups':
-                response['followups'] += item.get('followups', [])
-        response['citations'] = filter_citations(response['content'], response['citations'])
-        return response
-
-    async def query(self, query: str, history: List[ServiceMessage], message: ServiceMessage):
-        log.info('calling %s', query)
-        chat_response = self.get_chat_response(query, history)
-        content_chunks = list(chunk_text(chat_response['content']))
-        citations = [f'[{c["reference"]}] - {c["title"]} ({c["url"]})' for c in chat_response['citations'] if c.get('reference')]
+        })
+        async with request as http_response:
+            async for item in iter_json(http_response.content.iter_any()):
+                yield item
+
+    @staticmethod
+    def add_item(response: Dict[str, Any], item: Dict[str, Any]) -> str:
+        """Add a streamed item to the response, returning any new content"""
+        if item.get('state') == 'citations':
+            response['citations'] += item.get('citations', [])
+        elif item.get('state') == 'streaming':
+            response['content'] += item.get('content', '')
+            return item.get('content', '')
+        elif item.get('state') == 'followups':
+            response['followups'] += item.get('followups', [])
+        return ''
+
+    @staticmethod
+    def format_extras(response: Dict[str, Any]) -> List[str]:
+        """The citations and followups of a finished response, as messages"""
+        used_citations = filter_citations(response['content'], response['citations'])
+        citations = [f'[{c["reference"]}] - {c["title"]} ({c["url"]})' for c in used_citations if c.get('reference')]
         if citations:
             citations = ['Citations: \n' + '\n'.join(citations)]
         followups = []
-        if follows := chat_response['followups']:
+        if follows := response['followups']:
             followups = [
                 'Checkout these articles for more info: \n' + '\n'.join(
                     f'{f["text"]} - https://aisafety.info?state={f["pageid"]}' for f in follows
                 )
             ]
+        return citations + followups
+
+    async def get_chat_response(self, query: str, history: List[MessageRecord]):
+        response = {'citations': [], 'content': '', 'followups': []}
+        async for item in self.stream_chat_response(query, history):
+            self.add_item(response, item)
+        response['citations'] = filter_citations(response['content'], response['citations'])
+        return response
+
+    def stream_chat_text(self, query: str, history: List[MessageRecord], message: ServiceMessage) -> StreamedText:
+        """The chat bot's answer, to be shown while it's being written"""
+        response = {'citations': [], 'content': '', 'followups': []}
+
+        async def deltas():
+            try:
+                async for item in self.stream_chat_response(query, history):
+                    if content := self.add_item(response, item):
+                        yield content
+            except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+                # end the message with what we've got, rather than leaving it cut off
+                log.warning('stampy_chat', msg='The chat bot stopped answering', error=e)
+                yield INTERRUPTED_NOTE if response['content'].strip() else NO_ANSWER_TEXT
+                return
+            log.info('response: %s', response['content'])
+
+        return StreamedText(
+            deltas(),
+            epilogue=lambda: self.format_extras(response),
+            format=lambda text: italicise(text, message),
+        )
 
-        log.info('response: %s', content_chunks + citations + followups)
+    async def query(self, query: str, history: List[MessageRecord], message: ServiceMessage):
+        log.info('calling %s', query)
+        if message.service in STREAMING_SERVICES:
+            # show the answer as it's written
+            return Response(
+                confidence=10,
+                text=self.stream_chat_text(query, history, message),
+                why='This is what the chat bot returned'
+            )
+
+        chat_response = await self.get_chat_response(query, history)
+        content_chunks = list(chunk_text(chat_response['content']))
+        extras = self.format_extras(chat_response)
+
+        log.info('response: %s', content_chunks + extras)
         return Response(
             confidence=10,
-            text=[italicise(text, message) for text in content_chunks + citations + followups],
+            text=[italicise(text, message) for text in content_chunks + extras],
             why='This is what the chat bot returned'
         )
 
-    def _add_message(self, message: ServiceMessage) -> deque[ServiceMessage]:
-        self._messages[message.channel].append(message)
-        return self._messages[message.channel]
+    def _add_message(self, message: ServiceMessage) -> List[MessageRecord]:
+        store = ConversationStore.get_instance()
+        store.add(message)
+        return store.history(message.channel, LOG_MAX_MESSAGES)
 
     def make_query(self, messages):
         if not messages:
@@ -148,7 +207,7 @@ class StampyChat(Module):
         current = messages[-1]
         query, history = '', list(messages)
         while message := (history and history.pop()):
-            if message.author != current.author:
+            if message.author_id != current.author_id:
                 break
             query = message.content + ' ' + query
             current = message
@@ -161,7 +220,33 @@ class StampyChat(Module):
             return Response()
 
         query, history = self.make_query(history)
-        nlp = top_nlp_search(query)
+        client = HttpClient.get_instance()
+        if not client.is_available(STAMPY_CHAT_ENDPOINT):
+            return Response()
+        if not client.is_available(NLP_SEARCH_ENDPOINT):
+            # can't check whether it's on topic, so only ask the chat bot if nothing else has a go
+            return Response(
+                confidence=4,
+                callback=self.query,
+                args=[query, history, message],
+                why="The semantic search is down, but the chat bot might know",
+            )
+        return Response(
+            confidence=6,
+            callback=self.check_nlp_search,
+            args=[query, history, message, prefetch_nlp_search(query)],
+            why='Someone asked me something, maybe there is an answer on aisafety.info',
+        )
+
+    async def check_nlp_search(
+        self,
+        query: str,
+        history: List[MessageRecord],
+        message: ServiceMessage,
+        prefetched: Optional['asyncio.Task[Dict[str, Any]]'] = None,
+    ):
+        """Point to an existing answer if there's a good one, otherwise ask the chat bot if it's on topic"""
+        nlp = await (prefetched or top_nlp_search(query))
         if nlp.get('score', 0) > STAMPY_ANSWER_MIN_SCORE and nlp.get('status') == 'Live on site':
             return Response(confidence=5, text=f'Check out {nlp.get("url")} ({nlp.get("title")})')
         if nlp.get('score', 0) > STAMPY_CHAT_MIN_SCORE:
@@ -1,11 +1,19 @@
 """
 Searches the titles, descriptions and transcripts of Rob Miles videos, to find keywords/phrases
+Put a phrase in "double quotes" to match it exactly. Links go to the moment in the video that matched best.
 """
 
 import re
-import os
+from typing import Optional
 from modules.module import Module, Response
-from config import subs_dir
+from config import subs_dir, video_index_path
+from database.transcripts import (
+    RE_PHRASE,
+    TranscriptCorpus,
+    extract_phrases,
+    process_vtt_file,
+    tokenize,
+)
 
 
 class VideoSearch(Module):
@@ -31,12 +39,33 @@ class VideoSearch(Module):
 
             self.title = title
             self.stub = stub
-            self.text = text
+            self._text = text
             self.description = description
 
             self.url = "http://youtu.be/%s" % self.stub
 
+            # position of this video's transcript in the TranscriptIndex
+            self.doc_id: Optional[int] = None
+            # the corpus holding the transcript text, if it wasn't given directly
+            self.corpus: Optional[TranscriptCorpus] = None
+
             self.score = 0
+            # start of the transcript cue that best matched the last search, in seconds
+            self.timestamp: Optional[int] = None
+
+        @property
+        def text(self):
+            """The transcript, in `timestamp|line` format. Only decoded when asked for"""
+            if self.corpus is not None and self.doc_id is not None:
+                return self.corpus.text(self.doc_id)
+            return self._text
+
+        @property
+        def link(self):
+            """The video URL, deep-linked to the best matching moment if we know it"""
+            if self.timestamp is None:
+                return self.url
+            return "%s?t=%d" % (self.url, self.timestamp)
 
         def __repr__(self):
             return '<Video %s: %f "%s">' % (self.stub, self.score, self.title)
@@ -46,42 +75,18 @@ class VideoSearch(Module):
 
     @staticmethod
     def process_vtt_file(vtt_file_name):
-        with open(vtt_file_name) as vtt_file:
-            lines = []
-            for line in vtt_file.readlines():
-                regex_matches = re.search(r"<[^>]*>", line)
-                if regex_matches:
-                    # the timestamp for the start of the line
-                    timestamp = regex_matches.group(0)
-
-                    # remove the brackets, leading zeros, and milliseconds
-                    # 00:10:17.630 becomes 10:17
-                    timestamp = timestamp.lstrip("0<>").lstrip(":").partition(".")[0]
-
-                    # strip out all the html tags from the line
-                    pline = re.sub(r"<[^>]*>", "", line.strip())
-                    lines.append(timestamp + "|" + pline)
-        return "\n".join(lines)
+        return process_vtt_file(vtt_file_name)
 
     def load_videos(self):
-        with os.scandir(self.subsdir) as entries:
-            for entry in entries:
-                if entry.name.endswith(".en.vtt"):
-                    vtt_groups = re.match(r"^(.+?)-([a-zA-Z0-9\-_]{11})\.en(-GB)?\.vtt$", entry.name)
-                    title = vtt_groups.group(1)
-                    stub = vtt_groups.group(2)
-
-                    text = self.process_vtt_file(entry.path)
-
-                    description_filename = title + "-" + stub + ".description"
-                    description_filepath = os.path.join(self.subsdir, description_filename)
-                    if os.path.exists(description_filepath):
-                        description = open(description_filepath, encoding="utf8").read()
-                    else:
-                        description = ""
-
-                    video = self.Video(title, stub, text, description)
-                    self.videos.append(video)
+        """Load the prebuilt video index, rebuilding it first if the subtitles have changed"""
+        self.corpus = TranscriptCorpus.load_or_build(self.subsdir, video_index_path)
+        self.transcripts = self.corpus.index
+        self.videos = []
+        for doc_id, record in enumerate(self.corpus.records):
+            video = self.Video(record.title, record.stub, description=record.description)
+            video.doc_id = doc_id
+            video.corpus = self.corpus
+            self.videos.append(video)
 
     @staticmethod
     def extract_keywords(query):
@@ -101,16 +106,26 @@ class VideoSearch(Module):
         return keywords
 
     def sort_by_relevance(self, videos, search_string, reverse=False):
-        keywords = self.extract_keywords(search_string)
-        self.log.info(self.class_name, video_keywords=keywords)
+        phrases = extract_phrases(search_string)
+        # the words of a quoted phrase only count together, so they aren't keywords by themselves
+        keywords = self.extract_keywords(RE_PHRASE.sub(" ", search_string))
+        self.log.info(self.class_name, video_keywords=keywords, video_phrases=phrases)
+
+        # transcripts are scored with a single lookup in the positional index, rather than a scan
+        terms = [token for keyword in keywords for token in tokenize(keyword)]
+        transcript_matches = self.transcripts.search(terms, phrases)
 
         for video in videos:
             video.score = 0
-            for keyword in keywords:
+            video.timestamp = None
+            for keyword in keywords + [" ".join(phrase) for phrase in phrases]:
                 keyword = keyword.lower()
                 video.score += 3.0 * video.title.lower().count(keyword) / (len(video.title) + 1)
                 video.score += 1.0 * video.description.lower().count(keyword) / (len(video.description) + 1)
-                video.score += 1.0 * video.text.lower().count(keyword) / (len(video.text) + 1)
+            match = transcript_matches.get(video.doc_id)
+            if match:
+                video.score += 1.0 * match.score
+                video.timestamp = match.seconds
         return sorted(videos, key=(lambda v: v.score), reverse=reverse)
 
     def search(self, query):
@@ -147,14 +162,14 @@ class VideoSearch(Module):
     @staticmethod
     def list_relevant_videos(result):
         video = result[0]
-        video_description = '"%s" %s' % (video.title, video.url)
+        video_description = '"%s" %s' % (video.title, video.link)
 
         reply = "This video seems relevant:\n" + video_description
 
         if len(result) > 1:
             reply += "\nIt could also be:\n"
             for video in result[1:5]:
-                reply += '- "%s" <%s>\n' % (video.title, video.url)
+                reply += '- "%s" <%s>\n' % (video.title, video.link)
 
         return reply
 
@@ -4,9 +4,19 @@ Asks WolframAlpha for the answer
 
 
 import re
-import urllib
+from typing import Optional
+
+import aiohttp
+
 from config import wolfram_token
+from database.result_cache import ResultCache
 from modules.module import Module, Response
+from utilities.http_utils import HttpClient
+
+WOLFRAM_SHORT_ANSWERS_URL = "http://api.wolframalpha.com/v1/result"
+
+# the status the short answers API gives when it doesn't have an answer
+NO_ANSWER_STATUS = 501
 
 
 class Wolfram(Module):
@@ -36,6 +46,9 @@ class Wolfram(Module):
         if not wolfram_token or not text:
             return Response()
 
+        if not HttpClient.get_instance().is_available(WOLFRAM_SHORT_ANSWERS_URL):
+            return Response()
+
         if text.endswith("?"):
             return Response(
                 confidence=5,
@@ -64,13 +77,24 @@ class Wolfram(Module):
         else:
             return 8
 
-    def ask(self, question):
+    async def ask(self, question):
+        async def lookup() -> Optional[str]:
+            try:
+                answer = await HttpClient.get_instance().get_text(
+                    WOLFRAM_SHORT_ANSWERS_URL, params={"appid": wolfram_token, "i": question.strip()}
+                )
+            except aiohttp.ClientResponseError as e:
+                if e.status == NO_ANSWER_STATUS:
+                    return None
+                raise
+            if "olfram" in answer:
+                return None
+            return answer
+
         try:
             self.log.info(self.class_name, wolfram_alpha_question=question)
-            question_escaped = urllib.parse.quote_plus(question.strip())
-            url = "http://api.wolframalpha.com/v1/result?appid=%s&i=%s" % (wolfram_token, question_escaped,)
-            answer = urllib.request.urlopen(url).read().decode("utf-8")
-            if "olfram" not in answer:
+            answer = await ResultCache.get_instance().get_or_fetch("wolfram", question, lookup)
+            if answer:
                 return Response(
                     confidence=self.confidence_of_answer(answer),
                     text=answer,
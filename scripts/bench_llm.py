@@ -0,0 +1,75 @@
+"""
+Load test of the LLM path against the fake OpenAI server (scripts/fake_openai.py), offline
+and without spending anything.
+
+Sends `--requests` questions, spread over `--channels` channels, through the LLMScheduler and
+`OpenAI.get_response` (moderation and completion) all at once, then prints how long they took
+and how the calls went:
+
+    python -m scripts.bench_llm --requests 50 --channels 10 --latency 0.5 --rate-limit-rate 0.1
+"""
+
+import argparse
+import asyncio
+import time
+
+import openai
+
+from api import openai as openai_api
+from api.llm_metrics import LLMMetrics
+from api.llm_scheduler import PRIORITY_DEFAULT, LLMScheduler
+from api.openai import OpenAI
+from api.utilities.openai import OpenAIEngines
+from scripts.fake_openai import FakeOpenAIConfig, FakeOpenAIServer
+
+
+async def ask_all(requests: int, channels: int, engine: OpenAIEngines) -> list:
+    scheduler = LLMScheduler.get_instance()
+    client = OpenAI()
+
+    async def ask(i: int):
+        return await scheduler.submit(
+            f"channel {i % channels}",
+            engine,
+            PRIORITY_DEFAULT,
+            lambda: client.get_response(engine, f"Question number {i}", {}),
+        )
+
+    return await asyncio.gather(*[ask(i) for i in range(requests)])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--engine", default=str(OpenAIEngines.GPT_3_5_TURBO))
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    engine = next(engine for engine in OpenAIEngines if str(engine) == args.engine)
+    config = FakeOpenAIConfig(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    )
+    with FakeOpenAIServer(config) as server:
+        openai.api_base = server.url
+        openai.api_key = "sk-fake"
+        openai_api.OPENAI_MODERATION_URL = f"{server.url}/moderations"
+        start = time.monotonic()
+        replies = asyncio.run(ask_all(args.requests, args.channels, engine))
+        elapsed = time.monotonic() - start
+
+    answered = sum(1 for reply in replies if reply)
+    superseded = sum(1 for reply in replies if reply is None)
+    print(f"{args.requests} requests in {elapsed:.2f}s: {answered} answered, {superseded} superseded")
+    print(f"{len(server.requests)} requests reached the server")
+    print(LLMMetrics.get_instance().summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Micro-benchmark for utilities/sse.py, against the line splitting stampy_chat used to do.
+
+Replays recorded chat.stampy.ai streams (raw response bodies, e.g. saved with
+`curl -N ... > answer.sse`) through both decoders in network-sized chunks:
+
+    python -m scripts.bench_sse answer.sse other_answer.sse
+
+With no files, two synthetic streams are used: a long answer streamed word by word, and
+an answer with a very large citations payload (where the old way rescans the line for
+every chunk).
+"""
+
+import argparse
+import json
+import random
+import timeit
+from typing import Iterable, Iterator
+
+from utilities.sse import SSEDecoder
+
+DATA_HEADER = "data: "
+
+
+def old_stream_lines(stream: Iterable[bytes]) -> Iterator[str]:
+    line = ""
+    for item in stream:
+        line += item.decode("utf8")
+        if "\n" in line:
+            lines = line.split("\n")
+            line = lines[-1]
+            yield from lines[:-1]
+    yield line
+
+
+def old_decode(chunks: list[bytes]) -> list:
+    return [
+        json.loads(line.split(DATA_HEADER)[1])
+        for line in old_stream_lines(chunks)
+        if line.strip().startswith(DATA_HEADER)
+    ]
+
+
+def new_decode(chunks: list[bytes]) -> list:
+    decoder = SSEDecoder()
+    events = [event for chunk in chunks for event in decoder.feed(chunk)]
+    return [event.json() for event in events + decoder.close()]
+
+
+def synthetic_stream(words: int, citation_passages: int) -> bytes:
+    citations = [
+        {
+            "reference": chr(ord("a") + i),
+            "title": f"Some alignment post {i}",
+            "url": f"https://example.com/{i}",
+            "text": "Long quoted passage about corrigibility. " * citation_passages,
+        }
+        for i in range(20)
+    ]
+    items = [{"state": "citations", "citations": citations}]
+    items += [{"state": "streaming", "content": f"word{i} "} for i in range(words)]
+    items += [{"state": "followups", "followups": [{"text": "More", "pageid": "1234"}]}]
+    return "".join(f"data: {json.dumps(item)}\n\n" for item in items).encode("utf-8")
+
+
+def chunked(stream: bytes, seed: int = 0) -> list[bytes]:
+    """Split the stream like a network would, into chunks of a few hundred bytes to a few KB"""
+    rng = random.Random(seed)
+    chunks, i = [], 0
+    while i < len(stream):
+        size = rng.randint(200, 4000)
+        chunks.append(stream[i : i + size])
+        i += size
+    return chunks
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="*", help="raw event streams to replay")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    streams = {path: open(path, "rb").read() for path in args.recordings}
+    if not streams:
+        streams = {
+            "long answer": synthetic_stream(words=3000, citation_passages=200),
+            "big citations": synthetic_stream(words=300, citation_passages=3000),
+        }
+
+    for name, stream in streams.items():
+        chunks = chunked(stream)
+        assert old_decode(chunks) == new_decode(chunks), f"decoders disagree on {name}"
+        print(f"{name}: {len(stream) / 1e6:.2f} MB in {len(chunks)} chunks")
+        for label, decode in [("old", old_decode), ("new", new_decode)]:
+            best = min(timeit.repeat(lambda: decode(chunks), number=1, repeat=args.repeat))
+            print(f"  {label}: {best * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
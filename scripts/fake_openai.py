@@ -0,0 +1,281 @@
+"""
+A stand-in for the OpenAI API, for trying out the LLM path (api/openai.py, GPT3Module and
+ChatGPTModule) without API keys or spend.
+
+Serves chat completions (streamed or not), completions and moderations, answering after a
+set delay and failing (with 500s or 429s) as often as asked. Which requests fail is decided
+by a seeded random number generator, so runs can be repeated exactly.
+
+    python -m scripts.fake_openai --port 8100 --latency 1 --rate-limit-rate 0.1
+    OPENAI_API_BASE=http://127.0.0.1:8100/v1 OPENAI_API_KEY=fake python stam.py
+
+In tests, use FakeOpenAITestCase (test/fake_openai.py), which runs the server in a thread
+and points the openai client at it.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, Optional
+
+from aiohttp import web
+
+# what the moderation endpoint says about texts that aren't flagged
+MODERATION_CATEGORIES = ("hate", "harassment", "self-harm", "sexual", "violence")
+
+# splits a reply into the "tokens" it's streamed in
+RE_TOKEN = re.compile(r"\S+\s*|\s+")
+
+
+@dataclass
+class FakeOpenAIConfig:
+    # seconds before a response starts
+    latency: float = 0.0
+    # seconds between the chunks of a streamed response
+    token_latency: float = 0.0
+    # how often requests fail with a 500, and with a 429
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    # what every completion says
+    reply: str = "Stamps are the most valuable thing in the world."
+    # texts containing any of these are flagged by the moderation endpoint
+    flagged_words: tuple[str, ...] = ("nasty",)
+    seed: int = 0
+
+
+@dataclass
+class FakeRequest:
+    path: str
+    body: dict[str, Any]
+    status: int = 200
+    received: float = field(default_factory=time.monotonic)
+
+
+def count_tokens(text: str) -> int:
+    return len(RE_TOKEN.findall(text))
+
+
+def error_body(status: int) -> dict[str, Any]:
+    if status == 429:
+        return {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}}
+    return {"error": {"message": "The server had an error (fake)", "type": "server_error", "code": None}}
+
+
+class FakeOpenAIServer:
+    def __init__(
+        self, config: Optional[FakeOpenAIConfig] = None, host: str = "127.0.0.1", port: int = 0
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self.app.add_routes(
+            [
+                web.post("/v1/chat/completions", self.chat_completions),
+                web.post("/v1/completions", self.completions),
+                web.post("/v1/moderations", self.moderations),
+            ]
+        )
+        self.reset(config)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.runner: Optional[web.AppRunner] = None
+        self.thread: Optional[threading.Thread] = None
+
+    def reset(self, config: Optional[FakeOpenAIConfig] = None) -> None:
+        """Start over with the new config: forget the requests and any failures still to come"""
+        self.config = config or FakeOpenAIConfig()
+        self.random = random.Random(self.config.seed)
+        self.requests: list[FakeRequest] = []
+        self.forced_failures: deque[int] = deque()
+
+    @property
+    def url(self) -> str:
+        """The API base, e.g. for `openai.api_base`"""
+        return f"http://{self.host}:{self.port}/v1"
+
+    def fail_next(self, status: int, times: int = 1) -> None:
+        """Make the next `times` requests fail with `status` (e.g. 429), whatever the config says"""
+        self.forced_failures.extend([status] * times)
+
+    def requests_to(self, path: str) -> list[FakeRequest]:
+        return [request for request in self.requests if request.path == path]
+
+    # running it
+
+    def start(self) -> None:
+        """Serve from a thread of its own, so it keeps going between `asyncio.run` calls"""
+        ready = threading.Event()
+
+        def serve() -> None:
+            self.loop = asyncio.new_event_loop()
+            self.runner = web.AppRunner(self.app)
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, self.host, self.port)
+            self.loop.run_until_complete(site.start())
+            self.port = self.runner.addresses[0][1]
+            ready.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.runner.cleanup())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=serve, name="fake-openai", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def stop(self) -> None:
+        if self.loop is not None and self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self) -> FakeOpenAIServer:
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    # the endpoints
+
+    async def receive(self, request: web.Request) -> tuple[FakeRequest, Optional[web.Response]]:
+        """Note the request down and wait out the latency. Gives an error response if it should fail."""
+        received = FakeRequest(request.path, await request.json())
+        self.requests.append(received)
+        if self.forced_failures:
+            received.status = self.forced_failures.popleft()
+        else:
+            roll = self.random.random()
+            if roll < self.config.rate_limit_rate:
+                received.status = 429
+            elif roll < self.config.rate_limit_rate + self.config.error_rate:
+                received.status = 500
+        await asyncio.sleep(self.config.latency)
+        if received.status != 200:
+            return received, web.json_response(error_body(received.status), status=received.status)
+        return received, None
+
+    def usage(self, prompt: str) -> dict[str, int]:
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(self.config.reply)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        received, failure = await self.receive(request)
+        if failure is not None:
+            return failure
+        body = received.body
+        header = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model")}
+        if body.get("stream"):
+            deltas = [{"role": "assistant"}]
+            deltas += [{"content": token} for token in RE_TOKEN.findall(self.config.reply)]
+            chunks = [
+                {"index": 0, "delta": delta, "finish_reason": None} for delta in deltas
+            ] + [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+            return await self.stream(
+                request, [{**header, "object": "chat.completion.chunk", "choices": [c]} for c in chunks]
+            )
+        prompt = "\n".join(message.get("content", "") for message in body.get("messages", []))
+        return web.json_response(
+            {
+                **header,
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": self.config.reply},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": self.usage(prompt),
+            }
+        )
+
+    async def completions(self, request: web.Request) -> web.Response:
+        received, failure = await self.receive(request)
+        if failure is not None:
+            return failure
+        body = received.body
+        return web.json_response(
+            {
+                "id": "cmpl-fake",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [
+                    {"index": 0, "text": self.config.reply, "logprobs": None, "finish_reason": "stop"}
+                ],
+                "usage": self.usage(str(body.get("prompt", ""))),
+            }
+        )
+
+    async def moderations(self, request: web.Request) -> web.Response:
+        received, failure = await self.receive(request)
+        if failure is not None:
+            return failure
+        texts = received.body.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+        results = []
+        for text in texts:
+            flagged = any(word in text.lower() for word in self.config.flagged_words)
+            categories = {category: False for category in MODERATION_CATEGORIES}
+            categories["harassment"] = flagged
+            results.append(
+                {
+                    "flagged": flagged,
+                    "categories": categories,
+                    "category_scores": {category: float(value) for category, value in categories.items()},
+                }
+            )
+        return web.json_response({"id": "modr-fake", "model": "text-moderation-fake", "results": results})
+
+    async def stream(self, request: web.Request, chunks: list[dict[str, Any]]) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i, chunk in enumerate(chunks):
+            if i:
+                await asyncio.sleep(self.config.token_latency)
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response starts")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that get a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests that get a 429")
+    parser.add_argument("--reply", default=FakeOpenAIConfig.reply)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = FakeOpenAIConfig(
+        latency=args.latency,
+        token_latency=args.token_latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        reply=args.reply,
+        seed=args.seed,
+    )
+    server = FakeOpenAIServer(config, args.host, args.port)
+    print(f"Fake OpenAI API at {server.url}")
+    web.run_app(server.app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,8 @@ conda deactivate
 conda env remove -n stampy
 conda env create -f environment.yml
 conda activate stampy
+# the language model tokenizers, if they aren't there yet (see api/utilities/tokenizers.py)
+python -m api.utilities.tokenizers || echo "WARNING: couldn't get the tokenizers, the GPT modules will be off"
 mkdir -p ~/stampy.local/logs/
 export log_file=~/stampy.local/logs/stampy-log-$(date +"%F-%T.log")
 ./runstampy > $log_file 2>&1 &
@@ -1,5 +1,4 @@
 import asyncio
-from datetime import datetime, timezone
 import inspect
 import sys
 from textwrap import wrap
@@ -31,8 +30,12 @@ from utilities import (
     get_git_branch_info,
     limit_text,
 )
+from utilities.conversations import ConversationStore
 from utilities.discordutils import DiscordMessage
+from utilities.http_utils import set_message_deadline
+from utilities.periodic import PeriodicScheduler
 from utilities.serviceutils import ServiceChannel
+from utilities.streaming import StreamedText, send_streamed
 
 log = get_logger()
 
@@ -45,6 +48,9 @@ else:
 # Discord messages can be 2000 max, so 20000 allows for 10 max length messages
 discordLimit = 20000
 
+# seconds that all the lookups made to answer a message (including by callbacks) can take, together
+message_deadline = 120
+
 
 # TODO: store long responses temporarily for viewing outside of discord
 def limit_text_and_notify(response: Response, why_traceback: list[str]) -> Union[str, Iterable]:
@@ -54,7 +60,7 @@ def limit_text_and_notify(response: Response, why_traceback: list[str]) -> Union
         if wastrimmed:
             why_traceback.append(f"I had to trim the output from {response.module}")
         return text_to_return
-    elif isinstance(response.text, (list, tuple)):
+    elif isinstance(response.text, (list, tuple, StreamedText)):
         return response.text
     return ""
 
@@ -158,6 +164,7 @@ class DiscordHandler:
                 return None
             #log.info("message channel {} was found in whitelist".format(message.channel.id)) # DEBUG
 
+            set_message_deadline(message_deadline)
             responses = [Response()]
             why_traceback: list[str] = []
             for module in self.modules:
@@ -257,6 +264,8 @@ class DiscordHandler:
                             if self.utils.test_mode:
                                 if is_test_response(message.clean_content):
                                     return  # must return after process message is called so that response can be evaluated
+                                if isinstance(top_response.text, StreamedText):
+                                    top_response.text = "\n".join(await top_response.text.collect())
                                 if is_test_question(message.clean_content):
                                     top_response.text = (
                                         TEST_RESPONSE_PREFIX
@@ -279,6 +288,22 @@ class DiscordHandler:
                                         top_response.text, embed=top_response.embed
                                     )
                                 )
+                            elif isinstance(top_response.text, StreamedText):
+                                # post as soon as there's something to show, and edit in the rest
+                                edited: dict[int, str] = {}
+
+                                async def edit(sent_message: discord.message.Message, text: str) -> None:
+                                    await sent_message.edit(content=text)
+                                    edited[sent_message.id] = text
+
+                                sent += await send_streamed(
+                                    top_response.text, send=message.channel.send, edit=edit
+                                )
+                                # the chat modules stored the messages as they were first posted
+                                for message_id, text in edited.items():
+                                    ConversationStore.get_instance().update(
+                                        message.channel, str(message_id), text
+                                    )
                             elif isinstance(top_response.text, str):
                                 # Discord allows max 2000 characters
                                 chunks = wrap(
@@ -320,40 +345,13 @@ class DiscordHandler:
             why_traceback.append("Detected recursion and killed the response process!")
             log.critical(self.class_name, error="Hit our recursion limit!")
 
-        @self.utils.client.event
-        async def on_socket_raw_receive(_) -> None:
-            """
-            This event fires whenever basically anything at all happens.
-            Anyone joining, leaving, sending anything, even typing and not sending...
-            So I'm going to use it as a kind of 'update' or 'tick' function,
-            for things the bot needs to do regularly. Yes this is hacky.
-            Rate limit these things, because this function might be firing a lot
-            """
-            # die if needed
-            if self.utils.stop.is_set():
-                exit()
-
-            # keep the log file fresh
-            sys.stdout.flush()
-
-            # give all the modules a chance to do things
-            for module in self.modules:
-                await module.tick()
-
-            # never fire more than once a second
-            if self.utils.rate_limit("on_socket_raw_receive", seconds=1):
-                return
-
-            # this is needed for later checks, which should all be replaced with rate_limit calls (TODO)
-            now = datetime.now(timezone.utc)
-
-            if youtube_api:
-                # check for new youtube comments
-                new_comments = youtube_api.check_for_new_youtube_comments()
-                if new_comments:
-                    for comment in new_comments:
-                        if "?" in comment["text"]:
-                            youtube_api.add_youtube_question(comment)
+        scheduler = PeriodicScheduler.get_instance()
+        scheduler.register("check for stop", self.check_for_stop, interval=1)
+        # keep the log file fresh
+        scheduler.register("flush stdout", self.flush_stdout, interval=5)
+        if youtube_api:
+            # only hits the API once the comment check's cooldown is up, which grows while it's quiet
+            scheduler.register("poll youtube comments", youtube_api.poll_comments, interval=30, jitter=5)
 
         @self.utils.client.event
         async def on_raw_reaction_add(
@@ -383,6 +381,23 @@ class DiscordHandler:
             for module in self.modules:
                 await module.process_raw_reaction_event(payload)
 
+    async def check_for_stop(self) -> None:
+        if self.utils.stop.is_set():
+            exit()
+
+    async def flush_stdout(self) -> None:
+        sys.stdout.flush()
+
+    async def consume_youtube_comments(self) -> None:
+        comments = youtube_api.subscribe()
+        while True:
+            comment = await comments.get()
+            try:
+                if "?" in comment["text"]:
+                    youtube_api.add_youtube_question(comment)
+            except Exception as e:
+                await self.utils.log_exception(e, problem_source="YouTube comment")
+
     def start(self, event: threading.Event) -> threading.Thread:
         try:
             # This line is deprecated in 3.10, but doesn't work otherwise.
@@ -391,6 +406,9 @@ class DiscordHandler:
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
         loop.create_task(self.utils.client.start(discord_token))
+        PeriodicScheduler.get_instance().start(loop)
+        if youtube_api:
+            loop.create_task(self.consume_youtube_comments())
         t = threading.Thread(target=loop.run_forever)
         t.name = "Discord Thread"
         t.start()
@@ -1,5 +1,6 @@
 from flask import Response as FlaskResponse
 from collections.abc import Iterable
+from api.llm_metrics import LLMMetrics
 from config import TEST_RESPONSE_PREFIX, maximum_recursion_depth, flask_port, flask_address
 from flask import Flask, request
 from modules.module import Response
@@ -13,6 +14,8 @@ from utilities import (
     get_question_id,
 )
 from utilities.flaskutils import FlaskMessage, FlaskUtilities
+from utilities.periodic import PeriodicScheduler
+from utilities.streaming import StreamedText, iter_blocking
 import asyncio
 import inspect
 import json
@@ -63,6 +66,19 @@ class FlaskHandler(threading.Thread):
     def process_list_modules(self) -> FlaskResponse:
         return FlaskResponse(json.dumps(list(self.modules.keys())))
 
+    def process_stats(self) -> FlaskResponse:
+        """How the calls to the language models (api/llm_metrics.py) and the periodic jobs
+        (utilities/periodic.py) are going"""
+        return FlaskResponse(
+            json.dumps(
+                {
+                    "llm": LLMMetrics.get_instance().as_dict(),
+                    "periodic": PeriodicScheduler.get_instance().as_dict(),
+                }
+            ),
+            mimetype="application/json",
+        )
+
     def _module_responses(self, message):
         if message.modules is None:
             message.modules = list(self.modules.keys())
@@ -144,7 +160,12 @@ class FlaskHandler(threading.Thread):
             else:
                 if top_response:
                     log.info(class_name, top_response=top_response.text)
-                    if isinstance(top_response.text, str):
+                    if isinstance(top_response.text, StreamedText):
+                        # send the text as it's written, rather than waiting for all of it
+                        ret = FlaskResponse(
+                            iter_blocking(top_response.text), 200, mimetype="text/plain"
+                        )
+                    elif isinstance(top_response.text, str):
                         ret = FlaskResponse(top_response.text, 200)
                     elif isinstance(top_response.text, Iterable):
                         builder = ""
@@ -169,6 +190,7 @@ class FlaskHandler(threading.Thread):
         app.add_url_rule(
             "/list_modules", view_func=self.process_list_modules, methods=["GET"]
         )
+        app.add_url_rule("/stats", view_func=self.process_stats, methods=["GET"])
         app.run(host=flask_address, port=flask_port)
 
     def stop(self):
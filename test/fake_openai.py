@@ -0,0 +1,44 @@
+from collections import OrderedDict
+from unittest import TestCase
+from unittest.mock import patch
+
+import openai
+
+from api import openai as openai_api
+from api.llm_metrics import LLMMetrics
+from api.llm_scheduler import LLMScheduler
+from api.openai import OpenAI
+from scripts.fake_openai import FakeOpenAIConfig, FakeOpenAIServer
+
+
+class FakeOpenAITestCase(TestCase):
+    """Runs a FakeOpenAIServer while the tests run, and points the openai client at it.
+
+    Each test starts with a fresh server config (`self.fake_openai.reset(...)` to change it),
+    no remembered moderation verdicts and its own LLMScheduler and LLMMetrics.
+    """
+
+    fake_openai: FakeOpenAIServer
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_openai = FakeOpenAIServer()
+        cls.fake_openai.start()
+        cls.addClassCleanup(cls.fake_openai.stop)
+
+    def setUp(self):
+        super().setUp()
+        self.fake_openai.reset(FakeOpenAIConfig())
+        self.metrics = LLMMetrics()
+        for patcher in [
+            patch.object(openai, "api_base", self.fake_openai.url),
+            patch.object(openai, "api_key", "sk-fake"),
+            patch.object(openai_api, "OPENAI_MODERATION_URL", f"{self.fake_openai.url}/moderations"),
+            patch.object(OpenAI, "verdicts", OrderedDict()),
+            patch.object(LLMScheduler, "get_instance", lambda: self.scheduler),
+            patch.object(LLMMetrics, "get_instance", lambda: self.metrics),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.scheduler = LLMScheduler()
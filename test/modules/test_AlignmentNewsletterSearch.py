@@ -0,0 +1,274 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+import os
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from typing import Optional
+from unittest import TestCase
+from unittest.mock import AsyncMock, patch
+import zipfile
+
+import aiohttp
+
+from modules import AlignmentNewsletterSearch as newsletter
+from modules.AlignmentNewsletterSearch import AlignmentNewsletterSearch, Item, NewsletterIndex
+
+# a cut down export of the spreadsheet, laid out the way google sheets does it
+DATABASE_HTML = (
+    '<html><head><meta http-equiv="content-type" content="text/html; charset=UTF-8"></head>'
+    '<body><div class="ritz grid-container" dir="ltr"><table class="waffle" cellspacing="0" cellpadding="0">'
+    '<thead><tr><th class="row-header freezebar-origin-ltr"></th><th id="0C0" class="column-headers-background">A</th></tr></thead>'
+    "<tbody>"
+    '<tr style="height: 20px"><th class="row-headers-background">1</th><td>Category</td><td>Highlight</td>'
+    "<td>Title</td><td>Authors</td><td>Venue</td><td>Year</td><td>H/T</td><td>Email</td><td>Summary</td><td>Opinion</td></tr>"
+    '<tr><th class="freezebar-cell"></th><td class="freezebar-cell"></td></tr>'
+    '<tr style="height: 20px"><th class="row-headers-background">3</th><td>Learning human intent</td><td>Highlight</td>'
+    '<td><a target="_blank" href="https://arxiv.org/abs/1706.03741">Deep RL from Human Preferences</a></td>'
+    "<td>Paul Christiano, Jan Leike</td><td>NeurIPS</td><td>2017</td><td></td><td>AN #1</td>"
+    "<td>Learns a <b>reward model</b> from comparisons.<br>Then optimises it &amp; repeats.</td>"
+    "<td>Café-grade results — promising.</td></tr>"
+    '<tr style="height: 20px"><th class="row-headers-background">4</th><td>Interpretability</td><td></td>'
+    "<td>[Zoom In: An Introduction to Circuits](https://distill.pub/2020/circuits/zoom-in/)</td>"
+    "<td>Chris Olah</td><td>Distill</td><td>2020</td><td></td><td>AN #92</td><td>Neurons and circuits.</td><td></td></tr>"
+    '<tr style="height: 20px"><th class="row-headers-background">5</th><td>Miscellaneous</td><td></td>'
+    "<td></td><td>Nobody</td><td></td><td></td><td></td><td></td><td>Row with no title.</td><td></td></tr>"
+    '<tr style="height: 20px"><th class="row-headers-background">6</th><td>Miscellaneous</td><td></td>'
+    "<td>A title without a link</td><td>Somebody</td><td></td><td></td><td></td><td></td><td>Skipped.</td><td></td></tr>"
+    '<tr style="height: 20px"><th class="row-headers-background">7</th><td>Agent foundations</td><td>Highlight</td>'
+    '<td><a href="https://intelligence.org/embedded-agency/"><i>Embedded</i> Agency</a></td>'
+    "<td>Abram Demski, Scott Garrabrant</td><td></td><td>2018</td><td></td><td>AN #31</td>"
+    "<td>Agents that are part of their environment.</td><td>Read it.</td></tr>"
+    "</tbody></table></div></body></html>"
+)
+
+# what the parser that loaded the whole document with etree.HTML made of it
+OLD_PARSER_ITEMS = [
+    Item(
+        "Learning human intent",
+        True,
+        "https://arxiv.org/abs/1706.03741",
+        "Deep RL from Human Preferences",
+        "Paul Christiano, Jan Leike",
+        "Learns a reward model from comparisons.Then optimises it & repeats.",
+        "Café-grade results — promising.",
+    ),
+    Item(
+        "Interpretability",
+        False,
+        "https://distill.pub/2020/circuits/zoom-in/",
+        "Zoom In: An Introduction to Circuits",
+        "Chris Olah",
+        "Neurons and circuits.",
+        "",
+    ),
+    # the title is only the link's own text, which is empty when it starts with a tag
+    Item(
+        "Agent foundations",
+        True,
+        "https://intelligence.org/embedded-agency/",
+        "",
+        "Abram Demski, Scott Garrabrant",
+        "Agents that are part of their environment.",
+        "Read it.",
+    ),
+]
+
+
+HEADER_ROWS = "<tr><th></th><td>Category</td><td>Highlight</td><td>Title</td></tr><tr><td></td></tr>"
+
+
+def row(title, url="https://example.com", summary="", highlight=False, authors="", opinion=""):
+    cells = [
+        "",
+        "Category",
+        "Highlight" if highlight else "",
+        f'<a href="{url}">{title}</a>',
+        authors,
+        "",
+        "",
+        "",
+        "",
+        summary,
+        opinion,
+    ]
+    return "<tr>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>"
+
+
+def zipped_database(*rows, html=None):
+    """The spreadsheet as google sheets exports it: a zip holding Database.html"""
+    if html is None:
+        html = f"<html><body><table><tbody>{HEADER_ROWS}{''.join(rows)}</tbody></table></body></html>"
+    zipped = BytesIO()
+    with zipfile.ZipFile(zipped, "w") as zip_file:
+        zip_file.writestr("Database.html", html)
+    return zipped.getvalue()
+
+
+def response(status=200, body=b"", headers=None):
+    return SimpleNamespace(status=status, headers=headers or {}, read=AsyncMock(return_value=body))
+
+
+def item(title, summary="", highlight=False):
+    return Item("Category", highlight, f"https://example.com/{title}", title, "", summary, "")
+
+
+class FakeHttpClient:
+    """Answers each request with the next of `responses`, raising it if it's an exception"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.headers = []
+        # set to hold the responses back until the test is ready for them
+        self.hold: Optional[asyncio.Event] = None
+
+    @asynccontextmanager
+    async def request(self, method, url, headers=None, **kwargs):
+        self.headers.append(headers or {})
+        if self.hold is not None:
+            await self.hold.wait()
+        next_response = self.responses.pop(0)
+        if isinstance(next_response, Exception):
+            raise next_response
+        yield next_response
+
+
+class TestParseItems(TestCase):
+    def test_parses_the_export_like_the_old_parser(self):
+        items = AlignmentNewsletterSearch.parse_items(zipped_database(html=DATABASE_HTML))
+        self.assertEqual(items, OLD_PARSER_ITEMS)
+
+    def test_many_rows(self):
+        # rows are thrown away as they're parsed, which mustn't lose any of the later ones
+        rows = [row(f"Paper {i}", summary=f"summary {i}", highlight=i % 2 == 0) for i in range(500)]
+        items = AlignmentNewsletterSearch.parse_items(zipped_database(*rows))
+        self.assertEqual([item.title for item in items], [f"Paper {i}" for i in range(500)])
+        self.assertEqual(items[-1].summary, "summary 499")
+        self.assertFalse(items[-1].is_highlight)
+
+
+class TestNewsletterIndex(TestCase):
+    def setUp(self):
+        self.index = NewsletterIndex(
+            [
+                item("Cooking", "recipes for soup"),
+                item("Reward hacking", "agents that game their reward"),
+                item("Survey", "a survey touching on reward, among many many other things"),
+                item("Corrigibility", "agents that let you switch them off"),
+            ]
+        )
+
+    def titles(self, keywords, limit=5):
+        return [result.title for result in self.index.top_items(keywords, limit)]
+
+    def test_best_matches_come_first(self):
+        self.assertEqual(self.titles(["reward", "hacking"]), ["Reward hacking", "Survey"])
+        self.assertEqual(self.titles(["soup"]), ["Cooking"])
+        self.assertEqual(self.titles(["reward", "hacking"], limit=1), ["Reward hacking"])
+
+    def test_results_have_their_scores(self):
+        results = self.index.top_items(["reward"], 5)
+        self.assertTrue(all(result.score > 0 for result in results))
+        self.assertEqual([r.score for r in results], sorted([r.score for r in results], reverse=True))
+        self.assertEqual(self.index.items[1].score, 0.0)
+
+    def test_highlights_are_boosted(self):
+        plain = NewsletterIndex([item("Agents A", "reward"), item("Agents B", "reward")])
+        highlighted = NewsletterIndex([item("Agents A", "reward"), item("Agents B", "reward", highlight=True)])
+        [a, b] = plain.top_items(["reward"], 5)
+        self.assertAlmostEqual(a.score, b.score)
+        [best, other] = highlighted.top_items(["reward"], 5)
+        self.assertEqual(best.title, "Agents B")
+        self.assertAlmostEqual(best.score, other.score * newsletter.HIGHLIGHT_WEIGHT)
+
+    def test_nothing_to_match(self):
+        for keywords in [[], ["unheardof", "words"], ["!!!"]]:
+            with self.subTest(keywords=keywords):
+                self.assertEqual(self.index.top_items(keywords, 5), [])
+        self.assertEqual(NewsletterIndex([]).top_items(["reward"], 5), [])
+
+
+class TestNewsletterCache(TestCase):
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache_path = os.path.join(tmp.name, "alignment_newsletter.json")
+        self.http = FakeHttpClient()
+        for patcher in [
+            patch.object(newsletter, "CACHE_PATH", self.cache_path),
+            patch.object(newsletter.HttpClient, "get_instance", lambda: self.http),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.module = AlignmentNewsletterSearch()
+
+    def titles(self, index):
+        return [item.title for item in index.items]
+
+    def test_first_search_waits_for_the_download(self):
+        self.http.responses = [response(body=zipped_database(row("Stamps")), headers={"ETag": "v1"})]
+        index = asyncio.run(self.module.get_index())
+        self.assertEqual(self.titles(index), ["Stamps"])
+        self.assertEqual(self.http.headers, [{}])
+
+        # and a restart carries on from the saved copy, without downloading it again
+        reloaded = AlignmentNewsletterSearch()
+        self.assertEqual((self.titles(reloaded.index), reloaded.etag), (["Stamps"], "v1"))
+        self.assertFalse(reloaded.is_stale())
+
+    def test_failed_download_is_only_retried_after_the_retry_interval(self):
+        self.http.responses = [aiohttp.ClientError("down"), aiohttp.ClientError("still down")]
+
+        async def search_twice():
+            first = await self.module.get_index()
+            second = await self.module.get_index()
+            return first, second
+
+        self.assertEqual([len(index) for index in asyncio.run(search_twice())], [0, 0])
+        self.assertEqual(len(self.http.headers), 1)
+        self.assertGreater(
+            self.module.next_refresh_at,
+            datetime.now(timezone.utc) + newsletter.CACHE_RETRY_INTERVAL - timedelta(minutes=1),
+        )
+
+        self.module.next_refresh_at = datetime.now(timezone.utc)
+        asyncio.run(self.module.get_index())
+        self.assertEqual(len(self.http.headers), 2)
+
+    def test_stale_items_are_searched_while_refreshing(self):
+        self.http.responses = [response(body=zipped_database(row("Old")))]
+        asyncio.run(self.module.get_index())
+        self.module.next_refresh_at = datetime.now(timezone.utc)
+        self.http.responses = [response(body=zipped_database(row("New")))]
+
+        async def search_during_refresh():
+            self.http.hold = asyncio.Event()
+            during = self.titles(await self.module.get_index())
+            self.http.hold.set()
+            await self.module.refresh_task
+            return during, self.titles(await self.module.get_index())
+
+        self.assertEqual(asyncio.run(search_during_refresh()), (["Old"], ["New"]))
+        self.assertFalse(self.module.is_stale())
+
+    def test_unchanged_database_is_not_downloaded_again(self):
+        headers = {"ETag": "v1", "Last-Modified": "Mon, 19 Oct 2026 00:00:00 GMT"}
+        self.http.responses = [response(body=zipped_database(row("Stamps")), headers=headers)]
+        asyncio.run(self.module.get_index())
+        self.module.next_refresh_at = datetime.now(timezone.utc)
+        not_modified = response(status=304)
+        self.http.responses = [not_modified]
+
+        async def refresh():
+            await self.module.get_index()
+            await self.module.refresh_task
+
+        asyncio.run(refresh())
+        self.assertEqual(
+            self.http.headers[-1],
+            {"If-None-Match": "v1", "If-Modified-Since": "Mon, 19 Oct 2026 00:00:00 GMT"},
+        )
+        not_modified.read.assert_not_called()
+        self.assertEqual((self.titles(self.module.index), self.module.etag), (["Stamps"], "v1"))
+        self.assertFalse(self.module.is_stale())
@@ -0,0 +1,128 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import openai
+
+from api.llm_metrics import LLMMetrics
+from api.llm_scheduler import LLMScheduler
+from api.utilities.openai import OpenAIEngines
+from modules import chatgpt
+from modules.chatgpt import ChatGPTModule
+from servicemodules.serviceConstants import Services
+from utilities.serviceutils import ServiceChannel, ServiceMessage, ServiceUser
+from utilities.streaming import StreamedText
+
+
+def chunk(content):
+    return SimpleNamespace(choices=[SimpleNamespace(delta={"content": content})])
+
+
+class TestStreamChatCompletion(TestCase):
+    def setUp(self):
+        self.chatgpt = ChatGPTModule()
+        self.message = ServiceMessage(
+            "1",
+            "hi stampy",
+            ServiceUser("author", "author", "123"),
+            ServiceChannel("channel", "456", None),
+            Services.DISCORD,
+        )
+        patcher = patch.object(self.chatgpt, "generate_messages_list", lambda channel, engine: [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(LLMScheduler, "get_instance", lambda: LLMScheduler())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.metrics = LLMMetrics()
+        patcher = patch.object(LLMMetrics, "get_instance", lambda: self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_acreate(self, *parts, error=None):
+        self.requests = []
+
+        async def acreate(**kwargs):
+            self.requests.append(kwargs)
+
+            async def chunks():
+                for part in parts:
+                    yield chunk(part)
+                if error is not None:
+                    raise error
+
+            return chunks()
+
+        return patch.object(chatgpt.openai.ChatCompletion, "acreate", acreate)
+
+    def stream(self, *parts, error=None):
+        async def collect():
+            deltas = self.chatgpt.stream_chat_completion(self.message, OpenAIEngines.GPT_4)
+            return [delta async for delta in deltas]
+
+        with self.fake_acreate(*parts, error=error):
+            return asyncio.run(collect())
+
+    def chat(self, *parts, error=None):
+        """What chatgpt_chat responds with, and the whole text of the reply if it streams one"""
+        self.chatgpt.openai = MagicMock(is_text_risky=AsyncMock(return_value=False))
+        self.chatgpt.openai.get_engine.return_value = OpenAIEngines.GPT_4
+
+        async def respond():
+            response = await self.chatgpt.chatgpt_chat(self.message)
+            if isinstance(response.text, StreamedText):
+                return response, "".join([delta async for delta in response.text])
+            return response, None
+
+        with self.fake_acreate(*parts, error=error):
+            return asyncio.run(respond())
+
+    def test_streams_deltas(self):
+        deltas = self.stream("Stamps", " are great. ", "I collect them all. ", "The end.", " Bye.")
+        self.assertEqual(deltas, ["Stamps are great. I collect them all. ", "The end.", " Bye."])
+        self.assertTrue(self.requests[0]["stream"])
+
+    def test_drops_stampy_says(self):
+        deltas = self.stream("Stampy", " says:", " Hello", " there, how are you doing today?")
+        self.assertEqual("".join(deltas), "Hello there, how are you doing today?")
+
+    def test_short_answers_are_kept(self):
+        self.assertEqual(self.stream("Yes", "."), ["Yes."])
+
+    def test_errors_partway_through_end_the_stream(self):
+        for error, counted in [
+            (openai.error.RateLimitError("slow down"), "rate_limited"),
+            (openai.error.APIError("bad gateway"), "errors"),
+            (openai.error.AuthenticationError("who are you"), "errors"),
+        ]:
+            self.metrics = LLMMetrics()
+            deltas = self.stream("Stamps are great, ", "I collect them all. ", "And", error=error)
+            self.assertEqual("".join(deltas), "Stamps are great, I collect them all. And")
+            stats = self.metrics.get("completion", OpenAIEngines.GPT_4)
+            self.assertEqual(getattr(stats, counted), 1, error)
+
+    def test_claims_the_message_once_there_is_an_answer(self):
+        response, text = self.chat("Stamps", " are great. ", "I collect them all.")
+        self.assertEqual(response.confidence, 10)
+        self.assertEqual(text, "Stamps are great. I collect them all.")
+
+    def test_leaves_the_message_to_others_without_an_answer(self):
+        for parts, error in [((), None), (("  ",), None), ((), openai.error.APIError("bad gateway"))]:
+            with self.subTest(parts=parts, error=error):
+                response, _ = self.chat(*parts, error=error)
+                self.assertFalse(response)
+
+    def test_superseded_messages_are_still_claimed(self):
+        @asynccontextmanager
+        async def turn(*args):
+            yield False
+
+        scheduler = LLMScheduler()
+        with patch.object(LLMScheduler, "get_instance", lambda: scheduler), patch.object(
+            scheduler, "turn", turn
+        ):
+            response, text = self.chat("Stamps are great.")
+        self.assertEqual((response.confidence, text), (10, None))
+        self.assertEqual(self.requests, [])
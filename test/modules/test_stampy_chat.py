@@ -0,0 +1,124 @@
+import asyncio
+import json
+import os
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import AsyncMock, patch
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from database.result_cache import ResultCache
+from modules import stampy_chat
+from modules.stampy_chat import INTERRUPTED_NOTE, StampyChat, prefetch_nlp_search
+from servicemodules.serviceConstants import Services, italicise
+from utilities import streaming
+from utilities.http_utils import HttpClient
+from utilities.serviceutils import ServiceChannel, ServiceMessage, ServiceUser
+
+ANSWER = {
+    "score": 0.9,
+    "status": "Live on site",
+    "url": "https://aisafety.info/?state=6568",
+    "title": "What is AGI?",
+}
+
+
+def chat_event(content):
+    return f"data: {json.dumps({'state': 'streaming', 'content': content})}\n\n".encode()
+
+
+def discord_message():
+    return ServiceMessage(
+        "1",
+        "stampy, what are stamps?",
+        ServiceUser("author", "author", "123"),
+        ServiceChannel("channel", "456", None),
+        Services.DISCORD,
+    )
+
+
+class TestNLPSearch(TestCase):
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        cache = ResultCache(os.path.join(tmp_dir.name, "cache.db"))
+        self.http = SimpleNamespace(get_json=AsyncMock(return_value=[ANSWER]))
+        for patcher in [
+            patch.object(stampy_chat.ResultCache, "get_instance", lambda: cache),
+            patch.object(stampy_chat.HttpClient, "get_instance", lambda: self.http),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.message = discord_message()
+
+    def test_check_uses_the_prefetched_search(self):
+        async def search():
+            prefetched = prefetch_nlp_search("what is agi?")
+            return await StampyChat().check_nlp_search("what is agi?", [], self.message, prefetched)
+
+        response = asyncio.run(search())
+        self.assertEqual(response.text, f"Check out {ANSWER['url']} ({ANSWER['title']})")
+        self.http.get_json.assert_awaited_once()
+
+    def test_unexpected_replies_dont_break_the_prefetch(self):
+        for failure in [json.JSONDecodeError("Expecting value", "", 0), None]:
+            with self.subTest(failure=failure):
+                if failure is None:
+                    # JSON, but not a list of results
+                    self.http.get_json = AsyncMock(return_value={"detail": "Not found"})
+                else:
+                    self.http.get_json = AsyncMock(side_effect=failure)
+
+                async def prefetch():
+                    prefetched = prefetch_nlp_search(f"what is {failure}?")
+                    await asyncio.wait([prefetched])
+                    return prefetched
+
+                prefetched = asyncio.run(prefetch())
+                self.assertIsNone(prefetched.exception())
+                self.assertEqual(prefetched.result(), {})
+
+
+class TestStreamedAnswer(TestCase):
+    def setUp(self):
+        patcher = patch.object(streaming, "EDIT_INTERVAL", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dropped_connection_ends_the_answer(self):
+        async def chat(request):
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            await response.write(chat_event("Stamps are great. "))
+            await response.write(chat_event("They are"))
+            # hang up partway through the answer
+            request.transport.close()
+            return response
+
+        messages = []
+
+        async def send(text):
+            messages.append(text)
+            return len(messages) - 1
+
+        async def edit(index, text):
+            messages[index] = text
+
+        async def answer():
+            app = web.Application()
+            app.router.add_post("/chat", chat)
+            async with TestServer(app) as server:
+                with patch.object(stampy_chat, "STAMPY_CHAT_ENDPOINT", str(server.make_url("/chat"))):
+                    streamed = StampyChat().stream_chat_text("what are stamps?", [], message)
+                    try:
+                        await streaming.send_streamed(streamed, send, edit)
+                    finally:
+                        await HttpClient.get_instance().close()
+
+        message = discord_message()
+        asyncio.run(answer())
+        self.assertEqual(
+            messages, [italicise("Stamps are great. They are" + INTERRUPTED_NOTE, message)]
+        )
@@ -0,0 +1,51 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from database.transcripts import TranscriptCorpus
+from modules import videosearch
+from modules.videosearch import VideoSearch
+from test.test_transcripts import write_video
+
+
+class TestVideoSearch(TestCase):
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        subs_dir = tmp_dir.name
+        write_video(
+            subs_dir,
+            "Corrigibility",
+            "3TYT1QfdfsM",
+            [(1, "hi"), (20, "what happens when you press the stop button"), (40, "it stops")],
+        )
+        write_video(
+            subs_dir,
+            "Elevator Pitch",
+            "pYXy-A4siMw",
+            [(2, "press the button"), (50, "and the lift will stop")],
+        )
+        corpus = TranscriptCorpus.build(subs_dir)
+        with patch.object(videosearch.TranscriptCorpus, "load_or_build", lambda *args: corpus):
+            self.search = VideoSearch()
+
+    def results(self, query):
+        return [(video.title, video.timestamp) for video in self.search.search(query)]
+
+    def test_phrases_only_match_consecutive_words(self):
+        self.assertEqual(self.results('"stop button"'), [("Corrigibility", 20)])
+
+    def test_words_match_anywhere(self):
+        self.assertEqual(
+            {title for title, _ in self.results("stop button")}, {"Corrigibility", "Elevator Pitch"}
+        )
+
+    def test_phrases_and_words_together(self):
+        results = self.search.sort_by_relevance(self.search.videos, 'lift "stop button"', reverse=True)
+        self.assertEqual(
+            [(video.title, video.timestamp) for video in results],
+            # the elevator only matches "lift", as its "stop" and "button" aren't together
+            [("Corrigibility", 20), ("Elevator Pitch", 50)],
+        )
+        self.assertGreater(results[1].score, 0)
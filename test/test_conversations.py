@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from utilities.conversations import ConversationStore
+from utilities.utilities import Utilities
+
+
+def channel(id):
+    return SimpleNamespace(id=id)
+
+
+def message(id, text, channel):
+    author = SimpleNamespace(id="author", name="name", display_name="name")
+    return SimpleNamespace(
+        id=id, content=text, clean_content=text, channel=channel, author=author, service=None
+    )
+
+
+class TestConversationStore(TestCase):
+    def setUp(self):
+        patcher = patch.object(
+            Utilities.get_instance(), "stampy_is_author", lambda message: False
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = ConversationStore(history=3, max_channels=2, max_chars=100)
+
+    def ids(self, channel):
+        return [record.id for record in self.store.history(channel)]
+
+    def test_keeps_the_last_messages_of_each_channel(self):
+        for i in range(5):
+            self.store.add(message(str(i), "hi", channel("a")))
+        self.assertEqual(self.ids(channel("a")), ["2", "3", "4"])
+        self.assertEqual([r.id for r in self.store.history(channel("a"), 2)], ["3", "4"])
+        self.assertEqual(self.store.chars, 12)
+
+    def test_each_message_is_stored_once(self):
+        first = self.store.add(message("1", "hi", channel("a")))
+        self.assertIs(self.store.add(message("1", "hi", channel("a"))), first)
+        self.assertEqual(self.ids(channel("a")), ["1"])
+
+    def test_forgets_least_recently_active_channels(self):
+        self.store.add(message("1", "hi", channel("a")))
+        self.store.add(message("2", "hi", channel("b")))
+        self.store.add(message("3", "hi", channel("a")))
+        self.store.add(message("4", "hi", channel("c")))
+        self.assertEqual(self.ids(channel("b")), [])
+        self.assertEqual(self.ids(channel("a")), ["1", "3"])
+
+    def test_forgets_channels_when_there_is_too_much_text(self):
+        self.store.add(message("1", "x" * 30, channel("a")))
+        self.store.add(message("2", "x" * 30, channel("b")))
+        self.assertEqual(self.ids(channel("a")), [])
+        self.assertEqual(self.store.chars, 60)
+
+    def test_records_dont_keep_the_message(self):
+        record = self.store.add(message("1", "hi", channel("a")))
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertEqual((record.author_name, record.clean_content), ("name", "hi"))
+
+    def test_updating_a_message_replaces_its_text_and_memo(self):
+        record = self.store.add(message("1", "Stamps are", channel("a")))
+        record.memo["tokens"] = 3
+        self.assertIs(self.store.update(channel("a"), "1", "Stamps are great."), record)
+        self.assertEqual((record.content, record.clean_content), ("Stamps are great.",) * 2)
+        self.assertEqual(record.memo, {})
+        self.assertEqual(self.store.chars, 34)
+
+    def test_edits_to_messages_not_yet_added_are_used_when_they_are(self):
+        self.assertIsNone(self.store.update(channel("a"), "1", "Stamps are great."))
+        record = self.store.add(message("1", "Stamps are", channel("a")))
+        self.assertEqual(record.clean_content, "Stamps are great.")
+        self.assertEqual(self.store.chars, 34)
+        self.assertEqual(self.store.pending_edits, {})
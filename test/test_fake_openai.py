@@ -0,0 +1,95 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, patch
+
+from api import openai as openai_api
+from api.openai import OpenAI, OpenAIEngines
+from modules.chatgpt import ChatGPTModule
+from scripts.fake_openai import FakeOpenAIConfig
+from servicemodules.serviceConstants import Services
+from test.fake_openai import FakeOpenAITestCase
+from utilities.serviceutils import ServiceChannel, ServiceMessage, ServiceUser
+
+REPLY = FakeOpenAIConfig.reply.strip(".")
+
+
+class TestOpenAIAgainstFakeServer(FakeOpenAITestCase):
+    def setUp(self):
+        super().setUp()
+        for target, value in [
+            ("disable_prompt_moderation", False),
+            ("use_helicone", False),
+            ("COMPLETION_TIMEOUT", 0.3),
+        ]:
+            patcher = patch.object(openai_api, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for method in ["log_error", "log_exception"]:
+            patcher = patch.object(openai_api.utils, method, AsyncMock())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ask(self, prompt="What are stamps?"):
+        return asyncio.run(OpenAI().get_response(OpenAIEngines.GPT_3_5_TURBO, prompt, {}))
+
+    def test_moderates_then_completes(self):
+        self.assertEqual(self.ask(), REPLY)
+        self.assertEqual(
+            [request.path for request in self.fake_openai.requests],
+            ["/v1/moderations", "/v1/chat/completions"],
+        )
+        stats = self.metrics.get("completion", OpenAIEngines.GPT_3_5_TURBO)
+        self.assertEqual((stats.calls, stats.prompt_tokens), (1, 3))
+
+    def test_risky_prompt_is_not_sent(self):
+        self.assertEqual(self.ask("something nasty"), "")
+        self.assertEqual(self.fake_openai.requests_to("/v1/chat/completions"), [])
+
+    def test_rate_limit(self):
+        self.fake_openai.fail_next(429)
+        with patch.object(openai_api, "disable_prompt_moderation", True):
+            self.assertEqual(self.ask(), "")
+        self.assertEqual(self.metrics.get("completion", OpenAIEngines.GPT_3_5_TURBO).rate_limited, 1)
+
+    def test_slow_server_times_out(self):
+        self.fake_openai.reset(FakeOpenAIConfig(latency=1))
+        with patch.object(openai_api, "disable_prompt_moderation", True):
+            self.assertEqual(self.ask(), "")
+        self.assertEqual(self.metrics.get("completion", OpenAIEngines.GPT_3_5_TURBO).timeouts, 1)
+
+    def test_requests_run_concurrently(self):
+        self.fake_openai.reset(FakeOpenAIConfig(latency=0.1))
+
+        async def ask_all():
+            return await asyncio.gather(
+                *[OpenAI().get_response(OpenAIEngines.GPT_3_5_TURBO, f"question {i}", {}) for i in range(5)]
+            )
+
+        start = time.monotonic()
+        self.assertEqual(asyncio.run(ask_all()), [REPLY] * 5)
+        # moderation then completion, each taking 0.1s, rather than 5 of each in a row
+        self.assertLess(time.monotonic() - start, 0.6)
+
+
+class TestChatGPTAgainstFakeServer(FakeOpenAITestCase):
+    def test_streams_the_reply(self):
+        self.fake_openai.reset(FakeOpenAIConfig(token_latency=0.01))
+        chatgpt = ChatGPTModule()
+        message = ServiceMessage(
+            "1",
+            "hi stampy",
+            ServiceUser("author", "author", "123"),
+            ServiceChannel("channel", "456", None),
+            Services.DISCORD,
+        )
+
+        async def collect():
+            deltas = chatgpt.stream_chat_completion(message, OpenAIEngines.GPT_4)
+            return [delta async for delta in deltas]
+
+        with patch.object(chatgpt, "generate_messages_list", lambda channel, engine: []):
+            deltas = asyncio.run(collect())
+        self.assertEqual("".join(deltas), FakeOpenAIConfig.reply)
+        self.assertGreater(len(deltas), 1)
+        [request] = self.fake_openai.requests_to("/v1/chat/completions")
+        self.assertTrue(request.body["stream"])
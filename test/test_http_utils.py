@@ -0,0 +1,72 @@
+import asyncio
+from unittest import TestCase
+from unittest.mock import patch
+
+import aiohttp
+
+from utilities import http_utils
+from utilities.http_utils import (
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_RESET_AFTER,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceededError,
+    HttpClient,
+)
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = patch.object(http_utils.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker("example.com")
+
+    def test_opens_after_repeated_failures(self):
+        for _ in range(BREAKER_FAILURE_THRESHOLD - 1):
+            self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_available())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertRaises(CircuitOpenError, self.breaker.before_request)
+
+    def test_half_open_allows_one_trial(self):
+        for _ in range(BREAKER_FAILURE_THRESHOLD):
+            self.breaker.record_failure()
+        self.now += BREAKER_RESET_AFTER
+        self.breaker.before_request()
+        self.assertFalse(self.breaker.is_available())
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+
+        self.now += BREAKER_RESET_AFTER
+        self.breaker.before_request()
+        self.breaker.record_success(0.1)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_slow_responses_count_as_failures(self):
+        for _ in range(BREAKER_FAILURE_THRESHOLD):
+            self.breaker.record_success(http_utils.BREAKER_SLOW_CALL + 1)
+        self.assertEqual(self.breaker.state, "open")
+
+
+class TestDeadline(TestCase):
+    def test_request_fails_once_deadline_has_passed(self):
+        async def ask():
+            http_utils.set_message_deadline(0)
+            async with HttpClient.get_instance().request("GET", "http://localhost"):
+                pass
+
+        with self.assertRaises(DeadlineExceededError):
+            asyncio.run(ask())
+
+    def test_deadline_caps_timeout(self):
+        async def timeout():
+            http_utils.set_message_deadline(2)
+            return HttpClient._apply_deadline(aiohttp.ClientTimeout(total=10, connect=3))
+
+        capped = asyncio.run(timeout())
+        self.assertLessEqual(capped.total, 2)
+        self.assertEqual(capped.connect, 3)
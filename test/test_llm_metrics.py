@@ -0,0 +1,39 @@
+import asyncio
+from unittest import TestCase
+
+import openai
+
+from api.llm_metrics import LLMMetrics
+from api.utilities.openai import OpenAIEngines
+
+
+class TestLLMMetrics(TestCase):
+    def setUp(self):
+        self.metrics = LLMMetrics()
+
+    def test_counts_tokens_and_cost(self):
+        with self.metrics.timed("completion", OpenAIEngines.GPT_4) as call:
+            call.add_usage({"prompt_tokens": 1000, "completion_tokens": 500})
+        stats = self.metrics.get("completion", OpenAIEngines.GPT_4)
+        self.assertEqual((stats.calls, stats.prompt_tokens, stats.completion_tokens), (1, 1000, 500))
+        self.assertAlmostEqual(stats.cost, 0.06)
+        self.assertIn("1000+500 tokens", self.metrics.summary())
+
+    def test_sorts_out_failures(self):
+        for error in [
+            openai.error.RateLimitError("slow down"),
+            asyncio.TimeoutError(),
+            ValueError("oops"),
+        ]:
+            with self.assertRaises(type(error)):
+                with self.metrics.timed("moderation"):
+                    raise error
+        stats = self.metrics.get("moderation", None)
+        self.assertEqual((stats.calls, stats.rate_limited, stats.timeouts, stats.errors), (3, 1, 1, 1))
+
+    def test_as_dict(self):
+        self.metrics.add("queue", OpenAIEngines.GPT_4, 0.5)
+        self.metrics.add("queue", OpenAIEngines.GPT_4, 1.5)
+        [queue] = self.metrics.as_dict()["calls"]
+        self.assertEqual((queue["kind"], queue["engine"], queue["calls"]), ("queue", "gpt-4", 2))
+        self.assertEqual(queue["mean_seconds"], 1.0)
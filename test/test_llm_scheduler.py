@@ -0,0 +1,68 @@
+import asyncio
+from unittest import TestCase
+from unittest.mock import patch
+
+from api import llm_scheduler
+from api.llm_scheduler import PRIORITY_DEFAULT, PRIORITY_VIP, LLMScheduler
+from api.utilities.openai import OpenAIEngines
+
+ENGINE = OpenAIEngines.GPT_4
+
+
+class TestLLMScheduler(TestCase):
+    def setUp(self):
+        patcher = patch.dict(llm_scheduler.ENGINE_CONCURRENCY, {ENGINE: 1})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = LLMScheduler()
+        self.started = []
+
+    def request(self, key, name, priority=PRIORITY_DEFAULT, release=None):
+        async def generate():
+            self.started.append(name)
+            if release:
+                await release.wait()
+            return name
+
+        return self.scheduler.submit(key, ENGINE, priority, generate)
+
+    def run_all(self, make_requests):
+        async def run():
+            release = asyncio.Event()
+            tasks = [asyncio.create_task(self.request("busy", "first", release=release))]
+            await asyncio.sleep(0)
+            for args in make_requests():
+                tasks.append(asyncio.create_task(self.request(*args)))
+                await asyncio.sleep(0)
+            release.set()
+            return await asyncio.gather(*tasks)
+
+        return asyncio.run(run())
+
+    def test_newer_request_replaces_waiting_one(self):
+        results = self.run_all(lambda: [("channel", "a"), ("channel", "b")])
+        self.assertEqual(results, ["first", None, "b"])
+        self.assertEqual(self.started, ["first", "b"])
+
+    def test_vips_go_first(self):
+        results = self.run_all(lambda: [("x", "normal"), ("y", "vip", PRIORITY_VIP)])
+        self.assertEqual(results, ["first", "normal", "vip"])
+        self.assertEqual(self.started, ["first", "vip", "normal"])
+
+    def test_one_request_per_channel_runs_at_a_time(self):
+        with patch.dict(llm_scheduler.ENGINE_CONCURRENCY, {ENGINE: 5}):
+            results = self.run_all(lambda: [("busy", "second"), ("other", "other")])
+        self.assertEqual(results, ["first", "second", "other"])
+        self.assertEqual(self.started, ["first", "other", "second"])
+
+    def test_cancelled_requests_free_their_place(self):
+        async def run():
+            release = asyncio.Event()
+            first = asyncio.create_task(self.request("a", "first", release=release))
+            await asyncio.sleep(0)
+            first.cancel()
+            await asyncio.gather(first, return_exceptions=True)
+            return await self.request("b", "second")
+
+        self.assertEqual(asyncio.run(run()), "second")
+        self.assertEqual(self.scheduler.running[ENGINE], 0)
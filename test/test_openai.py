@@ -0,0 +1,102 @@
+import asyncio
+from collections import OrderedDict
+from unittest import TestCase
+from unittest.mock import patch
+
+from api import openai as openai_api
+from api.openai import OpenAI, OpenAIEngines
+from utilities import http_utils
+
+
+async def slow_call(*args, **kwargs):
+    await asyncio.sleep(10)
+
+
+class TestNonBlockingCalls(TestCase):
+    def setUp(self):
+        for target, value in [
+            ("disable_prompt_moderation", True),
+            ("COMPLETION_TIMEOUT", 0.2),
+            ("MODERATION_TIMEOUT", 0.2),
+        ]:
+            patcher = patch.object(openai_api, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_slow_completion_times_out_without_blocking(self):
+        ticks = []
+
+        async def other_channel():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        async def ask():
+            ticker = asyncio.create_task(other_channel())
+            try:
+                return await OpenAI().get_response(OpenAIEngines.GPT_3_5_TURBO, "hi", {})
+            finally:
+                ticker.cancel()
+
+        with patch.object(openai_api.openai.ChatCompletion, "acreate", slow_call):
+            self.assertEqual(asyncio.run(ask()), "")
+        self.assertGreater(len(ticks), 5)
+
+    def test_slow_moderation_counts_as_risky(self):
+        with patch.object(openai_api, "disable_prompt_moderation", False), patch.object(
+            openai_api, "use_helicone", False
+        ), patch.object(openai_api.Moderation, "acreate", slow_call), patch.object(
+            OpenAI, "log_error"
+        ):
+            self.assertTrue(asyncio.run(OpenAI().is_text_risky("hello")))
+
+    def test_message_deadline_caps_timeout(self):
+        async def timeout():
+            http_utils.set_message_deadline(0.05)
+            return openai_api.request_timeout(60)
+
+        self.assertLessEqual(asyncio.run(timeout()), 0.05)
+
+
+def moderation_result(flagged):
+    return {"flagged": flagged, "categories": {"harassment": flagged}}
+
+
+class TestModerationCache(TestCase):
+    def setUp(self):
+        patcher = patch.object(OpenAI, "verdicts", OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.requests = []
+
+        async def request_moderation(texts):
+            self.requests.append(texts)
+            return [moderation_result(text == "nasty") for text in texts]
+
+        self.openai = OpenAI()
+        self.openai.request_moderation = request_moderation
+
+    def test_only_unseen_texts_are_sent_in_one_batch(self):
+        self.assertEqual(asyncio.run(self.openai.moderate(["a", "b"])), [False, False])
+        self.assertEqual(
+            asyncio.run(self.openai.moderate(["a", "b", "nasty", "c"])),
+            [False, False, True, False],
+        )
+        self.assertEqual(self.requests, [["a", "b"], ["nasty", "c"]])
+
+        self.assertTrue(asyncio.run(self.openai.any_text_risky(["c", "nasty"])))
+        self.assertEqual(len(self.requests), 2)
+
+    def test_failures_are_risky_but_not_remembered(self):
+        async def failing_request(texts):
+            self.requests.append(texts)
+
+        self.openai.request_moderation = failing_request
+        self.assertEqual(asyncio.run(self.openai.moderate(["a"])), [True])
+        self.assertEqual(asyncio.run(self.openai.moderate(["a"])), [True])
+        self.assertEqual(len(self.requests), 2)
+
+    def test_cache_is_bounded(self):
+        with patch.object(openai_api, "MODERATION_CACHE_SIZE", 2):
+            asyncio.run(self.openai.moderate(["a", "b", "c"]))
+        self.assertEqual(len(OpenAI.verdicts), 2)
@@ -0,0 +1,76 @@
+import asyncio
+from unittest import TestCase
+from unittest.mock import AsyncMock, patch
+
+from utilities.periodic import MissedRuns, PeriodicScheduler
+from utilities.utilities import Utilities
+
+
+class TestPeriodicScheduler(TestCase):
+    def setUp(self):
+        self.scheduler = PeriodicScheduler()
+        patcher = patch.object(Utilities.get_instance(), "log_exception", AsyncMock())
+        self.log_exception = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_for(self, seconds):
+        async def run():
+            self.scheduler.start(asyncio.get_running_loop())
+            await asyncio.sleep(seconds)
+            self.scheduler.stop()
+
+        asyncio.run(run())
+
+    def test_runs_every_interval(self):
+        runs = []
+
+        async def job():
+            runs.append(1)
+
+        self.scheduler.register("job", job, interval=0.05, run_at_start=True)
+        self.run_for(0.22)
+        self.assertIn(len(runs), (4, 5))
+        self.assertEqual(self.scheduler.jobs["job"].runs, len(runs))
+
+    def test_failures_are_counted_and_dont_stop_the_job(self):
+        async def job():
+            raise ValueError("oops")
+
+        self.scheduler.register("job", job, interval=0.05, run_at_start=True)
+        self.run_for(0.12)
+        job = self.scheduler.jobs["job"]
+        self.assertGreaterEqual(job.failures, 2)
+        self.assertEqual(job.last_error, "ValueError('oops')")
+        self.log_exception.assert_awaited()
+
+    def test_missed_runs(self):
+        for missed, gap in [(MissedRuns.SKIP, 0.2), (MissedRuns.RUN_ONCE, 0.12)]:
+            starts = []
+
+            async def job():
+                starts.append(asyncio.get_running_loop().time())
+                await asyncio.sleep(0.12)
+
+            self.scheduler = PeriodicScheduler()
+            self.scheduler.register("job", job, interval=0.1, missed=missed, run_at_start=True)
+            self.run_for(0.3)
+            # SKIP waits for the next slot on the schedule, RUN_ONCE runs as soon as it can
+            self.assertAlmostEqual(starts[1] - starts[0], gap, delta=0.035, msg=missed)
+            self.assertGreater(self.scheduler.jobs["job"].missed_runs, 0)
+
+    def test_never_overlaps(self):
+        async def job():
+            await asyncio.sleep(0.05)
+
+        async def run_twice():
+            periodic = self.scheduler.register("job", job, interval=60)
+            await asyncio.gather(self.scheduler.run(periodic), self.scheduler.run(periodic))
+            return periodic
+
+        periodic = asyncio.run(run_twice())
+        self.assertEqual((periodic.runs, periodic.missed_runs), (1, 1))
+
+    def test_summary(self):
+        self.assertEqual(self.scheduler.summary(), "Periodic jobs: none")
+        self.scheduler.register("autopost", AsyncMock(), interval=60)
+        self.assertIn("autopost: every 60s, 0 runs", self.scheduler.summary())
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from api.utilities import tokenizers
+from api.utilities.openai import OpenAIEngines
+from api.utilities.prompt_window import PromptWindow
+from utilities.conversations import ConversationStore
+from utilities.utilities import Utilities
+
+
+class WordTokenizer:
+    """One token per word"""
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return text.split(" ")
+
+    def decode(self, ids):
+        return " ".join(ids)
+
+
+CHANNEL = SimpleNamespace(id="channel")
+
+
+def message(id, text, channel=CHANNEL):
+    author = SimpleNamespace(id="author", name="name", display_name="name")
+    return SimpleNamespace(
+        id=id, content=text, clean_content=text, channel=channel, author=author, service=None
+    )
+
+
+class TestPromptWindow(TestCase):
+    def setUp(self):
+        self.tokenizer = WordTokenizer()
+        self.store = ConversationStore(history=3)
+        for target, name, value in [
+            (tokenizers, "get_tokenizer", lambda name: self.tokenizer),
+            (ConversationStore, "get_instance", lambda: self.store),
+            (Utilities.get_instance(), "stampy_is_author", lambda message: False),
+        ]:
+            patcher = patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.engine = OpenAIEngines.GPT_3_5_TURBO
+        self.window = PromptWindow(3, 10, lambda record: record.clean_content)
+
+    def fitted_texts(self, budget=None):
+        return [text for _, text in self.window.fit(CHANNEL, self.engine, budget)]
+
+    def test_fits_newest_messages_in_budget(self):
+        for i, text in enumerate(["a b c", "d e", "f"]):
+            self.store.add(message(i, text))
+        # each message costs an extra token
+        self.assertEqual(self.fitted_texts(5), ["d e", "f"])
+        self.assertEqual(self.fitted_texts(4), ["f"])
+
+    def test_each_message_is_tokenized_once(self):
+        self.store.add(message(0, "a b c"))
+        self.fitted_texts()
+        self.store.add(message(1, "d e"))
+        self.fitted_texts()
+        self.assertEqual(self.tokenizer.encoded, ["a b c", "d e"])
+
+    def test_long_messages_lose_their_middle(self):
+        self.store.add(message(0, " ".join(str(i) for i in range(30))))
+        [text] = self.fitted_texts()
+        self.assertEqual(text, "0 1 2 ... 27 28 29")
+        self.assertLessEqual(len(self.tokenizer.encode(text)), 10)
@@ -0,0 +1,55 @@
+import asyncio
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from database import result_cache
+from database.result_cache import ResultCache, normalise_query
+
+
+class TestResultCache(TestCase):
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, "cache.db")
+        self.cache = ResultCache(self.path)
+        self.calls = 0
+
+    def fetch(self, value):
+        async def fetch():
+            self.calls += 1
+            return value
+
+        return fetch
+
+    def test_normalise_query(self):
+        self.assertEqual(normalise_query("  What is  AIXI?"), normalise_query("what is aixi"))
+        self.assertEqual(normalise_query("What is AIXI ?."), "what is aixi")
+
+    def test_symbols_are_part_of_the_query(self):
+        self.assertNotEqual(normalise_query("what is 2+2?"), normalise_query("what is 2*2?"))
+        self.assertNotEqual(normalise_query("what is C++?"), normalise_query("what is C?"))
+        self.assertEqual(normalise_query("what is 2.5?"), "what is 2.5")
+
+    def test_caches_answers_and_misses(self):
+        async def lookups():
+            for query in ["What is AIXI?", "what is aixi"]:
+                yield await self.cache.get_or_fetch("duckduckgo", query, self.fetch({"Abstract": "AIXI is"}))
+            for _ in range(2):
+                yield await self.cache.get_or_fetch("duckduckgo", "nonsense", self.fetch(None))
+
+        async def run():
+            return [result async for result in lookups()]
+
+        self.assertEqual(asyncio.run(run()), [{"Abstract": "AIXI is"}] * 2 + [None] * 2)
+        self.assertEqual(self.calls, 2)
+        self.assertIn("duckduckgo: 2/4 hits (50%)", self.cache.stats())
+
+    def test_survives_restart_until_expired(self):
+        self.cache.put("wolfram", "2+2", "4")
+        self.assertEqual(ResultCache(self.path).get("wolfram", "2+2").value, "4")
+
+        later = result_cache.time.time() + result_cache.SOURCE_TTLS["wolfram"].positive.total_seconds()
+        with patch.object(result_cache.time, "time", lambda: later + 1):
+            self.assertIsNone(ResultCache(self.path).get("wolfram", "2+2"))
@@ -0,0 +1,36 @@
+import json
+from unittest import TestCase
+
+from utilities.sse import SSEDecoder, SSEEvent
+
+
+def decode(chunks):
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events += decoder.feed(chunk)
+    return events + decoder.close()
+
+
+class TestSSEDecoder(TestCase):
+    def test_events_split_anywhere(self):
+        stream = (
+            'data: {"state": "streaming", "content": "café ☕"}\n\n'
+            ": keep-alive\r\n"
+            'event: done\r\ndata: {"state": "followups"}\r\n\r\n'
+        ).encode("utf-8")
+        expected = [
+            SSEEvent("message", json.dumps({"state": "streaming", "content": "café ☕"})),
+            SSEEvent("done", '{"state": "followups"}'),
+        ]
+        for size in [1, 2, 3, 7, len(stream)]:
+            events = decode(stream[i : i + size] for i in range(0, len(stream), size))
+            self.assertEqual([e.json() for e in events], [json.loads(e.data) for e in expected])
+            self.assertEqual([e.event for e in events], ["message", "done"])
+
+    def test_multi_line_data(self):
+        events = decode([b"data: first\ndata:second\ndata\n\n"])
+        self.assertEqual(events, [SSEEvent("message", "first\nsecond\n")])
+
+    def test_keeps_unterminated_last_event(self):
+        self.assertEqual(decode([b"id: 7\ndata: 1"]), [SSEEvent("message", "1", "7")])
@@ -0,0 +1,111 @@
+import asyncio
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from modules.module import Response
+from servicemodules.flask import FlaskHandler
+from utilities import streaming
+from utilities.flaskutils import FlaskMessage, server_keys
+from utilities.streaming import StreamedText, iter_blocking, send_streamed, split_text, wait_for_text
+
+
+async def deltas(*parts):
+    for part in parts:
+        yield part
+
+
+class FakeChannel:
+    def __init__(self):
+        self.messages = []
+        self.edits = 0
+
+    async def send(self, text):
+        self.messages.append(text)
+        return len(self.messages) - 1
+
+    async def edit(self, index, text):
+        self.edits += 1
+        self.messages[index] = text
+
+    def stream(self, streamed, limit=streaming.MESSAGE_LIMIT):
+        return asyncio.run(send_streamed(streamed, self.send, self.edit, limit=limit))
+
+
+class TestStreaming(TestCase):
+    def setUp(self):
+        patcher = patch.object(streaming, "EDIT_INTERVAL", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.channel = FakeChannel()
+
+    def test_split_text_prefers_sentence_ends(self):
+        self.assertEqual(split_text("One two. Three four five", 15), ["One two. ", "Three four five"])
+
+    def test_waits_for_a_sentence_before_posting(self):
+        posted = []
+
+        async def watched():
+            async for part in deltas("Hello", " there", ". How", " are you?"):
+                posted.append(list(self.channel.messages))
+                yield part
+
+        self.channel.stream(StreamedText(watched()))
+        self.assertEqual(posted, [[], [], [], ["Hello there. "]])
+        self.assertEqual(self.channel.messages, ["Hello there. How are you?"])
+
+    def test_starts_new_messages_and_adds_epilogue(self):
+        streamed = StreamedText(
+            deltas("aaaa. ", "bbbb. ", "cccc."),
+            epilogue=lambda: ["Citations"],
+            format=lambda text: f"*{text}*",
+        )
+        sent = self.channel.stream(streamed, limit=14)
+        self.assertEqual(self.channel.messages, ["*aaaa. bbbb. *", "*cccc.*", "*Citations*"])
+        self.assertEqual(sent, [0, 1, 2])
+
+    def test_wait_for_text(self):
+        async def wait(*parts):
+            waited = await wait_for_text(deltas(*parts))
+            return waited and [part async for part in waited]
+
+        self.assertEqual(asyncio.run(wait("", " ", "Hi", " there")), ["", " ", "Hi", " there"])
+        self.assertIsNone(asyncio.run(wait("", " \n")))
+        self.assertIsNone(asyncio.run(wait()))
+
+
+class TestIterBlocking(TestCase):
+    def test_yields_deltas_then_epilogue(self):
+        streamed = StreamedText(
+            deltas("Hello", " there."), epilogue=lambda: ["Citations"], format=lambda text: f"*{text}*"
+        )
+        self.assertEqual(
+            list(iter_blocking(streamed)), ["*Hello", " there.", "*", "\n\n*Citations*"]
+        )
+
+    def test_formats_the_whole_text(self):
+        def shout(text):
+            return text.upper() + "!"
+
+        streamed = StreamedText(deltas("Hello", " there"), epilogue=lambda: ["bye"], format=shout)
+        self.assertEqual(list(iter_blocking(streamed)), ["HELLO THERE!", "\n\nBYE!"])
+
+    def test_flask_reply(self):
+        def reply(message):
+            return Response(
+                confidence=10,
+                text=StreamedText(
+                    deltas(" ", "Stamps are", " great."),
+                    epilogue=lambda: ["Citations: [a]"],
+                    format=lambda text: f"_{text}_",
+                ),
+            )
+
+        handler = FlaskHandler()
+        handler.modules = {"stamps": SimpleNamespace(process_message=reply)}
+        message = FlaskMessage.from_dict(
+            {"key": next(iter(server_keys)), "content": "stamps?", "modules": ["stamps"]}
+        )
+        response = handler.on_message(message)
+        self.assertEqual(response.mimetype, "text/plain")
+        self.assertEqual(response.get_data(as_text=True), " _Stamps are great._\n\n_Citations: [a]_")
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from api.utilities import tokenizers
+from api.utilities.openai import OpenAIEngines
+
+
+class TestTokenizers(TestCase):
+    def test_import_doesnt_load_transformers(self):
+        check = "import sys, api.utilities.openai; sys.exit('transformers' in sys.modules)"
+        self.assertEqual(subprocess.run([sys.executable, "-c", check]).returncode, 0)
+
+    def test_missing_tokenizer_isnt_downloaded(self):
+        tokenizers.get_tokenizer.cache_clear()
+        self.addCleanup(tokenizers.get_tokenizer.cache_clear)
+        with patch.object(tokenizers, "tokenizers_dir", "/nonexistent"):
+            with self.assertRaises(FileNotFoundError):
+                OpenAIEngines.GPT_3_5_TURBO.tokenizer
+
+    def test_llm_modules_are_off_without_tokenizers(self):
+        from modules.chatgpt import ChatGPTModule
+        from modules.gpt3module import GPT3Module
+
+        with patch.object(tokenizers, "tokenizers_dir", "/nonexistent"):
+            self.assertFalse(GPT3Module.is_available())
+            self.assertFalse(ChatGPTModule.is_available())
+
+    def test_download_skips_saved_tokenizers(self):
+        with patch.object(tokenizers, "is_saved", lambda name: True), patch.dict(
+            "sys.modules", {"transformers": None}
+        ):
+            tokenizers.download_tokenizers()  # doesn't need transformers at all
+
+    def test_download_runs_without_config(self):
+        # as in the Docker build, where none of config's settings are there yet
+        with tempfile.TemporaryDirectory() as tokenizers_dir:
+            for name in tokenizers.TOKENIZERS:
+                os.mkdir(os.path.join(tokenizers_dir, name))
+            env = {"PATH": os.environ.get("PATH", ""), "TOKENIZERS_DIR": tokenizers_dir}
+            download = subprocess.run(
+                [sys.executable, "-m", "api.utilities.tokenizers"], env=env, capture_output=True, text=True
+            )
+        self.assertEqual(download.returncode, 0, download.stderr)
+
+    def test_download_fails_if_tokenizers_are_still_missing(self):
+        with patch.object(tokenizers, "tokenizers_dir", "/nonexistent"), patch.dict(
+            "sys.modules", {"transformers": MagicMock()}
+        ) as modules:
+            modules["transformers"].GPT2TokenizerFast.from_pretrained.side_effect = OSError("offline")
+            self.assertEqual(tokenizers.download_tokenizers(), ["cl100k_base", "gpt2"])
+
+    def test_chat_models_fall_back_to_gpt2(self):
+        from modules.gpt3module import constant_logit_bias
+
+        tokenizers.get_tokenizer.cache_clear()
+        self.addCleanup(tokenizers.get_tokenizer.cache_clear)
+        constant_logit_bias.cache_clear()
+        self.addCleanup(constant_logit_bias.cache_clear)
+        transformers = MagicMock()
+        with tempfile.TemporaryDirectory() as tokenizers_dir:
+            os.mkdir(os.path.join(tokenizers_dir, "gpt2"))
+            with patch.object(tokenizers, "tokenizers_dir", tokenizers_dir), patch.dict(
+                "sys.modules", {"transformers": transformers}
+            ):
+                self.assertEqual(tokenizers.missing_tokenizers(["cl100k_base"]), [])
+                OpenAIEngines.GPT_4.tokenizer
+                self.assertFalse(OpenAIEngines.GPT_4.has_own_tokenizer)
+                # the gpt2 token ids mean something else to gpt-4
+                self.assertEqual(constant_logit_bias(OpenAIEngines.GPT_4), {})
+        transformers.GPT2TokenizerFast.from_pretrained.assert_called_once_with(
+            os.path.join(tokenizers_dir, "gpt2"), local_files_only=True
+        )
@@ -0,0 +1,181 @@
+import mmap
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from database import transcripts
+from database.transcripts import (
+    ARTIFACT_PREAMBLE,
+    ARTIFACT_VERSION,
+    TranscriptCorpus,
+    TranscriptIndex,
+    extract_phrases,
+    parse_timestamp,
+)
+
+
+def write_video(subs_dir, title, stub, cues, description=None):
+    """Write a video's subtitles, as (seconds, line) cues, in the .vtt format youtube-dl saves"""
+    lines = ["WEBVTT", ""]
+    for seconds, text in cues:
+        timestamp = f"00:{seconds // 60:02}:{seconds % 60:02}.000"
+        lines += [f"{timestamp} --> {timestamp}", f"<{timestamp}><c>{text}</c>", ""]
+    with open(os.path.join(subs_dir, f"{title}-{stub}.en.vtt"), "w") as vtt_file:
+        vtt_file.write("\n".join(lines))
+    if description is not None:
+        with open(os.path.join(subs_dir, f"{title}-{stub}.description"), "w") as description_file:
+            description_file.write(description)
+
+
+class TestTranscriptIndex(TestCase):
+    def setUp(self):
+        self.index = TranscriptIndex()
+        self.index.add(
+            "00:01|hi everyone\n"
+            "00:05|today we're talking about the stop button problem\n"
+            "1:02|if you press the button the robot stops"
+        )
+        self.index.add("00:03|a stamp collector\n00:09|wants to stop you pressing the button")
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp("10:17"), 617)
+        self.assertEqual(parse_timestamp("1:02:03"), 3723)
+        self.assertEqual(parse_timestamp("nonsense"), 0)
+
+    def test_extract_phrases(self):
+        self.assertEqual(
+            extract_phrases('where is the "Stop Button" problem'), [["stop", "button"]]
+        )
+
+    def test_phrase_only_matches_consecutive_tokens(self):
+        matches = self.index.search([], [["stop", "button"]])
+        self.assertEqual(list(matches), [0])
+        self.assertEqual(matches[0].seconds, 5)
+
+    def test_proximity_picks_best_cue(self):
+        matches = self.index.search(["robot", "press"], [])
+        self.assertEqual(matches[0].seconds, 62)
+        self.assertNotIn(1, matches)
+
+
+class TestTranscriptCorpus(TestCase):
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.subs_dir = os.path.join(tmp_dir.name, "subs")
+        os.mkdir(self.subs_dir)
+        self.path = os.path.join(tmp_dir.name, "video_index.bin")
+        write_video(
+            self.subs_dir,
+            "Stop Button Solutions",
+            "9nktr1MgS-A",
+            [(1, "hi everyone"), (65, "the stop button problem")],
+            description="Corrigibility.",
+        )
+        write_video(self.subs_dir, "Stamp Collector", "tcdVC4e6EV4", [(3, "a stamp collecting device")])
+
+    def load(self, path=None):
+        corpus = TranscriptCorpus.load(path or self.path)
+        self.addCleanup(corpus.texts.close)
+        return corpus
+
+    def seconds(self, corpus, *terms, phrases=()):
+        matches = corpus.index.search(list(terms), list(phrases))
+        return {corpus.records[doc_id].title: match.seconds for doc_id, match in matches.items()}
+
+    def test_artifact_round_trip(self):
+        built = TranscriptCorpus.build(self.subs_dir)
+        built.save(self.path)
+        loaded = self.load()
+
+        self.assertIsInstance(loaded.texts, mmap.mmap)
+        self.assertEqual(loaded.fingerprint, built.fingerprint)
+        self.assertEqual(
+            [(r.title, r.stub, r.description) for r in loaded.records],
+            [
+                ("Stamp Collector", "tcdVC4e6EV4", ""),
+                ("Stop Button Solutions", "9nktr1MgS-A", "Corrigibility."),
+            ],
+        )
+        self.assertEqual([loaded.text(i) for i in range(2)], [built.text(i) for i in range(2)])
+        self.assertEqual(loaded.text(1), "00:01|hi everyone\n01:05|the stop button problem")
+        self.assertEqual(
+            self.seconds(loaded, phrases=[["stop", "button"]]), {"Stop Button Solutions": 65}
+        )
+        self.assertEqual(self.seconds(loaded, "stamp"), {"Stamp Collector": 3})
+        # the index is read back exactly as it was built
+        self.assertEqual(loaded.records, built.records)
+        self.assertEqual(loaded.index.postings, built.index.postings)
+
+    def test_rejects_other_artifacts(self):
+        TranscriptCorpus.build(self.subs_dir).save(self.path)
+        with open(self.path, "r+b") as artifact:
+            artifact.write(b"NOTVIDEO")
+        with self.assertRaises(ValueError):
+            TranscriptCorpus.load(self.path)
+
+        with patch.object(transcripts, "ARTIFACT_VERSION", ARTIFACT_VERSION + 1):
+            TranscriptCorpus.build(self.subs_dir).save(self.path)
+        with self.assertRaises(ValueError):
+            TranscriptCorpus.load(self.path)
+
+        TranscriptCorpus.build(self.subs_dir).save(self.path)
+        with open(self.path, "r+b") as artifact:
+            artifact.seek(ARTIFACT_PREAMBLE.size)
+            artifact.write(b"[]")
+        with self.assertRaises(ValueError):
+            TranscriptCorpus.load(self.path)
+
+        TranscriptCorpus.build(self.subs_dir).save(self.path)
+        with open(self.path, "r+b") as artifact:
+            _, _, header_length = ARTIFACT_PREAMBLE.unpack(artifact.read(ARTIFACT_PREAMBLE.size))
+            artifact.truncate(ARTIFACT_PREAMBLE.size + header_length + 8)
+        with self.assertRaises(ValueError):
+            TranscriptCorpus.load(self.path)
+
+        # and one that can't be loaded gets rebuilt
+        corpus = TranscriptCorpus.load_or_build(self.subs_dir, self.path)
+        self.assertEqual(len(corpus), 2)
+        with open(self.path, "rb") as artifact:
+            _, version, _ = ARTIFACT_PREAMBLE.unpack(artifact.read(ARTIFACT_PREAMBLE.size))
+        self.assertEqual(version, ARTIFACT_VERSION)
+
+    def test_rebuilds_when_the_subs_change(self):
+        TranscriptCorpus.load_or_build(self.subs_dir, self.path)
+        with patch.object(TranscriptCorpus, "build", side_effect=AssertionError("rebuilt")):
+            unchanged = TranscriptCorpus.load_or_build(self.subs_dir, self.path)
+        self.addCleanup(unchanged.texts.close)
+        self.assertIsInstance(unchanged.texts, mmap.mmap)
+
+        write_video(self.subs_dir, "Stamp Collector", "tcdVC4e6EV4", [(4, "an updated stamp collector")])
+        updated = TranscriptCorpus.load_or_build(self.subs_dir, self.path)
+        self.assertEqual(self.seconds(updated, "updated"), {"Stamp Collector": 4})
+        self.assertEqual(self.load().fingerprint, transcripts.subs_fingerprint(self.subs_dir))
+        self.assertEqual(self.seconds(self.load(), "updated"), {"Stamp Collector": 4})
+
+    def test_only_changed_videos_are_parsed_again(self):
+        write_video(self.subs_dir, "Reward Hacking", "46nsTFfsBuc", [(7, "the reward function")])
+        TranscriptCorpus.build(self.subs_dir).save(self.path)
+        previous = self.load()
+
+        write_video(
+            self.subs_dir, "Stamp Collector", "tcdVC4e6EV4", [(2, "an intro"), (90, "a new stamp line")]
+        )
+        with patch.object(transcripts, "ingest_video", wraps=transcripts.ingest_video) as ingest:
+            corpus = TranscriptCorpus.build(self.subs_dir, previous=previous)
+        ingest.assert_called_once_with(self.subs_dir, "Stamp Collector-tcdVC4e6EV4.en.vtt")
+
+        self.assertEqual(
+            [record.title for record in corpus.records],
+            ["Reward Hacking", "Stamp Collector", "Stop Button Solutions"],
+        )
+        # the reused videos, whose texts now sit at different offsets
+        self.assertEqual(self.seconds(corpus, "reward"), {"Reward Hacking": 7})
+        self.assertEqual(self.seconds(corpus, "problem"), {"Stop Button Solutions": 65})
+        self.assertEqual(corpus.text(2), previous.text(2))
+        self.assertEqual(corpus.records[2].description, "Corrigibility.")
+        # and the one that changed
+        self.assertEqual(self.seconds(corpus, "stamp"), {"Stamp Collector": 90})
+        self.assertEqual(self.seconds(corpus, "collecting"), {})
+        self.assertEqual(corpus.text(1), "00:02|an intro\n01:30|a new stamp line")
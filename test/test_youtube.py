@@ -0,0 +1,111 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from googleapiclient.errors import HttpError
+import httplib2
+
+from api.youtube import YoutubeAPI
+
+
+def thread(comment_id, published):
+    return {
+        "snippet": {
+            "topLevelComment": {
+                "id": comment_id,
+                "snippet": {
+                    "videoId": "video",
+                    "authorDisplayName": "viewer",
+                    "textOriginal": f"comment {comment_id}?",
+                    "publishedAt": published.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "likeCount": 0,
+                },
+            },
+            "totalReplyCount": 0,
+        }
+    }
+
+
+def make_api(test: TestCase) -> YoutubeAPI:
+    """A YoutubeAPI of the test's own, with no real client, forgotten once the test is over"""
+    patcher = patch("api.youtube.get_youtube_api", MagicMock())
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    setattr(YoutubeAPI, "_YoutubeAPI__instance", None)
+    test.addCleanup(setattr, YoutubeAPI, "_YoutubeAPI__instance", None)
+    return YoutubeAPI.get_instance()
+
+
+class TestYoutubeComments(TestCase):
+    def setUp(self):
+        self.api = make_api(self)
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.api.latest_comment_timestamp = self.now - timedelta(hours=1)
+        self.api.last_check_timestamp = self.now - timedelta(hours=1)
+        self.pages = {}
+        self.page_tokens = []
+
+        def list_threads(pageToken=None, **kwargs):
+            self.page_tokens.append(pageToken)
+            request = MagicMock()
+            request.execute.return_value = self.pages[pageToken]
+            return request
+
+        self.api.youtube = MagicMock()
+        self.api.youtube.commentThreads.return_value.list.side_effect = list_threads
+
+    def test_follows_pages_until_it_reaches_old_comments(self):
+        self.pages = {
+            None: {"items": [thread("a", self.now), thread("b", self.now)], "nextPageToken": "2"},
+            "2": {
+                "items": [thread("c", self.now), thread("old", self.now - timedelta(days=1))],
+                "nextPageToken": "3",
+            },
+        }
+        comments = self.api.check_for_new_youtube_comments()
+        self.assertEqual(self.page_tokens, [None, "2"])
+        self.assertEqual([comment["url"][-1] for comment in comments], ["a", "b", "c"])
+        self.assertEqual(self.api.latest_comment_timestamp, self.now)
+
+    def test_poll_passes_new_comments_to_subscribers(self):
+        self.pages = {None: {"items": [thread("a", self.now)]}}
+
+        async def poll():
+            queue = self.api.subscribe()
+            await self.api.poll_comments()
+            await self.api.poll_comments()  # too soon to check again
+            return [queue.get_nowait()["text"] for _ in range(queue.qsize())]
+
+        self.assertEqual(asyncio.run(poll()), ["comment a?"])
+        self.assertEqual(self.page_tokens, [None])
+
+
+class TestCachedRequests(TestCase):
+    def setUp(self):
+        self.api = make_api(self)
+        self.requests = []
+
+        def list_threads(id, **kwargs):
+            request = MagicMock(headers={})
+            self.requests.append((id, request))
+
+            def execute():
+                if "If-None-Match" in request.headers:
+                    raise HttpError(httplib2.Response({"status": 304}), b"")
+                return {"etag": f"etag-{id}", "items": [thread(id, datetime.now(timezone.utc))]}
+
+            request.execute.side_effect = execute
+            return request
+
+        self.api.youtube = MagicMock()
+        self.api.youtube.commentThreads.return_value.list.side_effect = list_threads
+
+    def test_unchanged_threads_come_from_the_cache(self):
+        url = "https://www.youtube.com/watch?v=video&lc=c1"
+        first = self.api.get_youtube_comment(url)
+        second = self.api.get_youtube_comment(url)
+        self.assertEqual(first, second)
+        (_, first_request), (_, second_request) = self.requests
+        self.assertNotIn("If-None-Match", first_request.headers)
+        self.assertEqual(second_request.headers["If-None-Match"], "etag-c1")
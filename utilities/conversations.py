@@ -0,0 +1,182 @@
+"""
+The recent messages of every channel, shared by the modules that chat (GPT-3, ChatGPT, stampy_chat).
+
+Each channel keeps its last CHANNEL_HISTORY messages in a ring buffer. Channels that go
+quiet are forgotten, least recently active first, once there are more than MAX_CHANNELS
+of them or the stored text adds up to more than MAX_STORED_CHARS.
+
+Messages are stored as `MessageRecord`s, which only have the few fields the chat modules
+need, so the store doesn't keep discord.py's message, member and channel objects alive.
+Every module adds every message it sees, but each message is only stored once. Messages
+that are edited afterwards (e.g. streamed replies) are updated with `update`.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict, deque
+from typing import Any, Optional
+
+from servicemodules.serviceConstants import Services
+from utilities.serviceutils import ServiceChannel, ServiceMessage
+from utilities.utilities import Utilities
+
+# messages kept per channel, enough for the module that looks furthest back
+CHANNEL_HISTORY = 15
+
+# limits on what's kept in total, after which the least recently active channels are dropped
+MAX_CHANNELS = 500
+MAX_STORED_CHARS = 2_000_000
+
+# edits to messages that haven't been added yet, kept until they are
+MAX_PENDING_EDITS = 100
+
+ChannelKey = tuple[str, str]
+
+
+def channel_key(channel: ServiceChannel) -> ChannelKey:
+    # not the channel itself, which holds on to the service's channel object
+    return (type(channel).__name__, str(channel.id))
+
+
+class MessageRecord:
+    """What the chat modules need to know about a message"""
+
+    __slots__ = (
+        "id",
+        "content",
+        "clean_content",
+        "service",
+        "author_id",
+        "author_name",
+        "author_display_name",
+        "from_stampy",
+        "memo",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        content: str,
+        clean_content: str,
+        service: Services,
+        author_id: str,
+        author_name: str,
+        author_display_name: str,
+        from_stampy: bool,
+    ) -> None:
+        self.id = id
+        self.content = content
+        self.clean_content = clean_content
+        self.service = service
+        self.author_id = author_id
+        self.author_name = author_name
+        self.author_display_name = author_display_name
+        self.from_stampy = from_stampy
+        # things modules work out from the message (e.g. token counts), forgotten with it
+        self.memo: dict[Any, Any] = {}
+
+    @classmethod
+    def from_message(cls, message: ServiceMessage) -> MessageRecord:
+        return cls(
+            id=str(message.id),
+            content=message.content,
+            clean_content=message.clean_content,
+            service=message.service,
+            author_id=str(message.author.id),
+            author_name=message.author.name,
+            author_display_name=message.author.display_name,
+            from_stampy=Utilities.get_instance().stampy_is_author(message),
+        )
+
+    def __repr__(self) -> str:
+        return f"MessageRecord({self.id}, {self.author_name}: {self.clean_content[:20]!r})"
+
+    def size(self) -> int:
+        return len(self.content) + len(self.clean_content)
+
+
+class ConversationStore:
+    __instance: Optional[ConversationStore] = None
+
+    @staticmethod
+    def get_instance() -> ConversationStore:
+        if ConversationStore.__instance is None:
+            ConversationStore.__instance = ConversationStore()
+        return ConversationStore.__instance
+
+    def __init__(
+        self,
+        history: int = CHANNEL_HISTORY,
+        max_channels: int = MAX_CHANNELS,
+        max_chars: int = MAX_STORED_CHARS,
+    ) -> None:
+        self.history_length = history
+        self.max_channels = max_channels
+        self.max_chars = max_chars
+        # least recently active first
+        self.channels: OrderedDict[ChannelKey, deque[MessageRecord]] = OrderedDict()
+        self.chars = 0
+        # final texts of messages that were edited before they were added, e.g. Stampy's
+        # streamed replies, which can be finished before Discord tells us they were sent
+        self.pending_edits: OrderedDict[tuple[ChannelKey, str], str] = OrderedDict()
+
+    def add(self, message: ServiceMessage) -> MessageRecord:
+        """Remember the message, unless it's already been added (e.g. by another module)"""
+        key = channel_key(message.channel)
+        records = self.channels.get(key)
+        if records is None:
+            records = self.channels[key] = deque(maxlen=self.history_length)
+        else:
+            for record in records:
+                if record.id == str(message.id):
+                    return record
+        self.channels.move_to_end(key)
+
+        if len(records) == records.maxlen:
+            self.chars -= records[0].size()
+        record = MessageRecord.from_message(message)
+        records.append(record)
+        self.chars += record.size()
+        edited = self.pending_edits.pop((key, record.id), None)
+        if edited is not None:
+            self.set_content(record, edited)
+        self.evict()
+        return record
+
+    def update(self, channel: ServiceChannel, message_id: str, content: str) -> Optional[MessageRecord]:
+        """The message now says `content` (e.g. a streamed reply that's been written out in full).
+
+        Anything the modules worked out from the old text is forgotten. If the message hasn't
+        been added yet, the new text is used once it is.
+        """
+        key = channel_key(channel)
+        for record in self.channels.get(key, ()):
+            if record.id == str(message_id):
+                self.set_content(record, content)
+                self.evict()
+                return record
+        self.pending_edits[(key, str(message_id))] = content
+        while len(self.pending_edits) > MAX_PENDING_EDITS:
+            self.pending_edits.popitem(last=False)
+        return None
+
+    def set_content(self, record: MessageRecord, content: str) -> None:
+        self.chars -= record.size()
+        record.content = record.clean_content = content
+        record.memo.clear()
+        self.chars += record.size()
+
+    def evict(self) -> None:
+        """Forget the least recently active channels, until the store is within its limits"""
+        while len(self.channels) > 1 and (
+            len(self.channels) > self.max_channels or self.chars > self.max_chars
+        ):
+            _, records = self.channels.popitem(last=False)
+            self.chars -= sum(record.size() for record in records)
+
+    def history(self, channel: ServiceChannel, count: Optional[int] = None) -> list[MessageRecord]:
+        """The last `count` messages in the channel (all that are kept by default), oldest first"""
+        records = self.channels.get(channel_key(channel), ())
+        if count is None or count >= len(records):
+            return list(records)
+        return list(records)[-count:]
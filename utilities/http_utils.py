@@ -0,0 +1,267 @@
+"""
+The HTTP client shared by every module that talks to the outside world.
+
+Modules run inside the Discord event loop, so blocking calls like `urlopen` or `requests.get`
+freeze the whole bot (including heartbeats) until they return. Use this instead:
+
+    client = HttpClient.get_instance()
+    data = await client.get_json("https://api.duckduckgo.com/", params={"q": query})
+
+All requests go through one `aiohttp.ClientSession` per event loop, which keeps a pool of
+keep-alive connections for each host, caches DNS lookups and gives every request a deadline
+unless the caller passes a `timeout` of its own.
+
+Every host also gets a circuit breaker. When a host keeps failing (or is very slow) its
+breaker opens and requests to it fail straight away with `CircuitOpenError` for a while,
+instead of every message waiting for the full timeout. Modules can check
+`client.is_available(url)` up front and skip the lookup or lower their confidence.
+
+The time left to answer the current message, if the service set one with `set_message_deadline`,
+caps the timeout of every request made while handling it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import time
+from typing import Any, AsyncIterator, Optional
+from urllib.parse import urlsplit
+from weakref import WeakKeyDictionary
+
+import aiohttp
+from structlog import get_logger
+
+log = get_logger()
+
+# how many connections to keep open to any single host
+CONNECTIONS_PER_HOST = 8
+
+# how long (in seconds) to remember DNS lookups
+DNS_CACHE_TTL = 300
+
+# used for every request that doesn't say otherwise
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=3)
+
+# a host's breaker opens after this many failures in a row
+BREAKER_FAILURE_THRESHOLD = 3
+
+# and stays open for this many seconds, before letting a single trial request through
+BREAKER_RESET_AFTER = 60
+
+# a response that takes longer than this (in seconds) to start counts as a failure
+BREAKER_SLOW_CALL = 8
+
+# server errors that mean the host is struggling, rather than that it didn't like our request
+BREAKER_STATUSES = frozenset({500, 502, 503, 504})
+
+# when (in `time.monotonic()` seconds) we have to give up on the message being handled
+_deadline: ContextVar[Optional[float]] = ContextVar("http_deadline", default=None)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request to a host whose circuit breaker is open"""
+
+
+class DeadlineExceededError(asyncio.TimeoutError):
+    """Raised instead of making a request when there's no time left to answer the message"""
+
+
+def set_message_deadline(seconds: float) -> None:
+    """Give every request made from here on while handling this message `seconds` at most, in total.
+
+    The deadline is a context variable, so it applies to the current asyncio task (e.g. one
+    `on_message` call, including the callbacks it awaits) and any tasks that it starts.
+    """
+    _deadline.set(time.monotonic() + seconds)
+
+
+def time_left() -> Optional[float]:
+    """Seconds until the current message's deadline, or None if there isn't one"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+class CircuitBreaker:
+    """Tracks failures and latency of requests to one host.
+
+    closed: requests go through as normal
+    open: the host has failed BREAKER_FAILURE_THRESHOLD times in a row, so requests are refused
+    half open: BREAKER_RESET_AFTER has passed since it opened, so one trial request is allowed
+               through, which closes the breaker if it succeeds and opens it again if not
+    """
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+        # exponentially weighted average of how long the host takes to respond
+        self.latency: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < BREAKER_RESET_AFTER:
+            return "open"
+        return "half open"
+
+    def is_available(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half open" and not self.trial_running)
+
+    def before_request(self) -> None:
+        if not self.is_available():
+            raise CircuitOpenError(f"{self.host} is failing, not trying it for now")
+        if self.state == "half open":
+            self.trial_running = True
+
+    def record_success(self, latency: float) -> None:
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if latency > BREAKER_SLOW_CALL:
+            self.record_failure()
+            return
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= BREAKER_FAILURE_THRESHOLD:
+            if self.state != "open":
+                log.warning(
+                    "CircuitBreaker", msg=f"Too many failures, pausing requests to {self.host}"
+                )
+            self.opened_at = time.monotonic()
+
+
+class HttpClient:
+    __instance: Optional[HttpClient] = None
+
+    @staticmethod
+    def get_instance() -> HttpClient:
+        if HttpClient.__instance is None:
+            return HttpClient()
+        return HttpClient.__instance
+
+    def __init__(self) -> None:
+        if HttpClient.__instance is not None:
+            raise Exception(
+                "This class is a singleton! Access it using `HttpClient.get_instance()`"
+            )
+        HttpClient.__instance = self
+        self.class_name = self.__class__.__name__
+        # aiohttp sessions can only be used from the loop they were made in. Discord has a
+        # single long running loop, but e.g. Flask runs every callback in a fresh one.
+        self._sessions: WeakKeyDictionary[
+            asyncio.AbstractEventLoop, aiohttp.ClientSession
+        ] = WeakKeyDictionary()
+        self.breakers: dict[str, CircuitBreaker] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The session for the running event loop, created the first time it's needed"""
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            self._forget_closed_loops()
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=CONNECTIONS_PER_HOST, ttl_dns_cache=DNS_CACHE_TTL
+                ),
+                timeout=DEFAULT_TIMEOUT,
+                raise_for_status=True,
+            )
+            self._sessions[loop] = session
+        return session
+
+    def _forget_closed_loops(self) -> None:
+        """Drop the sessions of loops that have finished (e.g. after `asyncio.run`).
+
+        Their connections died with the loop, so there's nothing left to close cleanly.
+        """
+        for loop in [loop for loop in self._sessions if loop.is_closed()]:
+            self._sessions.pop(loop).detach()
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        host = urlsplit(url).netloc
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(host)
+        return self.breakers[host]
+
+    def is_available(self, url: str) -> bool:
+        """Whether it's worth trying a request to this url's host right now"""
+        return self.breaker(url).is_available()
+
+    @staticmethod
+    def _apply_deadline(timeout: aiohttp.ClientTimeout) -> aiohttp.ClientTimeout:
+        remaining = time_left()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise DeadlineExceededError("Ran out of time to answer this message")
+        if timeout.total is not None and timeout.total <= remaining:
+            return timeout
+        return aiohttp.ClientTimeout(
+            total=remaining,
+            connect=timeout.connect,
+            sock_read=timeout.sock_read,
+            sock_connect=timeout.sock_connect,
+        )
+
+    @asynccontextmanager
+    async def request(
+        self, method: str, url: str, **kwargs: Any
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Make a request, e.g. to stream the body. Takes the same arguments as aiohttp.
+
+        Raises `aiohttp.ClientResponseError` for error statuses, `asyncio.TimeoutError`
+        if the server takes too long (or the message's deadline passes) and
+        `CircuitOpenError` if the host has been failing.
+        """
+        kwargs["timeout"] = self._apply_deadline(kwargs.get("timeout") or DEFAULT_TIMEOUT)
+        breaker = self.breaker(url)
+        breaker.before_request()
+
+        start = time.monotonic()
+        try:
+            response = await self.session.request(method, url, **kwargs)
+        except aiohttp.ClientResponseError as e:
+            if e.status in BREAKER_STATUSES:
+                breaker.record_failure()
+            else:
+                breaker.record_success(time.monotonic() - start)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # e.g. cancelled, which says nothing about the host
+            breaker.trial_running = False
+            raise
+        breaker.record_success(time.monotonic() - start)
+
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def get_json(self, url: str, **kwargs: Any) -> Any:
+        async with self.request("GET", url, **kwargs) as response:
+            # some APIs (e.g. DuckDuckGo) send JSON with the wrong content type
+            return await response.json(content_type=None)
+
+    async def get_text(self, url: str, **kwargs: Any) -> str:
+        async with self.request("GET", url, **kwargs) as response:
+            return await response.text()
+
+    async def close(self) -> None:
+        """Close the session of the running loop"""
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
@@ -0,0 +1,193 @@
+"""
+Jobs that run every so often, in the Discord event loop.
+
+Modules register their jobs when they're set up, with `Module.schedule` (or directly):
+
+    PeriodicScheduler.get_instance().register("autopost", self.autopost, interval=60, jitter=10)
+
+and DiscordHandler starts them all with the event loop. Each job runs in its own task:
+
+- It runs every `interval` seconds, plus up to `jitter` seconds picked at random each time,
+  so jobs with the same interval don't all hit the network at once.
+- A job never overlaps itself. If a run takes longer than the interval (or the loop was
+  busy), the runs it missed are handled according to its `missed` policy: SKIP waits for the
+  next run on the schedule, RUN_ONCE runs straight away and carries on from there.
+- An exception is logged and counted, and the job runs again next time.
+- How long each run took, how many failed and how many were missed are kept, and shown by
+  `s, stats` and Flask's `/stats` endpoint.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from enum import Enum
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from structlog import get_logger
+
+from utilities.utilities import Utilities
+
+log = get_logger()
+
+
+class MissedRuns(Enum):
+    SKIP = "skip"  # wait for the next run on the schedule
+    RUN_ONCE = "run once"  # run once straight away, however many were missed
+
+
+@dataclass
+class PeriodicJob:
+    name: str
+    func: Callable[[], Awaitable[Any]]
+    interval: float
+    jitter: float = 0.0
+    missed: MissedRuns = MissedRuns.SKIP
+    # whether the first run is straight away, rather than after one interval
+    run_at_start: bool = False
+
+    runs: int = 0
+    failures: int = 0
+    missed_runs: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    last_seconds: Optional[float] = None
+    last_started: Optional[float] = None  # time.time()
+    last_error: Optional[str] = None
+    running: bool = False
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            "missed_runs": self.missed_runs,
+            "mean_seconds": self.total_seconds / self.runs if self.runs else None,
+            "max_seconds": self.max_seconds,
+            "last_seconds": self.last_seconds,
+            "last_started": self.last_started,
+            "last_error": self.last_error,
+        }
+
+    def summary(self) -> str:
+        parts = [f"every {self.interval:g}s", f"{self.runs} runs"]
+        if self.runs:
+            parts.append(f"mean {self.total_seconds / self.runs:.2f}s, max {self.max_seconds:.2f}s")
+        if self.failures:
+            parts.append(f"{self.failures} failed (last: {self.last_error})")
+        if self.missed_runs:
+            parts.append(f"{self.missed_runs} missed")
+        return f"{self.name}: {', '.join(parts)}"
+
+
+class PeriodicScheduler:
+    __instance: Optional[PeriodicScheduler] = None
+
+    @staticmethod
+    def get_instance() -> PeriodicScheduler:
+        if PeriodicScheduler.__instance is None:
+            PeriodicScheduler.__instance = PeriodicScheduler()
+        return PeriodicScheduler.__instance
+
+    def __init__(self) -> None:
+        self.class_name = self.__class__.__name__
+        self.jobs: dict[str, PeriodicJob] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def register(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[Any]],
+        interval: float,
+        jitter: float = 0.0,
+        missed: MissedRuns = MissedRuns.SKIP,
+        run_at_start: bool = False,
+    ) -> PeriodicJob:
+        """Run `await func()` every `interval` seconds, once the scheduler has started.
+
+        Registering a job with the same name as an existing one replaces it.
+        """
+        if interval <= 0:
+            raise ValueError(f"Job {name} needs a positive interval, not {interval}")
+        self.cancel(name)
+        job = self.jobs[name] = PeriodicJob(name, func, interval, jitter, missed, run_at_start)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.start_job, job)
+        return job
+
+    def cancel(self, name: str) -> None:
+        job = self.jobs.pop(name, None)
+        if job is not None and job.task is not None:
+            job.task.get_loop().call_soon_threadsafe(job.task.cancel)
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Start running the jobs (including ones registered later) in `loop`, which needn't be running yet"""
+        if self.loop is not None:
+            return
+        self.loop = loop
+        for job in self.jobs.values():
+            self.start_job(job)
+
+    def stop(self) -> None:
+        for job in self.jobs.values():
+            if job.task is not None:
+                job.task.get_loop().call_soon_threadsafe(job.task.cancel)
+                job.task = None
+        self.loop = None
+
+    def start_job(self, job: PeriodicJob) -> None:
+        if self.loop is not None and self.jobs.get(job.name) is job and job.task is None:
+            job.task = self.loop.create_task(self.keep_running(job))
+
+    async def keep_running(self, job: PeriodicJob) -> None:
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + (0 if job.run_at_start else job.interval)
+        while True:
+            await asyncio.sleep(max(0.0, next_run - loop.time()) + random.uniform(0, job.jitter))
+            await self.run(job)
+            next_run += job.interval
+            now = loop.time()
+            if next_run < now:
+                missed = int((now - next_run) // job.interval) + 1
+                job.missed_runs += missed
+                log.warning(self.class_name, msg=f"{job.name} missed {missed} runs", missed=job.missed.value)
+                if job.missed is MissedRuns.SKIP:
+                    next_run += missed * job.interval
+                else:
+                    next_run = now
+
+    async def run(self, job: PeriodicJob) -> None:
+        """Run the job once, now, unless it's running already"""
+        if job.running:
+            job.missed_runs += 1
+            return
+        job.running = True
+        job.last_started = time.time()
+        start = time.monotonic()
+        try:
+            await job.func()
+        except Exception as e:
+            job.failures += 1
+            job.last_error = repr(e)
+            log.error(self.class_name, msg=f"{job.name} failed", error=repr(e))
+            await Utilities.get_instance().log_exception(e, problem_source=job.name)
+        finally:
+            job.running = False
+            seconds = time.monotonic() - start
+            job.runs += 1
+            job.total_seconds += seconds
+            job.max_seconds = max(job.max_seconds, seconds)
+            job.last_seconds = seconds
+
+    def as_dict(self) -> list[dict[str, Any]]:
+        return [job.as_dict() for job in self.jobs.values()]
+
+    def summary(self) -> str:
+        """For the stats command"""
+        if not self.jobs:
+            return "Periodic jobs: none"
+        return "\n".join(["Periodic jobs:"] + [job.summary() for job in self.jobs.values()])
@@ -0,0 +1,109 @@
+"""
+Incremental decoder for server-sent event streams (`text/event-stream`), e.g. from chat.stampy.ai
+
+Bytes are fed in as they arrive from the network. Anything after the last line break is
+kept in a `bytearray` until the rest of the line arrives. Only complete lines are decoded
+(all of a chunk's complete lines in one go), so UTF-8 characters split across chunks are
+never a problem, and each chunk is searched for line breaks once, however long the lines get.
+
+See https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+Lines may end with "\\n" or "\\r\\n" (a lone "\\r" isn't treated as a line break).
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any, AsyncIterable, AsyncIterator, NamedTuple, Optional
+
+
+class SSEEvent(NamedTuple):
+    event: str
+    data: str
+    id: Optional[str] = None
+
+    def json(self) -> Any:
+        return json.loads(self.data)
+
+
+class SSEDecoder:
+    def __init__(self) -> None:
+        # bytes after the last line break seen so far
+        self.buffer = bytearray()
+        # the fields of the event that's being read
+        self.data_lines: list[str] = []
+        self.event_type = ""
+        self.last_event_id: Optional[str] = None
+
+    def feed(self, chunk: bytes) -> list[SSEEvent]:
+        """Add a chunk of the stream, returning any events it completed"""
+        # only the new chunk needs searching, so a very long line isn't rescanned every time
+        last_break = chunk.rfind(b"\n")
+        if last_break == -1:
+            self.buffer += chunk
+            return []
+        if self.buffer:
+            self.buffer += chunk[: last_break + 1]
+            text = self.buffer.decode("utf-8")
+        else:
+            text = chunk[: last_break + 1].decode("utf-8")
+        self.buffer = bytearray(chunk[last_break + 1 :])
+
+        events: list[SSEEvent] = []
+        lines = text.split("\n")
+        lines.pop()  # the empty remainder after the last line break
+        for line in lines:
+            if line.endswith("\r"):
+                line = line[:-1]
+            if not line:
+                if self.data_lines:
+                    events.append(self.dispatch())
+                else:
+                    self.event_type = ""
+            elif line.startswith("data: "):
+                # the usual case, so it gets to skip the general field parsing
+                self.data_lines.append(line[6:])
+            elif not line.startswith(":"):  # lines starting with ":" are comments
+                self.process_field(line)
+        return events
+
+    def process_field(self, line: str) -> None:
+        name, colon, value = line.partition(":")
+        if colon and value.startswith(" "):
+            value = value[1:]
+        if name == "data":
+            self.data_lines.append(value)
+        elif name == "event":
+            self.event_type = value
+        elif name == "id":
+            self.last_event_id = value
+        # anything else (e.g. "retry") doesn't matter to us
+
+    def dispatch(self) -> SSEEvent:
+        """Finish the event that's being read"""
+        data = self.data_lines[0] if len(self.data_lines) == 1 else "\n".join(self.data_lines)
+        event = SSEEvent(self.event_type or "message", data, self.last_event_id)
+        self.data_lines = []
+        self.event_type = ""
+        return event
+
+    def close(self) -> list[SSEEvent]:
+        """The stream ended. Unlike the spec, we keep an event that was missing its final blank line."""
+        events = self.feed(b"\n") if self.buffer else []
+        if self.data_lines:
+            events.append(self.dispatch())
+        return events
+
+
+async def iter_events(chunks: AsyncIterable[bytes]) -> AsyncIterator[SSEEvent]:
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.close():
+        yield event
+
+
+async def iter_json(chunks: AsyncIterable[bytes]) -> AsyncIterator[Any]:
+    """The data of every event in the stream, parsed as JSON"""
+    async for event in iter_events(chunks):
+        yield event.json()
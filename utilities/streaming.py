@@ -0,0 +1,220 @@
+"""
+Text that arrives a bit at a time (e.g. from a chat bot), to be shown while it's being written.
+
+A module can reply with `Response(text=StreamedText(...))`. Services that support it post the
+first message as soon as there's a whole sentence to show, then keep editing it as more
+text arrives, starting a new message whenever one fills up. Anything that can only be
+worked out once the text is finished (e.g. citations) goes in the epilogue, which is
+posted at the end. Flask sends the text as it arrives, as a chunked HTTP response.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import re
+import time
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterator,
+    Optional,
+    TypeVar,
+)
+
+from servicemodules.serviceConstants import Services
+
+# Discord's limit on the length of a message
+MESSAGE_LIMIT = 2000
+
+# the services that show a StreamedText as it arrives. The others wait for all of it.
+STREAMING_SERVICES = frozenset({Services.DISCORD, Services.FLASK})
+
+# seconds between edits of the same message. Discord allows about 5 edits every 5 seconds.
+EDIT_INTERVAL = 1.2
+
+# stands in for the text, to find out what `format` adds around it
+FORMAT_MARKER = "\0"
+
+# where it's nice to split text, from best to worst
+RE_SENTENCE_END = re.compile(r"(?<=[.!?:;])\s|\n")
+RE_WORD_END = re.compile(r"\s")
+
+Message = TypeVar("Message")
+
+
+def split_point(text: str, limit: int) -> int:
+    """Where to split `text` so that the first part is at most `limit` characters long,
+    at the last sentence end if possible, otherwise the last space"""
+    if len(text) <= limit:
+        return len(text)
+    for pattern in (RE_SENTENCE_END, RE_WORD_END):
+        ends = [m.end() for m in pattern.finditer(text, 0, limit + 1)]
+        if ends and ends[-1] > 0:
+            return ends[-1]
+    return limit
+
+
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    chunks = []
+    while text:
+        cut = split_point(text, limit)
+        chunks.append(text[:cut])
+        text = text[cut:]
+    return chunks
+
+
+class StreamedText:
+    """Text made of `deltas` that are still arriving.
+
+    `epilogue` is called once all the deltas have arrived, and returns any extra messages to
+    post after the text. `format` is applied to the text of every message before it's sent,
+    e.g. to italicise it.
+    """
+
+    def __init__(
+        self,
+        deltas: AsyncIterable[str],
+        epilogue: Optional[Callable[[], list[str]]] = None,
+        format: Callable[[str], str] = lambda text: text,
+    ) -> None:
+        self.deltas = deltas
+        self.epilogue = epilogue or (lambda: [])
+        self.format = format
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self.deltas.__aiter__()
+
+    def __repr__(self) -> str:
+        return "StreamedText(...)"
+
+    def __bool__(self) -> bool:
+        return True
+
+    async def collect(self, limit: int = MESSAGE_LIMIT) -> list[str]:
+        """Wait for the whole text, for services that can't edit messages"""
+        text = "".join([delta async for delta in self])
+        return [self.format(chunk) for chunk in split_text(text, limit) + self.epilogue()]
+
+
+async def wait_for_text(deltas: AsyncIterable[str]) -> Optional[AsyncIterator[str]]:
+    """Wait until `deltas` has something to say, e.g. before claiming a message with it.
+
+    Returns None if it ends without saying anything. Otherwise returns all of its deltas,
+    starting again with the ones that were waited for.
+    """
+    remaining = deltas.__aiter__()
+    waited: list[str] = []
+    async for delta in remaining:
+        waited.append(delta)
+        if delta.strip():
+            break
+    else:
+        return None
+
+    async def resumed() -> AsyncIterator[str]:
+        for delta in waited:
+            yield delta
+        async for delta in remaining:
+            yield delta
+
+    return resumed()
+
+
+async def send_streamed(
+    streamed: StreamedText,
+    send: Callable[[str], Awaitable[Message]],
+    edit: Callable[[Message, str], Awaitable[object]],
+    limit: int = MESSAGE_LIMIT,
+) -> list[Message]:
+    """Show `streamed` as it arrives, using `send` to post new messages and `edit` to update them.
+
+    Returns all the messages that were sent.
+    """
+    # leave room for whatever `format` adds, e.g. italics marks
+    limit -= len(streamed.format("x")) - 1
+    sent: list[Message] = []
+    current: Optional[Message] = None  # the message that's still being written
+    text = ""  # everything that belongs in `current`
+    shown = ""  # what `current` says at the moment
+    last_edit = 0.0
+
+    async def show(new_text: str) -> None:
+        nonlocal current, shown, last_edit
+        if not new_text.strip():
+            return
+        if current is None:
+            current = await send(streamed.format(new_text))
+            sent.append(current)
+        else:
+            await edit(current, streamed.format(new_text))
+        shown = new_text
+        last_edit = time.monotonic()
+
+    async for delta in streamed:
+        text += delta
+
+        # finish off any messages that are full, and carry on in a new one
+        while len(text) > limit:
+            cut = split_point(text, limit)
+            await show(text[:cut])
+            current, shown, text = None, "", text[cut:]
+
+        if current is None:
+            # wait for a whole sentence before posting, so the first thing people see makes sense
+            sentences = [m.end() for m in RE_SENTENCE_END.finditer(text)]
+            if sentences:
+                await show(text[: sentences[-1]])
+        elif text != shown and time.monotonic() - last_edit >= EDIT_INTERVAL:
+            await show(text)
+
+    if text != shown:
+        await show(text)
+
+    for extra in streamed.epilogue():
+        for chunk in split_text(extra, limit):
+            sent.append(await send(streamed.format(chunk)))
+    return sent
+
+
+def iter_blocking(streamed: StreamedText) -> Iterator[str]:
+    """The text as it arrives, for code that isn't async (e.g. a Flask response body).
+
+    Runs the deltas in an event loop of its own. The text is formatted as a whole, e.g.
+    italicised from its first delta to its last, and the epilogue's messages each in a
+    paragraph of its own.
+    """
+    # what `format` puts either side of the text, sent before its first delta and after its last
+    before, marker, after = streamed.format(FORMAT_MARKER).partition(FORMAT_MARKER)
+    sample = "Some text."
+    if not marker or streamed.format(sample) != before + sample + after:
+        # a format that does more than wrap the text, so it needs all of it
+        marker = ""
+    loop = asyncio.new_event_loop()
+    deltas = streamed.__aiter__()
+    text = ""
+    started = False
+    try:
+        while True:
+            try:
+                delta = loop.run_until_complete(deltas.__anext__())
+            except StopAsyncIteration:
+                break
+            text += delta
+            if not marker:
+                continue
+            if not started and delta.strip():
+                started = True
+                delta = before + delta
+            yield delta
+        if not marker:
+            yield streamed.format(text)
+        elif started:
+            yield after
+        for extra in streamed.epilogue():
+            yield "\n\n" + streamed.format(extra)
+    finally:
+        # e.g. the client went away, so close the request that's producing the deltas
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()